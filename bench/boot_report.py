@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Report where app boot time goes
+
+Runs `import app; app.create_app()` in a fresh interpreter under
+`python -X importtime` and prints the slowest imports (cumulative, including
+their own imports) plus the time create_app() itself takes, as JSON.
+
+    python bench/boot_report.py --top 25
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+BOOT_SCRIPT = """
+import time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app({config_name!r})
+created = time.perf_counter()
+print('BOOT', imported - start, created - imported)
+"""
+
+
+def parse_importtime(stderr):
+    """Return {module: (self_us, cumulative_us)} from -X importtime output"""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        # Nested imports are indented; the name is what is left
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--config', default='production', help='config name passed to create_app()')
+    parser.add_argument('--top', type=int, default=20, help='how many of the slowest imports to list')
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=SRC_DIR + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    env.setdefault('SECRET_KEY', 'boot-report')
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', BOOT_SCRIPT.format(config_name=args.config)],
+                            cwd=SRC_DIR, env=env, capture_output=True, text=True)
+    boot = [line for line in result.stdout.splitlines() if line.startswith('BOOT ')]
+    if result.returncode or not boot:
+        sys.stderr.write(result.stderr[-4000:])
+        sys.exit(result.returncode or 1)
+
+    import_s, create_app_s = (float(value) for value in boot[-1].split()[1:])
+    modules = parse_importtime(result.stderr)
+    slowest = sorted(modules.items(), key=lambda item: item[1][1], reverse=True)[:args.top]
+    heavy = ('openai', 'httpx', 'cryptography', 'tiktoken', 'sqlalchemy', 'bcrypt')
+    report = {
+        'import_app_ms': round(import_s * 1000, 1),
+        'create_app_ms': round(create_app_s * 1000, 1),
+        'modules_imported': len(modules),
+        # Heavy packages that should only load on first use
+        'heavy_imported_at_boot': sorted(name for name in modules if name in heavy),
+        'slowest_imports': [
+            {'module': name, 'cumulative_ms': round(cumulative / 1000, 1), 'self_ms': round(own / 1000, 1)}
+            for name, (own, cumulative) in slowest
+        ],
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the OpenAI chat completions API
+
+Serves POST /v1/chat/completions (plain and streamed) and GET /v1/models
+with configurable latency, jitter and error rate, so load tests exercise the
+real OpenAI client and connection pool without paying for API calls.
+
+    python bench/fake_llm.py --port 8099 --latency 0.8 --jitter 0.3 --error-rate 0.01
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_REPLY = "that sounds like a lot to carry. what's been the hardest part of it for you?"
+
+
+class FakeLLMSettings:
+    def __init__(self, latency=0.5, jitter=0.1, error_rate=0.0, chunk_delay=0.02, reply=DEFAULT_REPLY):
+        # latency is time to first token; chunk_delay separates streamed words
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.chunk_delay = chunk_delay
+        self.reply = reply
+        self.completions = 0
+        self.injected_errors = 0
+        self.lock = threading.Lock()
+
+    def count(self, failed):
+        with self.lock:
+            self.completions += 1
+            self.injected_errors += failed
+
+    def first_token_delay(self):
+        return max(0.0, random.gauss(self.latency, self.jitter)) if self.jitter else self.latency
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    settings = FakeLLMSettings()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def write_chunk(self, data):
+        # HTTP/1.1 chunked transfer encoding keeps the connection reusable
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/models'):
+            self.send_json(200, {"object": "list", "data": [{"id": "gpt-3.5-turbo", "object": "model",
+                                                             "created": 0, "owned_by": "fake"}]})
+        else:
+            self.send_json(404, {"error": {"message": "Not found", "type": "invalid_request_error"}})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        request = json.loads(self.rfile.read(length) or b'{}')
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_json(404, {"error": {"message": "Not found", "type": "invalid_request_error"}})
+            return
+
+        settings = self.settings
+        time.sleep(settings.first_token_delay())
+        failed = random.random() < settings.error_rate
+        settings.count(failed)
+        if failed:
+            self.send_json(500, {"error": {"message": "Injected failure", "type": "server_error"}})
+            return
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        model = request.get('model', 'gpt-3.5-turbo')
+        created = int(time.time())
+        words = settings.reply.split(' ')
+
+        if not request.get('stream'):
+            self.send_json(200, {
+                "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": settings.reply}}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(words), "total_tokens": len(words)}
+            })
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(settings.chunk_delay)
+            chunk = {
+                "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                "choices": [{"index": 0, "finish_reason": None,
+                             "delta": {"content": word if i == len(words) - 1 else word + ' '}}]
+            }
+            self.write_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+        final = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                 "choices": [{"index": 0, "finish_reason": "stop", "delta": {}}]}
+        self.write_chunk(f"data: {json.dumps(final)}\n\n".encode())
+        self.write_chunk(b"data: [DONE]\n\n")
+        self.write_chunk(b"")
+
+
+def start_fake_llm(host='127.0.0.1', port=0, settings=None):
+    """Start the fake API on a background thread; returns (server, base_url)"""
+    handler = type('ConfiguredFakeLLMHandler', (FakeLLMHandler,), {'settings': settings or FakeLLMSettings()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def add_arguments(parser):
+    parser.add_argument('--latency', type=float, default=0.5, help='mean seconds to first token')
+    parser.add_argument('--jitter', type=float, default=0.1, help='standard deviation of the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of calls that fail with a 500')
+    parser.add_argument('--chunk-delay', type=float, default=0.02, help='seconds between streamed words')
+
+
+def settings_from_args(args):
+    return FakeLLMSettings(latency=args.latency, jitter=args.jitter,
+                           error_rate=args.error_rate, chunk_delay=args.chunk_delay)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8099)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server, base_url = start_fake_llm(args.host, args.port, settings_from_args(args))
+    print(f"Fake LLM API listening on {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Load test for the chat app against a local fake LLM provider
+
+Starts the fake OpenAI API, then the app under gunicorn with
+gunicorn.conf.py in its own process, and runs concurrent virtual users through guest and account flows: signup,
+login, choosing a chat mode, plain and streamed chat turns, history reads
+and guest status polls. Prints a JSON report (throughput, latency
+percentiles and error counts per endpoint) that can be diffed between
+commits.
+
+    python bench/loadtest.py --users 50 --duration 60 --output results.json
+
+Use --target to drive an already running deployment instead (it must run
+with WTF_CSRF_ENABLED=False and point OPENAI_BASE_URL at a fake API).
+"""
+import argparse
+import atexit
+import http.cookiejar
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_llm import start_fake_llm, add_arguments, settings_from_args
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MESSAGES = [
+    "today was rough, work just keeps piling up",
+    "i finally went for a run this morning",
+    "i can't stop thinking about what my friend said",
+    "honestly i'm just tired of feeling like this",
+    "we adopted a dog last week and she's chaos",
+    "not sure if i should take the new job offer",
+]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_app(base_url, database_path, workers=None, threads=None, boot_timeout=60):
+    """Boot the app under gunicorn with gunicorn.conf.py in a separate process
+
+    Running it apart from the virtual users keeps their threads from
+    competing with the app for one GIL, and exercises the production worker
+    settings. Returns (process, base_url).
+    """
+    env = dict(os.environ, **{
+        'SECRET_KEY': 'loadtest',
+        'DATABASE_URL': f'sqlite:///{database_path}',
+        'WRITE_BEHIND_SPOOL': database_path + '.spool',
+        'WTF_CSRF_ENABLED': 'False',
+        'LLM_PROVIDER': 'openai',
+        'OPENAI_API_KEY': 'sk-loadtest',
+        'OPENAI_BASE_URL': base_url,
+        'OPENAI_MAX_RETRIES': '0',
+        'LOG_LEVEL': 'WARNING',
+    })
+    # Virtual users chat far faster than people, so lift the per-visitor
+    # quotas unless the caller set them to test admission control itself
+    for name in ('USER_REQUESTS_PER_MINUTE', 'USER_REQUEST_BURST', 'GUEST_REQUESTS_PER_MINUTE', 'GUEST_REQUEST_BURST'):
+        env.setdefault(name, '100000')
+    for name in ('USER_TOKENS_PER_MINUTE', 'GUEST_TOKENS_PER_MINUTE'):
+        env.setdefault(name, '100000000')
+    if workers:
+        env['WEB_CONCURRENCY'] = str(workers)
+    if threads:
+        env['GUNICORN_THREADS'] = str(threads)
+
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'wsgi', 'init-db'],
+                   cwd=ROOT_DIR, env=env, check=True, stdout=subprocess.DEVNULL)
+    port = free_port()
+    process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+                                '--bind', f'127.0.0.1:{port}', 'wsgi:application'], cwd=ROOT_DIR, env=env)
+    atexit.register(stop_app, process)
+
+    app_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + boot_timeout
+    while True:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with status {process.returncode}")
+        try:
+            with urllib.request.urlopen(app_url + '/', timeout=1):
+                return process, app_url
+        except urllib.error.HTTPError:
+            return process, app_url
+        except OSError:
+            if time.time() > deadline:
+                stop_app(process)
+                raise RuntimeError(f"gunicorn did not answer within {boot_timeout}s")
+            time.sleep(0.2)
+
+
+def stop_app(process):
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+class Recorder:
+    """Collects latency samples and errors per endpoint"""
+
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds, ok):
+        with self.lock:
+            self.samples.setdefault(name, []).append(seconds)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+
+class VirtualUser:
+    def __init__(self, base_url, recorder, args):
+        self.base_url = base_url
+        self.recorder = recorder
+        self.args = args
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def call(self, name, method, path, payload=None, stream=False):
+        data = json.dumps(payload).encode() if payload is not None else None
+        request = urllib.request.Request(self.base_url + path, data=data, method=method)
+        if data is not None:
+            request.add_header('Content-Type', 'application/json')
+        if name.startswith('chat_message'):
+            request.add_header('Idempotency-Key', uuid.uuid4().hex)
+
+        start = time.perf_counter()
+        ok = True
+        try:
+            with self.opener.open(request, timeout=self.args.timeout) as response:
+                if stream:
+                    # Record time to first byte separately from the whole stream
+                    response.read(1)
+                    self.recorder.record(f"{name}_first_byte", time.perf_counter() - start, True)
+                response.read()
+                ok = response.status < 400
+        except urllib.error.HTTPError as e:
+            ok = e.code < 400
+        except Exception:
+            ok = False
+        self.recorder.record(name, time.perf_counter() - start, ok)
+        return ok
+
+    def run(self, deadline):
+        args = self.args
+        while time.time() < deadline:
+            self.call('index', 'GET', '/')
+            guest = random.random() < args.guest_ratio
+            if not guest:
+                email = f"{uuid.uuid4().hex}@loadtest.local"
+                self.call('signup', 'POST', '/auth/signup',
+                          {'first_name': 'Load', 'email': email, 'password': 'loadtest-password'})
+                self.call('logout', 'GET', '/auth/logout')
+                self.call('login', 'POST', '/auth/login', {'email': email, 'password': 'loadtest-password'})
+
+            self.call('chat_mode', 'POST', '/auth/chat/mode', {'mode': random.choice(['listen', 'talk'])})
+            for _ in range(args.turns):
+                if time.time() >= deadline:
+                    break
+                message = {'message': random.choice(MESSAGES)}
+                if random.random() < args.stream_ratio:
+                    self.call('chat_message_stream', 'POST', '/auth/chat/message/stream', message, stream=True)
+                else:
+                    self.call('chat_message', 'POST', '/auth/chat/message', message)
+                self.call('chat_history', 'GET', '/auth/chat/history?limit=20')
+                if guest:
+                    self.call('guest_status', 'GET', '/auth/guest/status')
+                time.sleep(random.uniform(0, args.think_time))
+
+            if not guest:
+                self.call('logout', 'GET', '/auth/logout')
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples, errors, elapsed):
+    ordered = sorted(samples)
+    return {
+        'count': len(ordered),
+        'errors': errors,
+        'throughput_rps': round(len(ordered) / elapsed, 2) if elapsed else 0.0,
+        'mean_ms': round(sum(ordered) / len(ordered) * 1000, 2) if ordered else None,
+        'p50_ms': round(percentile(ordered, 0.50) * 1000, 2) if ordered else None,
+        'p95_ms': round(percentile(ordered, 0.95) * 1000, 2) if ordered else None,
+        'p99_ms': round(percentile(ordered, 0.99) * 1000, 2) if ordered else None,
+        'max_ms': round(ordered[-1] * 1000, 2) if ordered else None,
+    }
+
+
+def build_report(recorder, elapsed, args, llm_settings=None):
+    endpoints = {name: summarize(values, recorder.errors.get(name, 0), elapsed)
+                 for name, values in sorted(recorder.samples.items())}
+    everything = [value for name, values in recorder.samples.items()
+                  if not name.endswith('_first_byte') for value in values]
+    total_errors = sum(count for name, count in recorder.errors.items() if not name.endswith('_first_byte'))
+    return {
+        'settings': {
+            'users': args.users, 'duration_s': args.duration, 'turns': args.turns,
+            'guest_ratio': args.guest_ratio, 'stream_ratio': args.stream_ratio, 'think_time_s': args.think_time,
+            'workers': args.workers, 'threads': args.threads,
+            'llm_latency_s': args.latency, 'llm_jitter_s': args.jitter, 'llm_error_rate': args.error_rate,
+        },
+        'elapsed_s': round(elapsed, 2),
+        'overall': summarize(everything, total_errors, elapsed),
+        'endpoints': endpoints,
+        # Provider failures are answered with fallback replies, so count them at the source
+        'llm': {'completions': llm_settings.completions, 'injected_errors': llm_settings.injected_errors}
+        if llm_settings else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--users', type=int, default=20, help='concurrent virtual users')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run')
+    parser.add_argument('--turns', type=int, default=5, help='chat turns per conversation')
+    parser.add_argument('--guest-ratio', type=float, default=0.5, help='fraction of users chatting as guests')
+    parser.add_argument('--stream-ratio', type=float, default=0.5, help='fraction of turns using the stream endpoint')
+    parser.add_argument('--think-time', type=float, default=0.5, help='max seconds a user pauses between turns')
+    parser.add_argument('--timeout', type=float, default=60, help='per-request timeout in seconds')
+    parser.add_argument('--target', help='base URL of a running app instead of starting one under gunicorn')
+    parser.add_argument('--workers', type=int, help='gunicorn workers for the local app (WEB_CONCURRENCY)')
+    parser.add_argument('--threads', type=int, help='threads per gunicorn worker (GUNICORN_THREADS)')
+    parser.add_argument('--seed', type=int, help='random seed for a repeatable request mix')
+    parser.add_argument('--output', help='write the JSON report here as well as to stdout')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    llm_settings = None
+    if args.target:
+        base_url = args.target.rstrip('/')
+    else:
+        llm_settings = settings_from_args(args)
+        _, llm_url = start_fake_llm(settings=llm_settings)
+        database_path = os.path.join(tempfile.mkdtemp(prefix='neurochat-loadtest-'), 'loadtest.db')
+        _, base_url = start_app(llm_url, database_path, args.workers, args.threads)
+
+    recorder = Recorder()
+    deadline = time.time() + args.duration
+    started = time.perf_counter()
+    users = [threading.Thread(target=VirtualUser(base_url, recorder, args).run, args=(deadline,), daemon=True)
+             for _ in range(args.users)]
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+
+    report = build_report(recorder, time.perf_counter() - started, args, llm_settings)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
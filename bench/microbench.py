@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the code that runs on every chat turn
+
+Times message encryption and decryption, history decryption at 10, 100 and
+1,000 messages, context assembly, session cookie serialisation and password
+hashing. Each result is compared with bench/baselines.json. The run fails
+if any benchmark is slower than its baseline by more than the threshold.
+
+    python bench/microbench.py                  # compare, exit 1 on a regression
+    python bench/microbench.py --update         # record new baselines
+    python bench/microbench.py --filter history --threshold 0.5
+
+Baselines depend on the machine; record them on the one that runs the check.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'src')
+BASELINES_PATH = os.path.join(BENCH_DIR, 'baselines.json')
+
+# Pinned so every run encrypts with the same key and cost
+ENCRYPTION_KEY = 'bWljcm9iZW5jaC1waW5uZWQta2V5LTMyLWJ5dGVzISE='
+BCRYPT_ROUNDS = 4
+MESSAGE = "honestly i'm just tired of feeling like this, work has been a lot and i can't switch off at night"
+PASSWORD = 'correct horse battery staple'
+REPLY = "that sounds exhausting. what usually helps you wind down when your head won't stop?"
+
+
+def measure(fn, min_time=0.2, repeat=5):
+    """Best seconds per call over `repeat` runs of a loop lasting about `min_time`"""
+    loops = 1
+    while True:
+        elapsed = _time_loops(fn, loops)
+        if elapsed >= min_time / 4 or loops >= 1 << 20:
+            break
+        loops *= 2
+    loops = max(1, int(loops * min_time / max(elapsed, 1e-9)))
+    return min(_time_loops(fn, loops) for _ in range(repeat)) / loops
+
+
+def _time_loops(fn, loops):
+    # As timeit does, keep collector pauses out of the numbers
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        return time.perf_counter() - start
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def build_app():
+    os.environ.setdefault('SECRET_KEY', 'microbench')
+    os.environ['ENCRYPTION_KEY'] = ENCRYPTION_KEY
+    sys.path.insert(0, SRC_DIR)
+    from app import create_app
+    app = create_app('testing')
+    from auth.models import db
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def seed_conversation(size, mode='talk'):
+    """A stored guest conversation of `size` alternating encrypted messages"""
+    from auth.models import db, Conversation
+    from auth.conversations import add_messages
+    from auth.cipher import get_cipher
+    conversation = Conversation(mode=mode)
+    db.session.add(conversation)
+    db.session.commit()
+    bodies = get_cipher().encrypt_many([MESSAGE if i % 2 == 0 else REPLY for i in range(size)])
+    add_messages(conversation, [('user' if i % 2 == 0 else 'ai', body, True) for i, body in enumerate(bodies)])
+    return conversation
+
+
+def benchmarks(app):
+    """Yield (name, zero-argument callable) pairs, run inside a request context"""
+    from flask import session
+    from auth.routes import encrypt_message, decrypt_message, get_decrypted_conversation_history
+    from auth.context import build_context
+    from auth.prompts import get_persona
+    from auth.passwords import PasswordHasher
+    from auth.models import User
+
+    encrypted = encrypt_message(MESSAGE)
+    yield 'encrypt_message', lambda: encrypt_message(MESSAGE)
+    yield 'decrypt_message', lambda: decrypt_message(encrypted)
+
+    conversations = {size: seed_conversation(size) for size in (10, 100, 1000)}
+
+    def history(size):
+        def run():
+            session['conversation_id'] = conversations[size].id
+            return get_decrypted_conversation_history(session)
+        return run
+
+    for size in (10, 100, 1000):
+        yield f'history_decrypt_{size}', history(size)
+
+    for mode in ('listen', 'talk'):
+        persona = get_persona(mode)
+
+        def assemble(persona=persona, mode=mode):
+            context = build_context(conversations[100], mode, MESSAGE)
+            return persona.build_messages(MESSAGE, context.history, context.summary)
+        yield f'context_assembly_{mode}', assemble
+
+    # The history lives in the database; the cookie carries the ids and guest state
+    serializer = app.session_interface.get_signing_serializer(app)
+    cookie = {'conversation_id': conversations[1000].id, 'chat_mode': 'talk', 'guest_id': 'a' * 32,
+              'guest_start_time': time.time(), 'guest_mode': 'guest', 'guest_expired_notified': False,
+              'csrf_token': 'b' * 40}
+    signed = serializer.dumps(cookie)
+    yield 'session_serialize', lambda: serializer.dumps(cookie)
+    yield 'session_load', lambda: serializer.loads(signed)
+
+    hasher = PasswordHasher(rounds=BCRYPT_ROUNDS, workers=0)
+    user = User(first_name='Bench', email='bench@example.com')
+    user.set_password(PASSWORD, hasher)
+    yield 'set_password', lambda: user.set_password(PASSWORD, hasher)
+    yield 'check_password', lambda: user.check_password(PASSWORD, hasher)
+
+
+def environment():
+    try:
+        import tiktoken  # noqa: F401 - token counting is far slower without it
+        tokenizer = 'tiktoken'
+    except ImportError:
+        tokenizer = 'estimate'
+    return {'python': platform.python_version(), 'machine': platform.machine(), 'tokenizer': tokenizer}
+
+
+def compare(results, baselines, threshold):
+    """Per-benchmark report plus the names that regressed beyond the threshold"""
+    report = {}
+    regressions = []
+    for name, seconds in results.items():
+        baseline = baselines.get(name)
+        entry = {'us_per_op': round(seconds * 1e6, 2)}
+        if baseline:
+            change = seconds / baseline - 1
+            entry.update(baseline_us=round(baseline * 1e6, 2), change=round(change, 3))
+            if change > threshold:
+                regressions.append(name)
+        report[name] = entry
+    return report, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--update', action='store_true', help='write the results as the new baselines')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed slowdown over the baseline before failing (0.25 = 25%%)')
+    parser.add_argument('--filter', default='', help='only run benchmarks whose name contains this')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds per timing run')
+    args = parser.parse_args()
+
+    try:
+        with open(BASELINES_PATH) as f:
+            stored = json.load(f)
+    except FileNotFoundError:
+        stored = {'environment': None, 'results': {}}
+
+    app = build_app()
+    results = {}
+    with app.test_request_context():
+        cases = {name: fn for name, fn in benchmarks(app) if args.filter in name}
+        for name, fn in cases.items():
+            results[name] = measure(fn, min_time=args.min_time)
+        if not args.update:
+            # A one-off stall should not fail the run; a regression survives a second look
+            _, suspects = compare(results, stored['results'], args.threshold)
+            for name in suspects:
+                results[name] = min(results[name], measure(cases[name], min_time=args.min_time))
+
+    if args.update:
+        merged = dict(stored['results'], **results)
+        with open(BASELINES_PATH, 'w') as f:
+            json.dump({'environment': environment(), 'results': merged}, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    report, regressions = compare(results, stored['results'], args.threshold)
+    print(json.dumps({
+        'environment': environment(),
+        'baseline_environment': stored['environment'],
+        'threshold': args.threshold,
+        'benchmarks': report,
+        'regressions': [] if args.update else regressions,
+    }, indent=2))
+    if regressions and not args.update:
+        sys.stderr.write(f"Regressed beyond {args.threshold:.0%}: {', '.join(regressions)}\n")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+Gunicorn configuration for production deployment
+
+Chat requests spend almost all of their time waiting on the LLM provider, so
+each worker runs a pool of threads (gthread) and every thread carries one
+in-flight request. Concurrency is workers x threads instead of just workers,
+and slow completions no longer starve login and static requests.
+"""
+import multiprocessing
+from decouple import config as env_config
+
+bind = f"0.0.0.0:{env_config('PORT', default=5000)}"
+
+# 'gthread' needs nothing extra; 'gevent' works too if it is installed
+worker_class = env_config('GUNICORN_WORKER_CLASS', default='gthread')
+workers = env_config('WEB_CONCURRENCY', default=min(multiprocessing.cpu_count() * 2 + 1, 8), cast=int)
+threads = env_config('GUNICORN_THREADS', default=32, cast=int)
+# Maximum simultaneous clients per worker for async worker classes
+worker_connections = env_config('GUNICORN_WORKER_CONNECTIONS', default=1000, cast=int)
+
+# Streamed replies keep a request open for the whole generation
+timeout = env_config('GUNICORN_TIMEOUT', default=120, cast=int)
+graceful_timeout = env_config('GUNICORN_GRACEFUL_TIMEOUT', default=30, cast=int)
+keepalive = env_config('GUNICORN_KEEPALIVE', default=5, cast=int)
+
+# Build the app once in the master and fork workers from it. Creating the app
+# does no I/O, and post_fork below replaces anything with sockets.
+preload_app = env_config('GUNICORN_PRELOAD', default=True, cast=bool)
+
+# Recycle workers now and then so a slow leak can't grow without bound
+max_requests = env_config('GUNICORN_MAX_REQUESTS', default=1000, cast=int)
+max_requests_jitter = env_config('GUNICORN_MAX_REQUESTS_JITTER', default=100, cast=int)
+
+
+def post_fork(server, worker):
+    if preload_app:
+        from app import reset_after_fork
+        reset_after_fork(server.app.wsgi())
+
+
+def worker_exit(server, worker):
+    # Finish spooled history writes before the worker goes away; anything
+    # left over is picked up from the spool by the next worker
+    queue = server.app.wsgi().extensions.get('write_behind')
+    if queue is not None:
+        queue.drain(timeout=max(1, graceful_timeout - 5))
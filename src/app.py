@@ -1,12 +1,28 @@
 import os
-from flask import Flask, render_template, session, jsonify, redirect, url_for
-from flask_bcrypt import Bcrypt
+import logging
+import click
+from flask import Flask, render_template, session, redirect, url_for
 from flask_login import LoginManager, login_required, current_user
-from flask_migrate import Migrate
 from flask_wtf.csrf import CSRFProtect
 from decouple import config as env_config
 from config import config_dict
 import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Loggers of this app's own modules; libraries stay at the root's WARNING so
+# their DEBUG output (request bodies, pool checkouts) never reaches the logs
+APP_LOGGERS = ('auth', 'assets', 'compression', 'database', 'metrics', 'profiling', 'writebehind')
+
+def configure_logging(app):
+    """Send app logs to stderr at the configured level"""
+    if not logging.getLogger().handlers:
+        logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s %(message)s')
+    level = app.config.get('LOG_LEVEL', 'INFO')
+    app.logger.setLevel(level)
+    for name in APP_LOGGERS:
+        logging.getLogger(name).setLevel(level)
 
 def create_app(config_name=None):
     """Application factory pattern"""
@@ -15,13 +31,19 @@ def create_app(config_name=None):
     # Load configuration
     config_name = config_name or env_config('FLASK_ENV', default='development')
     app.config.from_object(config_dict.get(config_name, config_dict['default']))
+    configure_logging(app)
     
     # Initialize extensions
     from auth.models import db
+    from database import configure_engine_options, init_database
+    configure_engine_options(app)
     db.init_app(app)
-    migrate = Migrate(app, db)
-    bcrypt = Bcrypt(app)
-    app.extensions['bcrypt'] = bcrypt  # Store bcrypt in extensions
+    init_database(app, db)
+    # Alembic adds a few hundred ms to boot and only the `flask db` commands
+    # need it, so skip it unless the app is being built by the flask CLI
+    if click.get_current_context(silent=True) is not None:
+        from flask_migrate import Migrate
+        Migrate(app, db)
     csrf = CSRFProtect(app)
     
     login_manager = LoginManager()
@@ -29,14 +51,79 @@ def create_app(config_name=None):
     login_manager.login_view = 'auth.login'
     login_manager.login_message_category = 'info'
     
+    # bcrypt runs on a process pool instead of the request threads
+    from auth.passwords import init_password_hasher
+    init_password_hasher(app)
+    
+    # Build the chat provider once so every request reuses its connection pool
+    from auth.provider import init_provider
+    init_provider(app)
+    
+    # Per-mode personas; token counts of their fixed prompts are cached
+    from auth.prompts import init_prompts
+    init_prompts(app)
+    
+    # Parse the encryption keys once and keep a ready cipher
+    from auth.cipher import init_cipher
+    init_cipher(app)
+    
+    # Blind-index key for searching encrypted history
+    from auth.search import init_search
+    init_search(app)
+    
+    # Duplicate chat submits share one generation
+    from auth.idempotency import init_idempotency
+    init_idempotency(app)
+    
+    # Guest expiries are scheduled once and pushed to waiting clients
+    from auth.guests import init_guest_registry
+    init_guest_registry(app)
+    
+    # Quotas and a provider concurrency cap for chat turns
+    from auth.admission import init_admission
+    init_admission(app)
+    
+    # Chat history and summaries are written after the reply goes out
+    from writebehind import init_write_behind
+    init_write_behind(app)
+    
+    # Per-stage latency histograms, served on /metrics
+    from metrics import init_metrics
+    init_metrics(app)
+    
+    # cProfile of sampled or explicitly requested requests, when configured
+    from profiling import init_profiling
+    init_profiling(app)
+    
+    # gzip/brotli for JSON, HTML and streamed replies
+    from compression import init_compression
+    init_compression(app)
+    
+    # Fingerprinted static files with immutable caching, once built
+    from assets import init_assets
+    init_assets(app)
+    
     # Register blueprints
     from auth import auth
     app.register_blueprint(auth, url_prefix='/auth')
     
+    # `flask export-conversations` for data-access requests
+    from auth.export import init_export
+    init_export(app)
+    
+    # Logged-in users are served from memory instead of a query per request
+    from auth.identity import init_user_cache
+    init_user_cache(app)
+    
     @login_manager.user_loader
     def load_user(user_id):
-        from auth.models import User
-        return User.query.get(int(user_id))
+        from auth.identity import get_user_cache
+        return get_user_cache().get(int(user_id))
+    
+    @app.cli.command('init-db')
+    def init_db_command():
+        """Create the database tables (run once per deploy, not on import)"""
+        init_db(app)
     
     # Main routes
     @app.route('/')
@@ -48,7 +135,8 @@ def create_app(config_name=None):
         # Always start fresh guest session when server loads
         session['guest_start_time'] = time.time()
         session['guest_mode'] = 'guest'
-        session['conversation_history'] = []
+        session['guest_id'] = uuid.uuid4().hex
+        session.pop('conversation_id', None)
         session['guest_expired_notified'] = False
         
         return render_template('index.html')
@@ -61,46 +149,34 @@ def create_app(config_name=None):
     
     return app
 
-# Create app instance
-app = create_app()
-
-# Initialize database after app creation
-with app.app_context():
-    try:
-        print("Starting database initialization...")
-        
+def init_db(app):
+    """Create the instance directory and any missing tables"""
+    with app.app_context():
         # Use the configured instance path from config
         instance_path = app.config.get('INSTANCE_DIR', os.path.join(os.getcwd(), 'instance'))
-        print(f"Instance path: {instance_path}")
-        
         if not os.path.exists(instance_path):
             os.makedirs(instance_path)
-            print(f"Created instance directory: {instance_path}")
-        else:
-            print(f"Instance directory already exists: {instance_path}")
+            logger.info("created instance directory path=%s", instance_path)
         
-        print("Importing database models...")
         from auth.models import db, User
-        print("Database models imported successfully")
-        
-        print("Creating database tables...")
         db.create_all()
-        print("Database tables created successfully")
         
         # Check if we have any users
         user_count = User.query.count()
-        print(f"Current user count: {user_count}")
-        
-        print("Database initialization completed successfully!")
-        
-    except Exception as e:
-        print(f"Database initialization error: {e}")
-        print(f"Error type: {type(e)}")
-        import traceback
-        traceback.print_exc()
-        print("Database initialization failed!")
+        logger.info("database initialized users=%d", user_count)
+
+def reset_after_fork(app):
+    """Give a worker forked from a preloaded parent its own connections"""
+    from auth.models import db
+    from auth.provider import init_provider
+    with app.app_context():
+        # close=False leaves the parent's sockets alone instead of shutting them under it
+        db.engine.dispose(close=False)
+    init_provider(app)
 
 if __name__ == '__main__':
+    app = create_app()
+    init_db(app)
     app.run(debug=env_config('DEBUG', default=False, cast=bool), 
             host='0.0.0.0', 
             port=int(env_config('PORT', default=5000)))
@@ -0,0 +1,141 @@
+"""
+Fingerprinted, precompressed static assets
+
+`flask build-assets` copies every file under static/ to static/dist/ with a
+content hash in its name, writes .gz (and .br when the brotli package is
+installed) next to text assets, and records the mapping in
+static/dist/manifest.json. Templates call asset_url() to get the hashed
+URL, which is served with a one-year immutable Cache-Control and the best
+precompressed encoding the client accepts. Without a manifest asset_url()
+falls back to the plain files, so development needs no build.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import shutil
+import threading
+import click
+from flask import current_app, request, send_file, url_for, abort
+from werkzeug.security import safe_join
+
+logger = logging.getLogger(__name__)
+
+DIST_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+# Only text formats shrink; images and fonts are already compressed
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.html', '.txt', '.map')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+_manifest_lock = threading.Lock()
+
+
+def fingerprint(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            digest.update(block)
+    return digest.hexdigest()[:12]
+
+
+def compress(path):
+    """Write path.gz and, if brotli is available, path.br when they are smaller"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    variants = [('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+    try:
+        import brotli
+        variants.append(('.br', brotli.compress(data, quality=11)))
+    except ImportError:
+        pass
+    written = []
+    for suffix, compressed in variants:
+        if len(compressed) < len(data):
+            with open(path + suffix, 'wb') as f:
+                f.write(compressed)
+            written.append(suffix)
+    return written
+
+
+def build_assets(static_folder):
+    """Fingerprint and precompress everything in static_folder; returns the manifest"""
+    dist = os.path.join(static_folder, DIST_DIR)
+    if os.path.isdir(dist):
+        shutil.rmtree(dist)
+    manifest = {}
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = sorted(d for d in dirs if os.path.join(root, d) != dist)
+        for name in sorted(files):
+            source = os.path.join(root, name)
+            logical = os.path.relpath(source, static_folder).replace(os.sep, '/')
+            stem, ext = os.path.splitext(logical)
+            hashed = f"{DIST_DIR}/{stem}.{fingerprint(source)}{ext}"
+            target = os.path.join(static_folder, *hashed.split('/'))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(source, target)
+            encodings = compress(target) if ext.lower() in COMPRESSIBLE else []
+            manifest[logical] = hashed
+            logger.info("built asset %s -> %s encodings=%s", logical, hashed, ','.join(encodings) or 'none')
+    with open(os.path.join(dist, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(app):
+    """Read the manifest once per process; an empty one means serve plain files"""
+    manifest = app.extensions.get('asset_manifest')
+    if manifest is None:
+        with _manifest_lock:
+            manifest = app.extensions.get('asset_manifest')
+            if manifest is None:
+                path = os.path.join(app.static_folder, DIST_DIR, MANIFEST_NAME)
+                try:
+                    with open(path) as f:
+                        manifest = json.load(f)
+                except FileNotFoundError:
+                    manifest = {}
+                app.extensions['asset_manifest'] = manifest
+    return manifest
+
+
+def asset_url(filename):
+    """URL of a static file, fingerprinted if the assets were built"""
+    return url_for('static', filename=load_manifest(current_app).get(filename, filename))
+
+
+def serve_static(filename):
+    """Static view: built assets get immutable caching and precompressed bodies"""
+    app = current_app
+    if not filename.startswith(DIST_DIR + '/'):
+        return app.send_static_file(filename)
+
+    path = safe_join(app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if request.accept_encodings[encoding] and os.path.isfile(path + suffix):
+            response = send_file(path + suffix, mimetype=mimetype, conditional=True)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_file(path, mimetype=mimetype, conditional=True)
+    response.headers['Cache-Control'] = IMMUTABLE
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def init_assets(app):
+    """Serve built assets and expose asset_url() to templates"""
+    app.view_functions['static'] = serve_static
+    app.jinja_env.globals['asset_url'] = asset_url
+
+    @app.cli.command('build-assets')
+    def build_assets_command():
+        """Fingerprint and precompress static files into static/dist"""
+        manifest = build_assets(app.static_folder)
+        app.extensions['asset_manifest'] = manifest
+        click.echo(f"Built {len(manifest)} assets into {os.path.join(app.static_folder, DIST_DIR)}")
@@ -0,0 +1,218 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+from metrics import ADMISSION_IN_FLIGHT, ADMISSION_REJECTIONS
+
+
+class AdmissionRejected(Exception):
+    """Raised when a chat turn cannot be admitted; retry_after is in seconds"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionBackend:
+    """Interface for where admission state lives"""
+
+    def consume(self, buckets):
+        """Take cost from every (key, rate, capacity, cost) token bucket, or from none
+
+        Returns 0 if all buckets had enough, else the seconds until they will.
+        """
+        raise NotImplementedError
+
+    def refund(self, buckets):
+        """Give cost back to every (key, rate, capacity, cost) bucket, up to its capacity"""
+        raise NotImplementedError
+
+    def acquire(self, name, limit, max_waiters, timeout):
+        """Take one of `limit` slots, waiting up to timeout; returns False if none came free"""
+        raise NotImplementedError
+
+    def release(self, name):
+        """Give back a slot taken with acquire()"""
+        raise NotImplementedError
+
+
+class MemoryAdmissionBackend(AdmissionBackend):
+    """Per-process admission state; each worker enforces its own share"""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._slots = {}
+        self._waiters = {}
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+
+    def _level(self, key, rate, capacity, now):
+        tokens, updated = self._buckets.get(key, (capacity, now))
+        return min(capacity, tokens + (now - updated) * rate)
+
+    def consume(self, buckets):
+        now = time.monotonic()
+        with self._lock:
+            levels = [self._level(key, rate, capacity, now) for key, rate, capacity, _ in buckets]
+            wait = 0.0
+            for level, (_, rate, capacity, cost) in zip(levels, buckets):
+                cost = min(cost, capacity)
+                if level < cost:
+                    wait = max(wait, (cost - level) / rate)
+            if wait:
+                return wait
+
+            for level, (key, rate, capacity, cost) in zip(levels, buckets):
+                self._buckets[key] = (level - min(cost, capacity), now)
+                self._buckets.move_to_end(key)
+            # Forget the least recently used clients; a forgotten bucket is a full one
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return 0.0
+
+    def refund(self, buckets):
+        now = time.monotonic()
+        with self._lock:
+            for key, rate, capacity, cost in buckets:
+                if key in self._buckets:
+                    level = self._level(key, rate, capacity, now)
+                    self._buckets[key] = (min(capacity, level + min(cost, capacity)), now)
+
+    def acquire(self, name, limit, max_waiters, timeout):
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            if self._slots.get(name, 0) >= limit:
+                if self._waiters.get(name, 0) >= max_waiters:
+                    return False
+                self._waiters[name] = self._waiters.get(name, 0) + 1
+                try:
+                    while self._slots.get(name, 0) >= limit:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0 or not self._slot_freed.wait(remaining):
+                            if self._slots.get(name, 0) >= limit:
+                                return False
+                finally:
+                    self._waiters[name] -= 1
+            self._slots[name] = self._slots.get(name, 0) + 1
+            return True
+
+    def release(self, name):
+        with self._lock:
+            self._slots[name] -= 1
+            self._slot_freed.notify()
+
+
+class AdmissionTicket:
+    """An admitted chat turn; release() frees its provider slot once"""
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.released = False
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            if self.released:
+                return
+            self.released = True
+        self.controller.backend.release('provider')
+        ADMISSION_IN_FLIGHT.dec()
+
+
+class AdmissionController:
+    """Gatekeeper in front of provider calls
+
+    Each turn must fit the client's request bucket (checked first, before
+    any real work) and token bucket, and then get one of max_in_flight
+    provider slots, waiting briefly in a short queue if all are busy. A turn
+    turned away for capacity gets its quota back. Rejections carry a
+    Retry-After hint.
+    """
+
+    def __init__(self, backend, max_in_flight=20, max_queue=4, queue_timeout=2.0, limits=None):
+        self.backend = backend
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        # kind ('user'/'guest') -> (requests/min, request burst, tokens/min)
+        self.limits = limits or {}
+
+    def _request_bucket(self, kind, client_id):
+        requests_per_minute, request_burst, _ = self.limits[kind]
+        return (f"{kind}:{client_id}:requests", requests_per_minute / 60.0, request_burst, 1)
+
+    def _token_bucket(self, kind, client_id, tokens):
+        _, _, tokens_per_minute = self.limits[kind]
+        return (f"{kind}:{client_id}:tokens", tokens_per_minute / 60.0, tokens_per_minute, tokens)
+
+    def _consume(self, kind, buckets):
+        wait = self.backend.consume(buckets)
+        if wait:
+            ADMISSION_REJECTIONS.inc(reason='quota', kind=kind)
+            raise AdmissionRejected('quota', math.ceil(wait))
+
+    def check_request(self, kind, client_id):
+        """Charge one request to a client's request bucket; raises AdmissionRejected"""
+        self._consume(kind, [self._request_bucket(kind, client_id)])
+
+    def admit(self, kind, client_id, tokens):
+        """Admit a turn costing about `tokens` for a client; raises AdmissionRejected
+
+        Call check_request() for the turn first.
+        """
+        token_bucket = self._token_bucket(kind, client_id, tokens)
+        self._consume(kind, [token_bucket])
+
+        if not self.backend.acquire('provider', self.max_in_flight, self.max_queue, self.queue_timeout):
+            # Nothing ran, so none of it counts against the client
+            self.backend.refund([self._request_bucket(kind, client_id), token_bucket])
+            ADMISSION_REJECTIONS.inc(reason='capacity', kind=kind)
+            raise AdmissionRejected('capacity', max(1, math.ceil(self.queue_timeout)))
+        ADMISSION_IN_FLIGHT.inc()
+        return AdmissionTicket(self)
+
+
+def create_memory_backend(app):
+    return MemoryAdmissionBackend()
+
+
+# Backend name -> factory taking the app; register_admission_backend() adds more
+ADMISSION_BACKENDS = {
+    'memory': create_memory_backend,
+}
+
+
+def register_admission_backend(name, factory):
+    """Make an admission backend selectable through the ADMISSION_BACKEND setting"""
+    ADMISSION_BACKENDS[name] = factory
+
+
+def init_admission(app):
+    """Build the process-wide admission controller"""
+    backend_name = app.config.get('ADMISSION_BACKEND', 'memory')
+    if backend_name not in ADMISSION_BACKENDS:
+        raise ValueError(f"Unknown ADMISSION_BACKEND: {backend_name}")
+
+    controller = AdmissionController(
+        ADMISSION_BACKENDS[backend_name](app),
+        max_in_flight=app.config.get('ADMISSION_MAX_IN_FLIGHT', 20),
+        max_queue=app.config.get('ADMISSION_QUEUE_SIZE', 4),
+        queue_timeout=app.config.get('ADMISSION_QUEUE_TIMEOUT', 2.0),
+        limits={
+            'user': (app.config.get('USER_REQUESTS_PER_MINUTE', 20),
+                     app.config.get('USER_REQUEST_BURST', 5),
+                     app.config.get('USER_TOKENS_PER_MINUTE', 20000)),
+            'guest': (app.config.get('GUEST_REQUESTS_PER_MINUTE', 10),
+                      app.config.get('GUEST_REQUEST_BURST', 3),
+                      app.config.get('GUEST_TOKENS_PER_MINUTE', 8000)),
+        })
+    app.extensions['admission'] = controller
+    return controller
+
+
+def get_admission():
+    """Return the admission controller of the current app"""
+    return current_app.extensions['admission']
@@ -0,0 +1,112 @@
+import base64
+import logging
+import os
+import threading
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+_build_lock = threading.Lock()
+
+
+def parse_key(key):
+    """Turn a stored ENCRYPTION_KEY (padding optional) into a Fernet key"""
+    from cryptography.fernet import Fernet
+    key = key.strip()
+    # Keys are stored without base64 padding, so add it back
+    if len(key) % 4 != 0:
+        key += '=' * (4 - len(key) % 4)
+    # Fernet validates the decoded length and raises ValueError if it is wrong
+    Fernet(key)
+    return key.encode()
+
+
+class CipherEngine:
+    """Fernet cipher whose key material is parsed once per process"""
+
+    def __init__(self, keys):
+        from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+        # The first key encrypts; the rest only decrypt, which allows rotation
+        fernets = [Fernet(key) for key in keys]
+        self.fernet = fernets[0] if len(fernets) == 1 else MultiFernet(fernets)
+        self.invalid_token = InvalidToken
+
+    def encrypt(self, message):
+        """Encrypt a message, falling back to plain text on failure"""
+        try:
+            return base64.b64encode(self.fernet.encrypt(message.encode())).decode()
+        except Exception as e:
+            logger.error("encryption failed error=%r", e)
+            return message
+
+    def decrypt(self, encrypted_message):
+        """Decrypt a message, returning it as-is if it cannot be decrypted"""
+        try:
+            encrypted_bytes = base64.b64decode(encrypted_message.encode())
+            return self.fernet.decrypt(encrypted_bytes).decode()
+        except (self.invalid_token, ValueError) as e:
+            logger.warning("decryption failed error=%r", e)
+            return encrypted_message
+
+    def encrypt_many(self, messages):
+        """Encrypt a batch of messages with the cached cipher"""
+        encrypt = self.encrypt
+        return [encrypt(message) for message in messages]
+
+    def decrypt_many(self, encrypted_messages):
+        """Decrypt a batch of messages with the cached cipher"""
+        decrypt = self.decrypt
+        return [decrypt(message) for message in encrypted_messages]
+
+
+def load_keys(app):
+    """Read the primary and retired encryption keys from the app config"""
+    keys = []
+    primary = app.config.get('ENCRYPTION_KEY')
+    if primary:
+        try:
+            keys.append(parse_key(primary))
+        except Exception as e:
+            logger.error("invalid ENCRYPTION_KEY format error=%r", e)
+
+    for old_key in (app.config.get('ENCRYPTION_OLD_KEYS') or '').split(','):
+        if old_key.strip():
+            try:
+                keys.append(parse_key(old_key))
+            except Exception as e:
+                logger.error("ignoring invalid old encryption key error=%r", e)
+
+    if not keys:
+        keys.append(parse_key(generate_key()))
+    return keys
+
+
+def generate_key():
+    """Make a fallback key in the stored format: a Fernet key without its base64 padding"""
+    raw_key = base64.urlsafe_b64encode(os.urandom(32))
+    # Remove base64 padding for cleaner storage
+    clean_key = raw_key.decode().rstrip('=')
+    logger.warning("generated new encryption key: %s", clean_key)
+    logger.warning("IMPORTANT: Save this key to your .env file as ENCRYPTION_KEY")
+    return clean_key
+
+
+def init_cipher(app):
+    """Register the process-wide cipher engine, built with its keys on first use"""
+    if not app.config.get('ENCRYPTION_KEY'):
+        # Generated here rather than at first use so workers forked from a
+        # preloaded app share it and can read each other's messages
+        app.config['ENCRYPTION_KEY'] = generate_key()
+    app.extensions['cipher'] = None
+
+
+def get_cipher():
+    """Return the cipher engine of the current app"""
+    engine = current_app.extensions['cipher']
+    if engine is None:
+        app = current_app._get_current_object()
+        with _build_lock:
+            engine = app.extensions['cipher']
+            if engine is None:
+                engine = app.extensions['cipher'] = CipherEngine(load_keys(app))
+    return engine
@@ -0,0 +1,225 @@
+import logging
+from flask import current_app
+from .models import db, Conversation, Message
+from .cipher import get_cipher
+from .conversations import page_messages, decrypt_history, conversation_version
+from .provider import get_provider
+from .prompts import context_budget
+from metrics import chat_stage
+from writebehind import register_task, get_write_behind
+
+logger = logging.getLogger(__name__)
+
+# Per-message overhead of the chat format (role markers and separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+# Messages decrypted per step while packing the window, newest first
+CONTEXT_PAGE_SIZE = 8
+
+SUMMARY_PROMPT = """You maintain a running summary of a supportive conversation between a user and Neurochat.
+Merge the new messages into the existing summary. Keep the facts, feelings and topics the user shared that would help continue the conversation naturally.
+Write plain prose in the third person, no more than a few sentences."""
+
+_encoding = None
+
+
+def count_tokens(text):
+    """Count the tokens in a piece of text
+
+    Uses tiktoken when it is installed and a four-characters-per-token
+    estimate otherwise.
+    """
+    global _encoding
+    if not text:
+        return 0
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding('cl100k_base')
+        except Exception:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text))
+    return len(text) // 4 + 1
+
+
+def message_tokens(text):
+    """Tokens a message costs inside a chat prompt"""
+    return count_tokens(text) + MESSAGE_OVERHEAD_TOKENS
+
+
+def truncate_tokens(text, max_tokens):
+    """Cut text down to its first `max_tokens` tokens"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ''
+    if _encoding:
+        return _encoding.decode(_encoding.encode(text)[:max_tokens])
+    return text[:max(0, max_tokens - 1) * 4]
+
+
+class ContextWindow:
+    """The part of a conversation that goes into the next prompt"""
+
+    def __init__(self, history, summary, tokens, oldest_id, user_message=None, budget=None):
+        self.history = history
+        self.summary = summary
+        self.tokens = tokens
+        # Id of the oldest message in the window; older ones are summary material
+        self.oldest_id = oldest_id
+        # The new message as sent to the provider, cut to fit the budget
+        self.user_message = user_message
+        self.budget = budget
+
+
+def summary_key(conversation):
+    """Write-behind key of a conversation's summary updates"""
+    return f"summary:{conversation.id}"
+
+
+def build_context(conversation, mode, user_message):
+    """Pack the most recent turns that fit the mode's token budget
+
+    The budget covers the summary, the packed history and the new user
+    message, which is truncated if it alone would not fit, so the prompt
+    never grows past the system prompt plus budget. Unsummarised turns that
+    no longer fit are folded into the summary before the window is packed,
+    so every earlier turn reaches the prompt one way or the other.
+    """
+    context, dropped = _pack_context(conversation, mode, user_message)
+    if dropped:
+        # A queued fold may already cover them; otherwise fold them now
+        get_write_behind().wait_for(summary_key(conversation))
+        db.session.refresh(conversation)
+        context, dropped = _pack_context(conversation, mode, user_message)
+        if dropped:
+            with chat_stage('summary'):
+                update_summary(conversation, context, min_batch=1)
+            context, _ = _pack_context(conversation, mode, user_message)
+    return context
+
+
+def _pack_context(conversation, mode, user_message):
+    """The context window, plus whether unsummarised turns were left out of it"""
+    budget = context_budget(mode)
+    summary = get_cipher().decrypt(conversation.summary) if conversation.summary else None
+    remaining = budget - (message_tokens(summary) if summary else 0)
+    user_message = truncate_tokens(user_message, remaining - MESSAGE_OVERHEAD_TOKENS)
+    remaining -= message_tokens(user_message)
+
+    window = []
+    before = None
+    dropped = False
+    while not dropped:
+        page, has_more = page_messages(conversation, CONTEXT_PAGE_SIZE, before=before)
+        with chat_stage('decrypt'):
+            entries = decrypt_history(page)
+        full = False
+        for entry in reversed(entries):
+            # Anything already folded into the summary stays out of the window
+            if entry['id'] <= conversation.summary_upto:
+                full = True
+                break
+            cost = message_tokens(entry['message'])
+            if cost > remaining:
+                full = dropped = True
+                break
+            remaining -= cost
+            window.append(entry)
+        if full or not has_more:
+            break
+        before = page[0].id
+
+    window.reverse()
+    # With an empty window every stored message is older than the window
+    oldest_id = window[0]['id'] if window else conversation_version(conversation) + 1
+    return ContextWindow(window, summary, budget - remaining, oldest_id, user_message, budget), dropped
+
+
+def summarize(summary, entries):
+    """Fold messages into a running summary, capped at the configured size"""
+    max_tokens = current_app.config['CONTEXT_SUMMARY_MAX_TOKENS']
+    transcript = '\n'.join(
+        f"{'User' if entry['role'] == 'user' else 'Neurochat'}: {entry['message']}" for entry in entries)
+
+    provider = get_provider()
+    if provider is not None:
+        try:
+            return provider.complete([
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": f"Existing summary:\n{summary or '(none)'}\n\nNew messages:\n{transcript}"}
+            ], mode='summary', model=current_app.config['CONTEXT_SUMMARY_MODEL'], max_tokens=max_tokens, temperature=0.3)
+        except Exception as e:
+            logger.warning("summary generation failed, keeping an excerpt error=%r", e)
+
+    # Without a provider keep the newest lines that fit
+    lines = ([summary] if summary else []) + transcript.split('\n')
+    kept = []
+    used = 0
+    for line in reversed(lines):
+        used += count_tokens(line)
+        if used > max_tokens:
+            break
+        kept.append(line)
+    return '\n'.join(reversed(kept))
+
+
+def update_summary(conversation, context, fold_ahead=False, min_batch=None):
+    """Fold messages that fell out of the window into the stored summary
+
+    Runs only once min_batch (CONTEXT_SUMMARY_BATCH) messages have dropped
+    out, so most turns cost nothing and the summary is never rebuilt from
+    scratch. With fold_ahead the oldest batch is folded even if some of it
+    is still in the window, because the next turn would push it out.
+    """
+    batch = current_app.config['CONTEXT_SUMMARY_BATCH']
+    unsummarized = Message.query.filter(
+        Message.conversation_id == conversation.id,
+        Message.id > conversation.summary_upto
+    )
+    dropped = unsummarized.filter(Message.id < context.oldest_id)
+    dropped_count = dropped.count()
+    if fold_ahead:
+        pending_rows = unsummarized.order_by(Message.id).limit(max(batch, dropped_count)).all()
+    elif dropped_count >= (min_batch or batch):
+        pending_rows = dropped.order_by(Message.id).all()
+    else:
+        return False
+    if not pending_rows:
+        return False
+
+    pending = decrypt_history(pending_rows)
+    conversation.summary = get_cipher().encrypt(summarize(context.summary, pending))
+    conversation.summary_upto = pending[-1]['id']
+    db.session.commit()
+    return True
+
+
+def queue_summary_update(conversation, context, reply):
+    """Run update_summary after the response is sent
+
+    When the next turn will not fit beside this one, the oldest turns are
+    folded ahead of time so that turn finds them summarised. Only ids go
+    into the spool; the task reads and decrypts the stored summary itself,
+    so no plain text is written to disk. Summaries have their own key so a
+    slow one never holds up the next turn's history.
+    """
+    # Next turn: this window plus the reply plus a message about as long as this one
+    upcoming = context.tokens + message_tokens(reply) + message_tokens(context.user_message)
+    get_write_behind().submit('update_summary', {
+        'conversation_id': conversation.id,
+        'oldest_id': context.oldest_id,
+        'fold_ahead': upcoming > context.budget,
+    }, key=summary_key(conversation))
+
+
+@register_task('update_summary')
+def update_summaries(payloads):
+    """Write-behind task: fold fallen-out messages into each conversation's summary"""
+    for payload in payloads:
+        conversation = db.session.get(Conversation, payload['conversation_id'])
+        if conversation is None:
+            continue
+        summary = get_cipher().decrypt(conversation.summary) if conversation.summary else None
+        update_summary(conversation, ContextWindow(None, summary, 0, payload['oldest_id']),
+                       fold_ahead=payload.get('fold_ahead', False))
@@ -0,0 +1,156 @@
+from datetime import datetime
+from flask import session
+from flask_login import current_user
+from .models import db, Conversation, Message
+from .cipher import get_cipher
+from .search import get_search_index, token_rows
+from writebehind import register_task, get_write_behind
+
+
+def current_conversation():
+    """Return the visitor's active conversation, or None"""
+    conversation_id = session.get('conversation_id')
+    if conversation_id is None:
+        return None
+
+    conversation = db.session.get(Conversation, conversation_id)
+    if conversation is None:
+        return None
+
+    # A conversation owned by an account is only visible to that account
+    if conversation.user_id is not None and (
+            not current_user.is_authenticated or conversation.user_id != current_user.id):
+        return None
+    return conversation
+
+
+def start_conversation(mode=None):
+    """Create a new conversation and make it the visitor's active one"""
+    user_id = current_user.id if current_user.is_authenticated else None
+    conversation = Conversation(user_id=user_id, mode=mode)
+    db.session.add(conversation)
+    db.session.commit()
+    session['conversation_id'] = conversation.id
+    return conversation
+
+
+def get_or_start_conversation(mode=None):
+    """Return the active conversation, creating one if there is none"""
+    return current_conversation() or start_conversation(mode)
+
+
+def add_messages(conversation, entries):
+    """Store (role, body, encrypted) tuples in a conversation in one commit"""
+    messages = [Message(conversation_id=conversation.id, role=role, body=body, encrypted=encrypted)
+                for role, body, encrypted in entries]
+    db.session.add_all(messages)
+    if conversation.user_id is not None and any(not msg.encrypted for msg in messages):
+        # Plain-text system messages can be indexed straight away
+        db.session.flush()
+        index = get_search_index()
+        for msg in messages:
+            if not msg.encrypted:
+                db.session.add_all(token_rows(msg.id, conversation.user_id, index.tokens(msg.body)))
+    db.session.commit()
+    return messages
+
+
+def conversation_key(conversation):
+    """Write-behind key that keeps a conversation's writes in order"""
+    return f"conversation:{conversation.id}"
+
+
+def queue_messages(conversation, entries, texts=None):
+    """Store already-encrypted (role, body, encrypted) tuples after the response is sent
+
+    The spooled job keeps the time of the turn, so stored timestamps don't
+    depend on when the background thread gets to it. `texts` are the plain
+    bodies; for an account's conversation their search tokens are spooled
+    with the messages, the plain text itself never is.
+    """
+    created_at = datetime.utcnow().isoformat()
+    payload = {
+        'conversation_id': conversation.id,
+        'created_at': created_at,
+        'messages': [list(entry) for entry in entries],
+    }
+    if texts is not None and conversation.user_id is not None:
+        index = get_search_index()
+        payload['user_id'] = conversation.user_id
+        payload['tokens'] = [index.tokens(text) for text in texts]
+    get_write_behind().submit('store_messages', payload, key=conversation_key(conversation))
+
+
+@register_task('store_messages')
+def store_messages(payloads):
+    """Write-behind task: insert every spooled message of a batch, and its search tokens, in one commit"""
+    indexed = []
+    for payload in payloads:
+        created_at = datetime.fromisoformat(payload['created_at'])
+        messages = [Message(conversation_id=payload['conversation_id'], role=role, body=body,
+                            encrypted=encrypted, created_at=created_at)
+                    for role, body, encrypted in payload['messages']]
+        db.session.add_all(messages)
+        if payload.get('tokens'):
+            indexed.extend((message, payload['user_id'], tokens)
+                           for message, tokens in zip(messages, payload['tokens']))
+    if indexed:
+        # Token rows need the message ids
+        db.session.flush()
+        for message, user_id, tokens in indexed:
+            db.session.add_all(token_rows(message.id, user_id, tokens))
+    db.session.commit()
+
+
+def settle(conversation):
+    """Wait for this conversation's queued writes before reading its history"""
+    if conversation is not None:
+        get_write_behind().wait_for(conversation_key(conversation))
+
+
+def recent_messages(conversation, limit=None):
+    """Return a conversation's messages oldest first, optionally only the last `limit`"""
+    query = Message.query.filter_by(conversation_id=conversation.id)
+    if limit is None:
+        return query.order_by(Message.created_at, Message.id).all()
+    if not limit:
+        return []
+    latest = query.order_by(Message.created_at.desc(), Message.id.desc()).limit(limit).all()
+    return latest[::-1]
+
+
+def conversation_version(conversation):
+    """Return the id of the newest message, which changes whenever history does"""
+    latest = db.session.query(db.func.max(Message.id)).filter_by(conversation_id=conversation.id).scalar()
+    return latest or 0
+
+
+def page_messages(conversation, limit, before=None, after=None):
+    """Return up to `limit` messages oldest first, plus whether more lie beyond them
+
+    Without a cursor the newest page is returned. `before` pages back through
+    older messages; `after` returns what was added since a message id.
+    """
+    query = Message.query.filter_by(conversation_id=conversation.id)
+    if after is not None:
+        page = query.filter(Message.id > after).order_by(Message.id).limit(limit + 1).all()
+        return page[:limit], len(page) > limit
+
+    if before is not None:
+        query = query.filter(Message.id < before)
+    page = query.order_by(Message.id.desc()).limit(limit + 1).all()
+    return page[:limit][::-1], len(page) > limit
+
+
+def decrypt_history(messages):
+    """Turn stored messages into display entries, decrypting them in one batch"""
+    # Legacy and system entries are stored as plain text
+    encrypted = [msg.body for msg in messages if msg.encrypted]
+    decrypted = iter(get_cipher().decrypt_many(encrypted))
+
+    return [{
+        'id': msg.id,
+        'role': msg.role,
+        'message': next(decrypted) if msg.encrypted else msg.body,
+        'timestamp': msg.created_at.isoformat()
+    } for msg in messages]
@@ -0,0 +1,158 @@
+"""
+Streaming NDJSON export of a user's conversations
+
+Conversations and their messages are read in keyset batches of
+EXPORT_BATCH_SIZE rows, decrypted a batch at a time and written out as one
+JSON object per line, so memory stays flat however large the archive is.
+Every record carries a `cursor`; passing the last one received resumes the
+export right after it. A final {"type": "end"} record marks a complete file.
+"""
+import gzip
+import json
+import logging
+import click
+from datetime import datetime
+from .models import db, User, Conversation, Message
+from .cipher import get_cipher
+
+logger = logging.getLogger(__name__)
+
+EXPORT_BATCH_SIZE = 500
+
+
+def parse_cursor(cursor):
+    """Turn a '<conversation id>:<message id>' cursor into a tuple; None starts over"""
+    if not cursor:
+        return None
+    try:
+        conversation_id, message_id = (int(part) for part in cursor.split(':'))
+    except ValueError:
+        raise ValueError(f"Invalid export cursor {cursor!r}")
+    return conversation_id, message_id
+
+
+def format_cursor(conversation_id, message_id):
+    return f"{conversation_id}:{message_id}"
+
+
+def _conversation_batches(user_id, after_id, batch_size):
+    while True:
+        batch = (db.session.query(Conversation.id, Conversation.mode, Conversation.created_at)
+                 .filter(Conversation.user_id == user_id, Conversation.id > after_id)
+                 .order_by(Conversation.id).limit(batch_size).all())
+        if not batch:
+            return
+        yield batch
+        after_id = batch[-1].id
+
+
+def _message_batches(conversation_id, after_id, batch_size):
+    # Plain column rows instead of ORM objects keep the session's identity map empty
+    while True:
+        batch = (db.session.query(Message.id, Message.role, Message.body, Message.encrypted, Message.created_at)
+                 .filter(Message.conversation_id == conversation_id, Message.id > after_id)
+                 .order_by(Message.id).limit(batch_size).all())
+        if not batch:
+            return
+        yield batch
+        after_id = batch[-1].id
+
+
+def _dumps(record):
+    return json.dumps(record, ensure_ascii=False) + '\n'
+
+
+def iter_export(user_id, cursor=None, batch_size=EXPORT_BATCH_SIZE):
+    """Yield the user's archive as NDJSON text, one chunk per batch of records
+
+    Raises ValueError for a malformed cursor, or one pointing into a
+    conversation the user does not own, before anything is yielded.
+    """
+    position = parse_cursor(cursor)
+    if position is not None and position[0] and Conversation.query.filter_by(
+            id=position[0], user_id=user_id).first() is None:
+        raise ValueError(f"Export cursor {cursor!r} does not belong to this account")
+    cipher = get_cipher()
+
+    def generate():
+        conversations = messages = 0
+        if position is None:
+            yield _dumps({'type': 'export', 'user_id': user_id, 'version': 1,
+                          'exported_at': datetime.utcnow().isoformat(), 'cursor': format_cursor(0, 0)})
+            resume_id, resume_after = 0, 0
+        else:
+            resume_id, resume_after = position
+
+        if resume_id:
+            # Finish the conversation the previous export stopped in; its header was already sent
+            for batch in _message_batches(resume_id, resume_after, batch_size):
+                messages += len(batch)
+                yield _message_chunk(cipher, resume_id, batch)
+
+        for batch in _conversation_batches(user_id, resume_id, batch_size):
+            for conversation in batch:
+                conversations += 1
+                yield _dumps({
+                    'type': 'conversation',
+                    'id': conversation.id,
+                    'mode': conversation.mode,
+                    'created_at': conversation.created_at.isoformat(),
+                    'cursor': format_cursor(conversation.id, 0),
+                })
+                for message_batch in _message_batches(conversation.id, 0, batch_size):
+                    messages += len(message_batch)
+                    yield _message_chunk(cipher, conversation.id, message_batch)
+
+        yield _dumps({'type': 'end', 'conversations': conversations, 'messages': messages})
+        logger.info("export finished user_id=%s conversations=%d messages=%d resumed=%s",
+                    user_id, conversations, messages, position is not None)
+
+    return generate()
+
+
+def _message_chunk(cipher, conversation_id, batch):
+    decrypted = iter(cipher.decrypt_many([row.body for row in batch if row.encrypted]))
+    return ''.join(_dumps({
+        'type': 'message',
+        'conversation_id': conversation_id,
+        'id': row.id,
+        'role': row.role,
+        'message': next(decrypted) if row.encrypted else row.body,
+        'timestamp': row.created_at.isoformat(),
+        'cursor': format_cursor(conversation_id, row.id),
+    }) for row in batch)
+
+
+def init_export(app):
+    """Register the export-conversations CLI command"""
+
+    @app.cli.command('export-conversations')
+    @click.argument('user')
+    @click.option('--output', '-o', type=click.Path(dir_okay=False), required=True,
+                  help='File to write; a .gz name is gzip-compressed')
+    @click.option('--cursor', default=None, help='Resume after this cursor, appending to the output')
+    @click.option('--batch-size', default=None, type=int, help='Rows decrypted per batch')
+    def export_conversations_command(user, output, cursor, batch_size):
+        """Export USER's (id or email) conversations as NDJSON"""
+        found = db.session.get(User, int(user)) if user.isdigit() else User.query.filter_by(email=user).first()
+        if found is None:
+            raise click.ClickException(f"No user {user!r}")
+        try:
+            chunks = iter_export(found.id, cursor, batch_size or app.config.get('EXPORT_BATCH_SIZE', EXPORT_BATCH_SIZE))
+        except ValueError as e:
+            raise click.ClickException(str(e))
+
+        # Appending to a .gz file adds a gzip member, which readers treat as one stream
+        mode = 'at' if cursor else 'wt'
+        opener = gzip.open if output.endswith('.gz') else open
+        last_cursor = cursor
+        with opener(output, mode, encoding='utf-8') as f:
+            try:
+                for chunk in chunks:
+                    f.write(chunk)
+                    last_cursor = json.loads(chunk[chunk.rstrip('\n').rfind('\n') + 1:]).get('cursor', last_cursor)
+            except BaseException:
+                if last_cursor:
+                    click.echo(f"Export interrupted; resume with --cursor {last_cursor}", err=True)
+                raise
+        click.echo(f"Exported conversations of user {found.id} to {output}")
@@ -0,0 +1,92 @@
+import heapq
+import threading
+import time
+from flask import current_app
+
+
+class GuestEntry:
+    """One guest session; `expired` is set by the registry's timer when time runs out"""
+
+    def __init__(self, guest_id, expires_at):
+        self.guest_id = guest_id
+        self.expires_at = expires_at
+        self.expired = threading.Event()
+
+
+class GuestRegistry:
+    """Per-process schedule of guest session expiries
+
+    The signed session cookie stays the source of truth, so any worker can
+    register a guest from it. Expiries sit in a heap served by one timer
+    thread, which wakes only for the next expiry. Waiters block on their
+    entry's event instead of polling.
+    """
+
+    def __init__(self, ttl=900):
+        self.ttl = ttl
+        self._guests = {}
+        self._heap = []
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def register(self, guest_id, started_at):
+        """Return the entry for a guest session that started at `started_at`"""
+        expires_at = started_at + self.ttl
+        with self._cond:
+            entry = self._guests.get(guest_id)
+            if entry is not None and entry.expires_at == expires_at:
+                return entry
+
+            entry = GuestEntry(guest_id, expires_at)
+            if expires_at <= time.time():
+                # Already over; nothing to schedule or keep
+                entry.expired.set()
+                return entry
+
+            self._guests[guest_id] = entry
+            heapq.heappush(self._heap, (expires_at, guest_id))
+            self._ensure_timer()
+            if self._heap[0][1] == guest_id:
+                # New earliest expiry: wake the timer to sleep less
+                self._cond.notify()
+            return entry
+
+    def _ensure_timer(self):
+        # Started lazily so forked workers each run their own
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='guest-expiry', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        with self._cond:
+            while True:
+                now = time.time()
+                while self._heap and self._heap[0][0] <= now:
+                    expires_at, guest_id = heapq.heappop(self._heap)
+                    entry = self._guests.get(guest_id)
+                    # Skip heap entries left behind by a re-registration
+                    if entry is not None and entry.expires_at == expires_at:
+                        del self._guests[guest_id]
+                        entry.expired.set()
+                self._cond.wait(self._heap[0][0] - now if self._heap else None)
+
+    def __len__(self):
+        with self._cond:
+            return len(self._guests)
+
+
+def guest_expiration_message(ttl):
+    return (f"⏰ Your {max(1, round(ttl / 60))}-minute guest session has expired. "
+            "Please create a free account to continue chatting with Neurochat!")
+
+
+def init_guest_registry(app):
+    """Build the process-wide guest registry"""
+    registry = GuestRegistry(ttl=app.config.get('GUEST_SESSION_TTL', 900))
+    app.extensions['guest_registry'] = registry
+    return registry
+
+
+def get_guest_registry():
+    """Return the guest registry of the current app"""
+    return current_app.extensions['guest_registry']
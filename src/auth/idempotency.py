@@ -0,0 +1,132 @@
+"""
+Idempotency-Key handling for chat turns
+
+Claims live in the IdempotencyRecord table, so a retry that lands on another
+worker process or host still finds the original turn. The first request for
+a key claims it and runs; duplicates poll the row until the owner stores its
+reply, then replay it. A claim whose owner died without finishing lapses
+after wait_timeout and the next duplicate takes it over. Keys, request
+fingerprints and replies are stored hashed or encrypted.
+"""
+import hashlib
+import json
+import time
+import uuid
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from .models import db, IdempotencyRecord
+from .cipher import get_cipher
+
+records = IdempotencyRecord.__table__
+
+
+class IdempotencyConflict(Exception):
+    """Raised when an idempotency key is reused for a different request"""
+
+
+class _Entry:
+    def __init__(self, key, owner):
+        self.key = key
+        self.owner = owner
+        self.finished = False
+
+
+def _digest(*parts):
+    return hashlib.sha256('\0'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+class IdempotencyStore:
+    """Coalesces duplicate requests onto one execution and replays its result
+
+    The first request for a key runs; duplicates that arrive while it is in
+    flight wait for it, and duplicates that arrive afterwards get the stored
+    result until the TTL runs out. Needs an app context.
+    """
+
+    def __init__(self, ttl=300, wait_timeout=120, poll_interval=0.1, purge_interval=60):
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.purge_interval = purge_interval
+        self._last_purge = 0.0
+
+    def _purge(self, conn, now):
+        if now - self._last_purge >= self.purge_interval:
+            self._last_purge = now
+            conn.execute(records.delete().where(records.c.expires_at <= now))
+
+    def begin(self, key, fingerprint):
+        """Claim a key; returns (entry, True) for the owner or (entry, False) for a duplicate"""
+        key, fingerprint = _digest(key), _digest(*fingerprint)
+        owner = uuid.uuid4().hex
+        # Separate transactions, so the request's own session is left alone
+        while True:
+            now = time.time()
+            try:
+                with db.engine.begin() as conn:
+                    self._purge(conn, now)
+                    conn.execute(records.insert().values(
+                        key=key, fingerprint=fingerprint, owner=owner, expires_at=now + self.wait_timeout))
+                return _Entry(key, owner), True
+            except IntegrityError:
+                pass
+
+            with db.engine.begin() as conn:
+                row = conn.execute(records.select().where(records.c.key == key)).first()
+                if row is None:
+                    # Failed and removed since the insert; claim it again
+                    continue
+                if row.expires_at <= now:
+                    # Finished long ago, or its owner died: take it over
+                    taken = conn.execute(records.update()
+                                         .where(records.c.key == key, records.c.owner == row.owner)
+                                         .values(fingerprint=fingerprint, owner=owner, result=None,
+                                                 expires_at=now + self.wait_timeout))
+                    if taken.rowcount:
+                        return _Entry(key, owner), True
+                    continue
+                if row.fingerprint != fingerprint:
+                    raise IdempotencyConflict(key)
+                return _Entry(key, row.owner), False
+
+    def finish(self, key, entry, result):
+        """Store the owner's result for duplicates to replay"""
+        entry.finished = True
+        with db.engine.begin() as conn:
+            conn.execute(records.update()
+                         .where(records.c.key == entry.key, records.c.owner == entry.owner)
+                         .values(result=get_cipher().encrypt(json.dumps(result)),
+                                 expires_at=time.time() + self.ttl))
+
+    def fail(self, key, entry):
+        """Drop an unfinished execution so a retry runs again"""
+        if entry.finished:
+            return
+        entry.finished = True
+        with db.engine.begin() as conn:
+            conn.execute(records.delete().where(records.c.key == entry.key, records.c.owner == entry.owner))
+
+    def wait(self, entry):
+        """Wait for the owner of an entry; returns its result or None if it failed"""
+        deadline = time.monotonic() + self.wait_timeout
+        while time.monotonic() < deadline:
+            with db.engine.connect() as conn:
+                row = conn.execute(records.select().where(records.c.key == entry.key)).first()
+            if row is None or row.owner != entry.owner:
+                return None
+            if row.result is not None:
+                return json.loads(get_cipher().decrypt(row.result))
+            time.sleep(self.poll_interval)
+        return None
+
+
+def init_idempotency(app):
+    """Build the idempotency store"""
+    store = IdempotencyStore(ttl=app.config.get('IDEMPOTENCY_TTL', 300))
+    app.extensions['idempotency'] = store
+    return store
+
+
+def get_idempotency_store():
+    """Return the idempotency store of the current app"""
+    return current_app.extensions['idempotency']
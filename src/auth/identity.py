@@ -0,0 +1,83 @@
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, has_app_context
+from flask_login import UserMixin
+from sqlalchemy import event
+from .models import db, User
+from metrics import USER_CACHE_LOOKUPS
+
+
+class CachedUser(UserMixin):
+    """The fields of a User that requests need, detached from any DB session"""
+
+    def __init__(self, id, first_name, email):
+        self.id = id
+        self.first_name = first_name
+        self.email = email
+
+
+class UserCache:
+    """Per-process LRU of logged-in users with a TTL
+
+    Saves the user_loader query on every authenticated request. Rows changed
+    through this process are dropped at once; changes made by other workers
+    show up when the TTL runs out.
+    """
+
+    def __init__(self, ttl=60, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._entries.get(user_id)
+            if cached is not None and cached[1] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                USER_CACHE_LOOKUPS.inc(result='hit')
+                return cached[0]
+            self.misses += 1
+        USER_CACHE_LOOKUPS.inc(result='miss')
+
+        user = db.session.get(User, user_id)
+        if user is None:
+            self.invalidate(user_id)
+            return None
+
+        cached_user = CachedUser(user.id, user.first_name, user.email)
+        with self._lock:
+            self._entries[user_id] = (cached_user, now + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return cached_user
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _invalidate_changed_user(mapper, connection, target):
+    if has_app_context() and 'user_cache' in current_app.extensions:
+        current_app.extensions['user_cache'].invalidate(target.id)
+
+
+def init_user_cache(app):
+    """Build the process-wide user cache"""
+    cache = UserCache(ttl=app.config.get('USER_CACHE_TTL', 60),
+                      max_entries=app.config.get('USER_CACHE_SIZE', 10000))
+    app.extensions['user_cache'] = cache
+    return cache
+
+
+def get_user_cache():
+    """Return the user cache of the current app"""
+    return current_app.extensions['user_cache']
@@ -1,3 +1,4 @@
+from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 
@@ -17,3 +18,58 @@ class User(UserMixin, db.Model):
     def check_password(self, password, bcrypt_instance):
         """Checks the password against the stored hash."""
         return bcrypt_instance.check_password_hash(self.password_hash, password)
+
+
+# Conversation model
+class Conversation(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    # Guest conversations have no owner
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True, index=True)
+    mode = db.Column(db.String(20), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # Encrypted rolling summary of every message up to summary_upto
+    summary = db.Column(db.Text, nullable=True)
+    summary_upto = db.Column(db.Integer, nullable=False, default=0)
+
+    messages = db.relationship('Message', backref='conversation', lazy='dynamic',
+                               cascade='all, delete-orphan')
+
+
+# Message model
+class Message(db.Model):
+    __table_args__ = (
+        db.Index('ix_message_conversation_created', 'conversation_id', 'created_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id'), nullable=False)
+    role = db.Column(db.String(10), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    encrypted = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    search_tokens = db.relationship('MessageToken', lazy='dynamic', cascade='all, delete-orphan')
+
+
+# Blind-index search token: keyed HMAC of one word of a message
+class MessageToken(db.Model):
+    __table_args__ = (
+        db.Index('ix_message_token_user_token', 'user_id', 'token'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    message_id = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    token = db.Column(db.String(32), nullable=False)
+
+
+# Claimed Idempotency-Key of a chat turn and, once it finished, its encrypted reply
+class IdempotencyRecord(db.Model):
+    # SHA-256 of the conversation-scoped key
+    key = db.Column(db.String(64), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    # Random id of the request that claimed the key
+    owner = db.Column(db.String(32), nullable=False)
+    result = db.Column(db.Text, nullable=True)
+    # Unix time the claim lapses, or the reply stops being replayed
+    expires_at = db.Column(db.Float, nullable=False, index=True)
@@ -0,0 +1,117 @@
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from flask import current_app
+from metrics import PASSWORD_QUEUE_DEPTH
+from pwhash import hash_password, check_password
+
+logger = logging.getLogger(__name__)
+
+
+class PasswordPoolBusy(Exception):
+    """Raised when the password pool has too much queued work or falls behind"""
+
+
+def _as_bytes(value):
+    return value.encode('utf-8') if isinstance(value, str) else value
+
+
+class PasswordHasher:
+    """bcrypt on a bounded process pool, so hashing never blocks request threads
+
+    Exposes the same generate_password_hash/check_password_hash calls as
+    Flask-Bcrypt. With workers=0 the work runs inline in the caller, at most
+    max_queue operations at a time.
+    """
+
+    def __init__(self, rounds=12, workers=2, max_queue=32, timeout=10.0):
+        self.rounds = rounds
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.pending = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # Created on first use so each forked server worker gets its own pool
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def _run(self, func, *args):
+        with self._lock:
+            if self.pending >= self.max_queue:
+                raise PasswordPoolBusy("queue full")
+            self.pending += 1
+        PASSWORD_QUEUE_DEPTH.inc()
+        if not self.workers:
+            # Inline work is bounded by the same limit as the pool's queue
+            try:
+                return func(*args)
+            finally:
+                self._job_done(None)
+
+        try:
+            future = self._get_executor().submit(func, *args)
+        except BaseException:
+            self._job_done(None)
+            raise
+        # A job that outlives our wait still occupies the pool, so it stays counted until it ends
+        future.add_done_callback(self._job_done)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            raise PasswordPoolBusy("timed out")
+        except BrokenProcessPool:
+            # A crashed worker poisons the pool; start a fresh one next time
+            logger.error("password pool broke, restarting")
+            with self._lock:
+                self._executor = None
+            raise
+
+    def _job_done(self, future):
+        PASSWORD_QUEUE_DEPTH.dec()
+        with self._lock:
+            self.pending -= 1
+
+    def generate_password_hash(self, password, rounds=None):
+        """Hash a password with the configured cost"""
+        return self._run(hash_password, _as_bytes(password), rounds or self.rounds)
+
+    def check_password_hash(self, pw_hash, password):
+        """Check a password against a stored hash"""
+        return self._run(check_password, _as_bytes(pw_hash), _as_bytes(password))
+
+    def needs_rehash(self, pw_hash):
+        """Whether a stored hash was made with a different cost than the configured one"""
+        try:
+            return int(pw_hash.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+
+def init_password_hasher(app):
+    """Build the process-wide password hasher
+
+    PASSWORD_WORKERS is a total for the host, split evenly between the
+    gunicorn workers, each of which gets at least one. Setting it to 0 hashes
+    inline on the request threads instead.
+    """
+    total = app.config.get('PASSWORD_WORKERS', 2)
+    workers = max(1, total // max(1, app.config.get('WEB_CONCURRENCY', 1))) if total > 0 else 0
+    hasher = PasswordHasher(rounds=app.config.get('BCRYPT_LOG_ROUNDS', 12),
+                            workers=workers,
+                            max_queue=app.config.get('PASSWORD_QUEUE_LIMIT', 32),
+                            timeout=app.config.get('PASSWORD_TIMEOUT', 10.0))
+    app.extensions['password_hasher'] = hasher
+    return hasher
+
+
+def get_password_hasher():
+    """Return the password hasher of the current app"""
+    return current_app.extensions['password_hasher']
@@ -0,0 +1,152 @@
+"""
+Chat personas: system prompt, model and sampling parameters per mode
+
+Each mode is one Persona in PERSONAS; register_persona() adds more without
+touching the routes. Prompts are assembled in a fixed order (persona,
+summary, history, new message) so the persona is a byte-identical prefix on
+every turn of every conversation, which is what provider-side prompt
+caching matches on. Token counts of the static parts are computed once per
+process.
+"""
+from flask import current_app
+
+
+class Persona:
+    """How Neurochat behaves in one chat mode"""
+
+    def __init__(self, name, system_prompt, fallback, confirmation, model='gpt-3.5-turbo', max_tokens=150,
+                 temperature=0.7, frequency_penalty=0.3, presence_penalty=0.3, context_budget=1000):
+        self.name = name
+        self.system_prompt = system_prompt
+        # Reply used when the provider fails or is unavailable
+        self.fallback = fallback
+        # First message of a conversation started in this mode
+        self.confirmation = confirmation
+        self.model = model
+        # Reply length cap, also charged against the token quota up front
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.frequency_penalty = frequency_penalty
+        self.presence_penalty = presence_penalty
+        # Used when CONTEXT_TOKEN_BUDGETS has no entry for this mode
+        self.context_budget = context_budget
+        self.system_message = {"role": "system", "content": system_prompt}
+        self._prompt_tokens = None
+
+    @property
+    def prompt_tokens(self):
+        """Tokens the persona adds to every prompt, counted on first use"""
+        if self._prompt_tokens is None:
+            from .context import message_tokens
+            self._prompt_tokens = message_tokens(self.system_prompt)
+        return self._prompt_tokens
+
+    def params(self):
+        """Provider parameters for a reply in this mode"""
+        return {
+            'mode': self.name,
+            'model': self.model,
+            'max_tokens': self.max_tokens,
+            'temperature': self.temperature,
+            'frequency_penalty': self.frequency_penalty,
+            'presence_penalty': self.presence_penalty,
+        }
+
+    def build_messages(self, user_message, history, summary=None):
+        """Chat messages for one turn, static prefix first"""
+        messages = [self.system_message]
+        # Earlier turns that no longer fit the token budget, condensed
+        if summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation: {summary}"})
+        # The recent conversation history packed by the context builder
+        for msg in history:
+            if msg.get('role') == 'user':
+                messages.append({"role": "user", "content": msg.get('message', '')})
+            elif msg.get('role') == 'ai':
+                messages.append({"role": "assistant", "content": msg.get('message', '')})
+        messages.append({"role": "user", "content": user_message})
+        return messages
+
+
+LISTEN = Persona(
+    'listen',
+    system_prompt="""You are Neurochat, a warm and empathetic AI companion in 'Listen Mode' where you provide gentle validation and support while mainly listening.
+
+Your personality:
+- Warm, empathetic, and supportive
+- Focus on validating feelings and providing gentle encouragement
+- Keep responses relatively short (1-2 sentences usually)
+- Be present and understanding without trying to solve problems
+- Use a calm, caring tone
+
+Response style:
+- Acknowledge their feelings and experiences
+- Provide gentle validation and support
+- Encourage them to continue sharing
+- Be empathetic but not overly formal
+- Focus on listening rather than giving advice
+
+Remember: You're here to listen with empathy and provide gentle support, not to solve problems or give advice.""",
+    fallback="I'm here to listen and support you. Please continue sharing what's on your mind.",
+    confirmation="Perfect! I'm in listening mode now. I'm here to support you - share whatever's on your mind and I'll be here to listen and offer gentle encouragement.",
+    max_tokens=100,
+    temperature=0.7,
+    context_budget=600,
+)
+
+TALK = Persona(
+    'talk',
+    system_prompt="""You are Neurochat, a warm and empathetic AI companion in 'Response Mode' where you actively engage in conversation.
+
+Your personality:
+- Casual, friendly, and conversational (like texting a close friend)
+- Use natural language, contractions, and sometimes casual expressions
+- Be genuinely curious and engaged
+- Share relatable thoughts and observations
+- Ask follow-up questions when appropriate, but don't make every response a question
+- Keep responses relatively short (1-3 sentences usually)
+- Be empathetic but not overly formal or therapeutic
+
+Response style:
+- Use lowercase naturally when it fits the casual tone
+- Occasional casual expressions like "oh wow", "that's wild", "honestly", etc.
+- Relate to their experiences with your own observations about life
+- Be authentic and human-like, not robotic or overly positive
+- Sometimes just validate their feelings without trying to "fix" anything
+
+Remember: You're a supportive friend having a natural conversation, not a therapist or formal assistant.""",
+    fallback="I'm having some connection issues right now, but I'm still here with you. What's going on?",
+    confirmation="Awesome! I'm in talk mode now. I'm excited to chat with you and really engage in conversation. What's on your mind?",
+    max_tokens=150,
+    temperature=0.8,
+    context_budget=1200,
+)
+
+# Mode name -> Persona; register_persona() adds more
+PERSONAS = {
+    'listen': LISTEN,
+    'talk': TALK,
+}
+
+
+def register_persona(persona):
+    """Make a persona selectable as a chat mode"""
+    PERSONAS[persona.name] = persona
+
+
+def get_persona(mode):
+    """Return the persona for a chat mode, or None if there is no such mode"""
+    return PERSONAS.get(mode)
+
+
+def context_budget(mode):
+    """Prompt tokens the context builder may fill for a mode"""
+    budgets = current_app.config.get('CONTEXT_TOKEN_BUDGETS') or {}
+    return budgets.get(mode) or PERSONAS[mode].context_budget
+
+
+def init_prompts(app):
+    """Count the personas' prompt tokens now when the app is pre-warmed"""
+    if app.config.get('LLM_PREWARM'):
+        for persona in PERSONAS.values():
+            persona.prompt_tokens
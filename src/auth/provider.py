@@ -0,0 +1,190 @@
+import os
+import time
+import logging
+import threading
+from flask import current_app
+from decouple import config
+
+logger = logging.getLogger(__name__)
+
+# Stands in for a provider that has not been built yet
+_NOT_BUILT = object()
+_build_lock = threading.Lock()
+
+
+class ChatProvider:
+    """Interface for chat completion backends"""
+
+    def complete(self, messages, **params):
+        """Return the full reply text for a list of chat messages
+
+        Params may include timeout, the seconds this call is allowed to take.
+        """
+        raise NotImplementedError
+
+    def stream(self, messages, **params):
+        """Yield the reply text in deltas as the backend produces it"""
+        raise NotImplementedError
+
+    def warm(self):
+        """Open connections ahead of the first chat turn"""
+
+
+class OpenAIProvider(ChatProvider):
+    """OpenAI chat completions through one long-lived, keep-alive client"""
+
+    def __init__(self, api_key, base_url=None, timeout=30.0, max_retries=2):
+        from openai import OpenAI
+        self.client = OpenAI(api_key=api_key, base_url=base_url,
+                             timeout=timeout, max_retries=max_retries)
+
+    def _client_for(self, timeout):
+        # Under a per-call budget retries would overrun it; the resilience layer handles failures
+        return self.client if timeout is None else self.client.with_options(timeout=timeout, max_retries=0)
+
+    def complete(self, messages, timeout=None, **params):
+        response = self._client_for(timeout).chat.completions.create(messages=messages, **params)
+        return response.choices[0].message.content.strip()
+
+    def stream(self, messages, timeout=None, **params):
+        response = self._client_for(timeout).chat.completions.create(messages=messages, stream=True, **params)
+        for chunk in response:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+
+    def warm(self):
+        # Any cheap authenticated call leaves a pooled TLS connection behind
+        self.client.models.list()
+
+
+class FakeProvider(ChatProvider):
+    """Local stand-in that answers without touching the network"""
+
+    def __init__(self, reply="I hear you. Tell me more about that.", latency=0.0):
+        self.reply = reply
+        self.latency = latency
+
+    def complete(self, messages, **params):
+        time.sleep(self.latency)
+        return self.reply
+
+    def stream(self, messages, **params):
+        words = self.reply.split(' ')
+        for i, word in enumerate(words):
+            time.sleep(self.latency / len(words))
+            yield word if i == len(words) - 1 else word + ' '
+
+
+def resolve_api_key():
+    """Find the OpenAI API key in config, the environment or the project .env file"""
+    # Method 1: decouple config
+    api_key = config('OPENAI_API_KEY', default=None)
+
+    # Method 2: direct environment variable
+    if not api_key:
+        api_key = os.environ.get('OPENAI_API_KEY')
+
+    # Method 3: hand-parse the .env file in the project root, which tolerates a
+    # BOM and keys wrapped over several lines
+    if not api_key:
+        project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+        env_path = os.path.join(project_root, '.env')
+        if os.path.exists(env_path):
+            try:
+                with open(env_path, 'r') as f:
+                    lines = f.read().split('\n')
+                for i, line in enumerate(lines):
+                    if line.startswith('OPENAI_API_KEY=') or line.startswith('ï»¿OPENAI_API_KEY='):
+                        full_key = line.replace('ï»¿OPENAI_API_KEY=', '').replace('OPENAI_API_KEY=', '').strip()
+
+                        # Look for continuation in next lines (up to 5 lines)
+                        for j in range(i + 1, min(i + 5, len(lines))):
+                            next_line = lines[j].strip()
+                            if next_line and not next_line.startswith('#') and '=' not in next_line:
+                                full_key += next_line
+                            else:
+                                break
+
+                        api_key = full_key
+                        break
+            except Exception as e:
+                logger.warning("failed to read .env file path=%s error=%r", env_path, e)
+
+    if api_key:
+        # Clean the key - remove any line breaks or extra whitespace
+        api_key = api_key.strip().replace('\n', '').replace('\r', '')
+    return api_key or None
+
+
+def create_openai_provider(app):
+    api_key = resolve_api_key()
+    if not api_key:
+        logger.warning("OPENAI_API_KEY is not set - chat will use fallback replies")
+        return None
+    return OpenAIProvider(api_key,
+                          base_url=app.config.get('OPENAI_BASE_URL'),
+                          timeout=app.config.get('OPENAI_TIMEOUT', 30.0),
+                          max_retries=app.config.get('OPENAI_MAX_RETRIES', 2))
+
+
+def create_fake_provider(app):
+    return FakeProvider(latency=app.config.get('FAKE_LLM_LATENCY', 0.0))
+
+
+# Backend name -> factory taking the app; register_provider() adds more
+PROVIDERS = {
+    'openai': create_openai_provider,
+    'fake': create_fake_provider,
+}
+
+
+def register_provider(name, factory):
+    """Make a provider factory selectable through the LLM_PROVIDER setting"""
+    PROVIDERS[name] = factory
+
+
+def build_provider(app):
+    """Resolve credentials and build the chat provider, pre-warming it if configured"""
+    provider = PROVIDERS[app.config.get('LLM_PROVIDER', 'openai')](app)
+    if provider is not None:
+        from .resilience import wrap_provider
+        provider = wrap_provider(app, provider)
+    app.extensions['llm_provider'] = provider
+
+    if provider is not None and app.config.get('LLM_PREWARM'):
+        try:
+            provider.warm()
+        except Exception as e:
+            logger.warning("provider pre-warm failed error=%r", e)
+    return provider
+
+
+def init_provider(app):
+    """Register the process-wide chat provider
+
+    The provider (and the openai package) is built on first use, so creating
+    the app stays cheap; LLM_PREWARM builds and warms it right away instead.
+    Calling this again after a fork drops connections inherited from the parent.
+    """
+    backend = app.config.get('LLM_PROVIDER', 'openai')
+    if backend not in PROVIDERS:
+        raise ValueError(f"Unknown LLM_PROVIDER: {backend}")
+
+    app.extensions['llm_provider'] = _NOT_BUILT
+    if app.config.get('LLM_PREWARM'):
+        build_provider(app)
+
+
+def get_provider():
+    """Return the chat provider of the current app, or None if unconfigured"""
+    provider = current_app.extensions.get('llm_provider')
+    if provider is _NOT_BUILT:
+        app = current_app._get_current_object()
+        with _build_lock:
+            provider = app.extensions['llm_provider']
+            if provider is _NOT_BUILT:
+                provider = build_provider(app)
+    return provider
@@ -0,0 +1,211 @@
+"""
+Latency budgets, a circuit breaker and hedged requests around the chat provider
+
+Every call gets the budget of its mode (LLM_TIMEOUTS) and no SDK retries, so
+a slow provider costs a request thread at most that long. After
+LLM_BREAKER_FAILURES errors or timeouts in a row the circuit opens and calls
+fail straight away, which sends the routes to their fallback replies, until
+a probe call succeeds LLM_BREAKER_RESET seconds later. With LLM_HEDGE on, a
+completion still running past the mode's recent latency percentile gets a
+second request (on LLM_HEDGE_MODEL if set) and the first reply wins.
+"""
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from metrics import PROVIDER_CIRCUIT_STATE, PROVIDER_SHORT_CIRCUITS, PROVIDER_HEDGES
+
+logger = logging.getLogger(__name__)
+
+# Completions per mode whose latency feeds the hedge delay
+LATENCY_WINDOW = 200
+# Fewer samples than this and there is no percentile to hedge on yet
+MIN_HEDGE_SAMPLES = 20
+
+CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling a provider that keeps failing"""
+
+
+class ProviderTimeout(Exception):
+    """Raised when no reply arrived within the call's latency budget"""
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker with a single probe after the reset timeout"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probe_until = 0.0
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        if state != self.state:
+            logger.warning("provider circuit %s -> %s failures=%d", self.state, state, self.failures)
+            self.state = state
+            PROVIDER_CIRCUIT_STATE.set(STATE_VALUES[state])
+
+    def allow(self):
+        """Whether a call may go to the provider now"""
+        if not self.failure_threshold:
+            return True
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = time.monotonic()
+            if self.state == OPEN and now - self._opened_at >= self.reset_timeout:
+                self._set_state(HALF_OPEN)
+            # One probe at a time; one that never reports back expires
+            if self.state == HALF_OPEN and now >= self._probe_until:
+                self._probe_until = now + self.reset_timeout
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self._set_state(CLOSED)
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failure_threshold and (self.state == HALF_OPEN or self.failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+
+class ResilientProvider:
+    """Wraps a ChatProvider with per-mode budgets, the breaker and hedging
+
+    Callers pass mode= with each call; it picks the budget and is not sent on.
+    """
+
+    def __init__(self, inner, budgets, default_budget=30.0, breaker=None,
+                 hedge=False, hedge_percentile=95, hedge_model=None, hedge_workers=16):
+        self.inner = inner
+        self.budgets = budgets
+        self.default_budget = default_budget
+        self.breaker = breaker or CircuitBreaker()
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_model = hedge_model
+        self.hedge_workers = hedge_workers
+        self._latencies = collections.defaultdict(lambda: collections.deque(maxlen=LATENCY_WINDOW))
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def budget(self, mode):
+        return self.budgets.get(mode) or self.default_budget
+
+    def hedge_delay(self, mode):
+        """Latency percentile of recent completions in this mode, or None"""
+        with self._lock:
+            samples = sorted(self._latencies[mode])
+        if len(samples) < MIN_HEDGE_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * self.hedge_percentile / 100))]
+
+    def _check(self, mode):
+        if not self.breaker.allow():
+            PROVIDER_SHORT_CIRCUITS.inc(mode=mode or '')
+            raise CircuitOpen("provider circuit is open")
+
+    def complete(self, messages, mode=None, **params):
+        self._check(mode)
+        budget = self.budget(mode)
+        started = time.monotonic()
+        try:
+            delay = self.hedge_delay(mode) if self.hedge else None
+            if delay is None or delay >= budget:
+                reply = self.inner.complete(messages, timeout=budget, **params)
+            else:
+                reply = self._hedged(messages, params, budget, delay)
+        except Exception:
+            self.breaker.failure()
+            raise
+        elapsed = time.monotonic() - started
+        self.breaker.success()
+        with self._lock:
+            self._latencies[mode].append(elapsed)
+        return reply
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.hedge_workers, thread_name_prefix='llm-hedge')
+            return self._executor
+
+    def _hedged(self, messages, params, budget, delay):
+        executor = self._get_executor()
+        deadline = time.monotonic() + budget
+        primary = executor.submit(self.inner.complete, messages, timeout=budget, **params)
+        pending = {primary}
+        if not wait(pending, timeout=delay).done:
+            hedge_params = dict(params, model=self.hedge_model) if self.hedge_model else params
+            pending.add(executor.submit(self.inner.complete, messages,
+                                        timeout=max(0.1, deadline - time.monotonic()), **hedge_params))
+            PROVIDER_HEDGES.inc(outcome='fired')
+
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                raise ProviderTimeout(f"no reply within {budget}s")
+            for future in done:
+                if future.exception() is None:
+                    # The slower request finishes on its own and is dropped
+                    if future is not primary:
+                        PROVIDER_HEDGES.inc(outcome='won')
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def stream(self, messages, mode=None, **params):
+        """Stream deltas; the budget bounds each wait, including the first token
+
+        The breaker is checked before the stream is returned, so a rejection
+        raises CircuitOpen here rather than as a failure mid-iteration.
+        Streams are not hedged: the first delta is already sent to the client.
+        """
+        self._check(mode)
+        return self._stream(messages, mode, params)
+
+    def _stream(self, messages, mode, params):
+        reported = False
+        try:
+            for delta in self.inner.stream(messages, timeout=self.budget(mode), **params):
+                if not reported:
+                    reported = True
+                    self.breaker.success()
+                yield delta
+        except Exception:
+            if not reported:
+                self.breaker.failure()
+            raise
+
+    def warm(self):
+        self.inner.warm()
+
+
+def wrap_provider(app, provider):
+    """Put the configured resilience layer around a built provider"""
+    return ResilientProvider(
+        provider,
+        budgets=app.config.get('LLM_TIMEOUTS', {}),
+        default_budget=app.config.get('OPENAI_TIMEOUT', 30.0),
+        breaker=CircuitBreaker(failure_threshold=app.config.get('LLM_BREAKER_FAILURES', 5),
+                               reset_timeout=app.config.get('LLM_BREAKER_RESET', 30.0)),
+        hedge=app.config.get('LLM_HEDGE', False),
+        hedge_percentile=app.config.get('LLM_HEDGE_PERCENTILE', 95),
+        hedge_model=app.config.get('LLM_HEDGE_MODEL'),
+        # A hedged call holds two threads, and every request thread may be making one
+        hedge_workers=2 * app.config.get('GUNICORN_THREADS', 32),
+    )
@@ -1,89 +1,42 @@
-import os
-from flask import request, jsonify, render_template, session, current_app
+import json
+from flask import request, jsonify, render_template, session, current_app, stream_with_context
 from flask_login import login_user, logout_user, login_required, current_user
 from .models import db, User
+from .provider import get_provider
+from .cipher import get_cipher
+from .passwords import get_password_hasher, PasswordPoolBusy
+from .idempotency import get_idempotency_store, IdempotencyConflict
+from .admission import get_admission, AdmissionRejected
+from .resilience import CircuitOpen
+from .prompts import get_persona, PERSONAS
+from .guests import get_guest_registry, guest_expiration_message
+from .context import build_context, queue_summary_update
+from .search import search_messages
+from .export import iter_export, EXPORT_BATCH_SIZE
+from .conversations import current_conversation, start_conversation, get_or_start_conversation, add_messages, queue_messages, settle, recent_messages, conversation_version, page_messages, decrypt_history
 from . import auth
-import openai
-from decouple import config
+from compression import Compressor, compress_stream
+from metrics import chat_stage, CHAT_STAGE_LATENCY, PASSWORD_LATENCY, PROVIDER_ERRORS
 import time
-from datetime import datetime, timedelta
-from cryptography.fernet import Fernet
-import base64
-
-# Encryption setup
-def get_encryption_key():
-    """Get or generate encryption key for message encryption"""
-    key = config('ENCRYPTION_KEY', default=None)
-    if not key:
-        # Generate a new key if none exists
-        raw_key = Fernet.generate_key()
-        # Remove base64 padding for cleaner storage
-        clean_key = raw_key.decode().rstrip('=')
-        print(f"Generated new encryption key: {clean_key}")
-        print("IMPORTANT: Save this key to your .env file as ENCRYPTION_KEY")
-        return raw_key  # Return the original bytes for Fernet
-    else:
-        # Convert string key back to bytes, adding padding if needed
-        if len(key) % 4 != 0:
-            key += '=' * (4 - len(key) % 4)
-        try:
-            return base64.b64decode(key)
-        except Exception as e:
-            print(f"Invalid encryption key format: {e}")
-            # Generate a new key if the provided one is invalid
-            raw_key = Fernet.generate_key()
-            clean_key = raw_key.decode().rstrip('=')
-            print(f"Generated new encryption key: {clean_key}")
-            print("IMPORTANT: Save this key to your .env file as ENCRYPTION_KEY")
-            return raw_key
+import logging
+
+logger = logging.getLogger(__name__)
 
 def encrypt_message(message):
     """Encrypt a message using Fernet symmetric encryption"""
-    try:
-        key = get_encryption_key()
-        f = Fernet(key)
-        encrypted_message = f.encrypt(message.encode())
-        return base64.b64encode(encrypted_message).decode()
-    except Exception as e:
-        print(f"Encryption error: {e}")
-        return message  # Fallback to plain text if encryption fails
+    return get_cipher().encrypt(message)
 
 def decrypt_message(encrypted_message):
     """Decrypt an encrypted message"""
-    try:
-        key = get_encryption_key()
-        f = Fernet(key)
-        # Decode from base64 first
-        encrypted_bytes = base64.b64decode(encrypted_message.encode())
-        decrypted_message = f.decrypt(encrypted_bytes)
-        return decrypted_message.decode()
-    except Exception as e:
-        print(f"Decryption error: {e}")
-        return encrypted_message  # Return as-is if decryption fails
+    return get_cipher().decrypt(encrypted_message)
 
-def get_decrypted_conversation_history(session):
+def get_decrypted_conversation_history(session, limit=None):
     """Get conversation history with decrypted messages for display"""
-    if 'conversation_history' not in session:
+    conversation = current_conversation()
+    if conversation is None:
         return []
     
-    decrypted_history = []
-    for msg in session['conversation_history']:
-        if msg.get('encrypted', False):
-            decrypted_msg = {
-                'role': msg['role'],
-                'message': decrypt_message(msg['message']),
-                'timestamp': msg.get('timestamp', None)
-            }
-        else:
-            # Handle legacy unencrypted messages
-            decrypted_msg = {
-                'role': msg['role'],
-                'message': msg['message'],
-                'timestamp': msg.get('timestamp', None)
-            }
-        decrypted_history.append(decrypted_msg)
-    
-    return decrypted_history
+    return decrypt_history(recent_messages(conversation, limit))
 
 @auth.route('/login', methods=['GET', 'POST'])
 def login():
@@ -92,29 +45,39 @@ def login():
     
     # Handle POST request for login
     try:
-        print("Login route called")
-        print(f"Request method: {request.method}")
-        print(f"Request headers: {dict(request.headers)}")
-        print(f"Request data: {request.get_json()}")
-        
         data = request.json or request.form
         email = data.get('email')
         password = data.get('password')
         
-        print(f"Email: {email}")
-        print(f"Password provided: {'Yes' if password else 'No'}")
-
         if not email or not password:
-            print("Missing email or password")
+            logger.info("login rejected reason=missing_fields")
             return jsonify({"error": "Email and password are required"}), 400
 
         user = User.query.filter_by(email=email).first()
-        print(f"User found: {user is not None}")
 
-        if not user or not user.check_password(password, current_app.extensions['bcrypt']):
-            print("Invalid credentials")
+        if not user:
+            logger.info("login rejected reason=unknown_email")
+            return jsonify({"error": "Invalid email or password"}), 401
+        
+        hasher = get_password_hasher()
+        with PASSWORD_LATENCY.time(operation='verify'):
+            password_ok = user.check_password(password, hasher)
+        if not password_ok:
+            logger.info("login rejected reason=bad_password user_id=%s", user.id)
             return jsonify({"error": "Invalid email or password"}), 401
 
+        if hasher.needs_rehash(user.password_hash):
+            # The cost factor changed since this hash was made; upgrade it now
+            # that we have the plain password. Failing here must not fail login.
+            try:
+                with PASSWORD_LATENCY.time(operation='rehash'):
+                    user.set_password(password, hasher)
+                db.session.commit()
+                logger.info("password rehashed user_id=%s rounds=%d", user.id, hasher.rounds)
+            except Exception as e:
+                db.session.rollback()
+                logger.warning("password rehash failed user_id=%s error=%r", user.id, e)
+
         # Clear guest session variables and set up user authentication
         session.pop('guest_start_time', None)
         session.pop('guest_mode', None)
@@ -124,7 +87,7 @@ def login():
         # Log in the user with Flask-Login
         login_user(user)
         
-        print("Login successful")
+        logger.info("login succeeded user_id=%s", user.id)
         return jsonify({
             "message": "Login successful",
             "user": {
@@ -134,10 +97,11 @@ def login():
             }
         }), 200
            
-    except Exception as e:
-        print(f"Login error: {e}")
-        import traceback
-        traceback.print_exc()
+    except PasswordPoolBusy as e:
+        logger.warning("login shed reason=password_pool_busy detail=%s", e)
+        return jsonify({"error": "Too many sign-ins right now, please try again"}), 503, {'Retry-After': '2'}
+    except Exception:
+        logger.exception("login failed")
         return jsonify({"error": "An error occurred during login"}), 500
 
 @auth.route('/signup', methods=['GET', 'POST'])
@@ -147,62 +111,37 @@ def signup():
     
     # Handle POST request for signup
     try:
-        print("=== SIGNUP ROUTE DEBUG ===")
-        print("Signup route called")
-        print(f"Request method: {request.method}")
-        print(f"Request headers: {dict(request.headers)}")
-        print(f"Request data: {request.get_json()}")
-        print(f"Form data: {request.form}")
-        
         data = request.json or request.form
-        print(f"Final data object: {data}")
         
         first_name = data.get('first_name')
         email = data.get('email')
         password = data.get('password')
-        
-        print(f"Extracted values:")
-        print(f"  - first_name: '{first_name}' (type: {type(first_name)})")
-        print(f"  - email: '{email}' (type: {type(email)})")
-        print(f"  - password: '{password}' (type: {type(password)})")
-        print(f"  - password length: {len(password) if password else 0}")
 
         # Check each field individually
         if not first_name:
-            print("❌ first_name is missing or empty")
             return jsonify({"error": "First name is required"}), 400
         if not email:
-            print("❌ email is missing or empty")
             return jsonify({"error": "Email is required"}), 400
         if not password:
-            print("❌ password is missing or empty")
             return jsonify({"error": "Password is required"}), 400
-
-        print("✅ All required fields present")
         
         # Check if user already exists
         existing_user = User.query.filter_by(email=email).first()
         if existing_user:
-            print(f"❌ Email already exists: {email}")
+            logger.info("signup rejected reason=email_in_use")
             return jsonify({"error": "Email already in use"}), 400
-        
-        print("✅ Email is available")
 
-        print("Creating new user...")
         new_user = User(first_name=first_name, email=email)
-        new_user.set_password(password, current_app.extensions['bcrypt'])
-        print("✅ User object created and password set")
+        with PASSWORD_LATENCY.time(operation='hash'):
+            new_user.set_password(password, get_password_hasher())
 
         db.session.add(new_user)
-        print("✅ User added to session")
-        
         db.session.commit()
-        print("✅ User committed to database")
         
         # Automatically log in the user after successful signup
         login_user(new_user)
         
-        print("User created and logged in successfully")
+        logger.info("signup succeeded user_id=%s", new_user.id)
         return jsonify({
             "message": "Account created successfully",
             "user": {
@@ -212,77 +151,195 @@ def signup():
             }
         }), 201
     
-    except Exception as e:
-        print(f"Signup error: {e}")
-        import traceback
-        traceback.print_exc()
+    except PasswordPoolBusy as e:
+        logger.warning("signup shed reason=password_pool_busy detail=%s", e)
+        db.session.rollback()
+        return jsonify({"error": "Too many sign-ups right now, please try again"}), 503, {'Retry-After': '2'}
+    except Exception:
+        logger.exception("signup failed")
         db.session.rollback()
         return jsonify({"error": "An error occurred during signup"}), 500
 
 # Chat routes
+def current_guest():
+    """Registry entry for the guest session in the cookie"""
+    start_time = session.get('guest_start_time', 0)
+    guest_id = session.get('guest_id') or f"start-{start_time}"
+    return get_guest_registry().register(guest_id, start_time)
+
+def notify_guest_expired():
+    """Record the expiration message in the guest's history once; returns it"""
+    expiration_message = guest_expiration_message(get_guest_registry().ttl)
+    if not session.get('guest_expired_notified'):
+        # Mark that we've notified about expiration
+        session['guest_expired_notified'] = True
+        add_messages(get_or_start_conversation(), [("ai", expiration_message, False)])
+    return expiration_message
+
 @auth.route('/guest/status', methods=['GET'])
 def guest_status():
-    """Get guest session status and remaining time"""
+    """Get guest session status, including the absolute expiry time
+    
+    Until the session expires the answer only changes if a new guest
+    session starts, so it is cacheable up to the expiry and revalidates by
+    ETag. Clients should count down from expires_at rather than poll.
+    """
+    if current_user.is_authenticated:
+        return jsonify({"authenticated": True}), 200
     if 'guest_start_time' not in session:
         return jsonify({"error": "No guest session"}), 400
     
-    guest_elapsed = time.time() - session.get('guest_start_time', 0)
-    remaining_time = max(0, 900 - guest_elapsed)  # 15 minutes = 900 seconds
+    entry = current_guest()
+    remaining_time = max(0, entry.expires_at - time.time())
     minutes_remaining = int(remaining_time // 60)
     seconds_remaining = int(remaining_time % 60)
+    expired = remaining_time <= 0
     
     # Check if time just expired and send message if needed
-    if remaining_time <= 0 and session.get('guest_mode') == 'guest' and not session.get('guest_expired_notified'):
-        # Mark that we've notified about expiration
-        session['guest_expired_notified'] = True
-        
-        # Add expiration message to chat history
-        if 'conversation_history' not in session:
-            session['conversation_history'] = []
-        
-        expiration_message = "⏰ Your 15-minute guest session has expired. Please create a free account to continue chatting with Neurochat!"
-        
-        session['conversation_history'].append({
-            "role": "ai",
-            "message": expiration_message
-        })
-        
-        return jsonify({
+    if expired and session.get('guest_mode') == 'guest' and not session.get('guest_expired_notified'):
+        expiration_message = notify_guest_expired()
+        response = jsonify({
             "guest_mode": session.get('guest_mode'),
             "remaining_time": remaining_time,
             "minutes_remaining": minutes_remaining,
             "seconds_remaining": seconds_remaining,
+            "expires_at": entry.expires_at,
             "expired": True,
             "expiration_message": expiration_message,
             "show_expiration_message": True
-        }), 200
+        })
+        response.headers['Cache-Control'] = 'no-store'
+        return response, 200
     
-    return jsonify({
-        "guest_mode": session.get('guest_mode'),
-        "remaining_time": remaining_time,
-        "minutes_remaining": minutes_remaining,
-        "seconds_remaining": seconds_remaining,
-        "expired": remaining_time <= 0
-    }), 200
+    etag = f"guest.{entry.guest_id}.{entry.expires_at}.{int(expired)}"
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify({
+            "guest_mode": session.get('guest_mode'),
+            "remaining_time": remaining_time,
+            "minutes_remaining": minutes_remaining,
+            "seconds_remaining": seconds_remaining,
+            "expires_at": entry.expires_at,
+            "expired": expired
+        })
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f"private, max-age={int(remaining_time)}" if not expired else 'private, no-cache'
+    return response
+
+# Longest a /guest/events request stays open; below typical proxy idle timeouts
+GUEST_EVENTS_MAX_WAIT = 45
+
+@auth.route('/guest/events', methods=['GET'])
+def guest_events():
+    """Push one 'expired' Server-Sent Event when the guest's time runs out
+    
+    If the session has not expired within GUEST_EVENTS_MAX_WAIT seconds the
+    stream ends with a 'pending' event carrying the time left, so clients
+    connect shortly before expires_at instead of holding a connection open
+    for the whole session.
+    """
+    if current_user.is_authenticated or 'guest_start_time' not in session:
+        return jsonify({"error": "No guest session"}), 400
+    
+    entry = current_guest()
+    expiration_message = guest_expiration_message(get_guest_registry().ttl)
+    
+    def expiry_events():
+        # Send a frame right away so proxies see the response start
+        yield "retry: 5000\n\n"
+        if entry.expired.wait(min(GUEST_EVENTS_MAX_WAIT, max(0, entry.expires_at - time.time()) + 1)):
+            yield sse_event({"expired": True, "expires_at": entry.expires_at,
+                             "expiration_message": expiration_message}, event='expired')
+        else:
+            yield sse_event({"expired": False, "expires_at": entry.expires_at,
+                             "remaining_time": max(0, entry.expires_at - time.time())}, event='pending')
+    
+    return sse_response(expiry_events())
+
+# Page sizes for /chat/history
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
 
 @auth.route('/chat/history', methods=['GET'])
 def get_chat_history():
-    """Get decrypted conversation history for display"""
+    """Get a page of decrypted conversation history for display
+    
+    Supports `limit` plus a `before` or `after` message id cursor (`since` is
+    accepted as an alias of `after` for reconnecting clients). Responses carry
+    an ETag so an unchanged page costs a 304 and no decryption.
+    """
     try:
-        decrypted_history = get_decrypted_conversation_history(session)
-        return jsonify({
-            "history": decrypted_history,
-            "count": len(decrypted_history)
-        }), 200
-    except Exception as e:
-        print(f"Error getting chat history: {e}")
+        limit = request.args.get('limit', HISTORY_PAGE_SIZE, type=int)
+        before = request.args.get('before', type=int)
+        after = request.args.get('after', request.args.get('since', type=int), type=int)
+        
+        if limit < 1:
+            return jsonify({"error": "limit must be a positive integer"}), 400
+        if before is not None and after is not None:
+            return jsonify({"error": "Use either before or after, not both"}), 400
+        limit = min(limit, HISTORY_MAX_PAGE_SIZE)
+        
+        conversation = current_conversation()
+        settle(conversation)
+        conversation_id = conversation.id if conversation else 0
+        version = conversation_version(conversation) if conversation else 0
+        etag = f"{conversation_id}.{version}.{limit}.{before}.{after}"
+        
+        if request.if_none_match.contains_weak(etag):
+            response = current_app.response_class(status=304)
+        else:
+            messages, has_more = page_messages(conversation, limit, before, after) if conversation else ([], False)
+            decrypted_history = decrypt_history(messages)
+            response = jsonify({
+                "history": decrypted_history,
+                "count": len(decrypted_history),
+                "has_more": has_more,
+                "version": version
+            })
+        
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    except Exception:
+        logger.exception("chat history failed")
         return jsonify({"error": "Failed to retrieve chat history"}), 500
 
+# Page sizes for /chat/search
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+
+@auth.route('/chat/search', methods=['GET'])
+@login_required
+def search_chat_history():
+    """Find the user's messages containing every word of `q`, newest first
+    
+    Answered from the blind index, so only matching messages are decrypted.
+    Page back with `before`, the id of the last result.
+    """
+    query = request.args.get('q', '').strip()
+    limit = request.args.get('limit', SEARCH_PAGE_SIZE, type=int)
+    before = request.args.get('before', type=int)
+    if not query:
+        return jsonify({"error": "Search query cannot be empty"}), 400
+    if limit < 1:
+        return jsonify({"error": "limit must be a positive integer"}), 400
+    
+    try:
+        results, has_more = search_messages(current_user.id, query, min(limit, SEARCH_MAX_PAGE_SIZE), before)
+    except Exception:
+        logger.exception("chat search failed")
+        return jsonify({"error": "Failed to search chat history"}), 500
+    
+    response = jsonify({"results": results, "count": len(results), "has_more": has_more})
+    response.headers['Cache-Control'] = 'private, no-store'
+    return response
+
 @auth.route('/chat/start', methods=['POST'])
 def start_chat():
     """Initialize chat session and ask for conversation mode preference"""
     session['chat_mode'] = None  # Reset mode
-    session['conversation_history'] = []
+    start_conversation()
     
     initial_message = {
         "message": "Hi, I'm Neurochat — your friendly AI companion here to listen or talk whenever you need. Would you prefer me to mainly listen and provide gentle support, or would you like me to actively respond and engage in conversation with you?",
@@ -292,6 +349,34 @@ def start_chat():
     
     return jsonify(initial_message), 200
 
+@auth.route('/export', methods=['GET'])
+@login_required
+def export_conversations():
+    """Stream every conversation of the current user as NDJSON
+
+    `gzip=1` downloads a .ndjson.gz file instead. After an interrupted
+    download, pass the `cursor` of the last complete line to continue.
+    """
+    cursor = request.args.get('cursor')
+    compressed = request.args.get('gzip', '').lower() in ('1', 'true', 'yes')
+    try:
+        chunks = iter_export(current_user.id, cursor, current_app.config.get('EXPORT_BATCH_SIZE', EXPORT_BATCH_SIZE))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    filename = f"neurochat-export-{current_user.id}.ndjson"
+    if compressed:
+        # Compressed here as a file, so the transport compression leaves it alone
+        chunks = compress_stream(chunks, Compressor('gzip', current_app.config.get('COMPRESS_LEVEL', 6), None))
+        filename += '.gz'
+    logger.info("export started user_id=%s resumed=%s gzip=%s", current_user.id, cursor is not None, compressed)
+    return current_app.response_class(
+        stream_with_context(chunks),
+        mimetype='application/gzip' if compressed else 'application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"',
+                 'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no'}
+    )
+
 @auth.route('/logout')
 def logout():
     """Logout user and clear session"""
@@ -306,29 +391,20 @@ def set_chat_mode():
         data = request.get_json()
         mode = data.get('mode')
         
-        if mode not in ['listen', 'talk']:
-            return jsonify({"error": "Invalid mode. Must be 'listen' or 'talk'"}), 400
+        persona = get_persona(mode)
+        if persona is None:
+            return jsonify({"error": f"Invalid mode. Must be one of: {', '.join(PERSONAS)}"}), 400
         
         session['chat_mode'] = mode
-        session['conversation_history'] = []
+        conversation = start_conversation(mode)
         
         # Send confirmation message based on mode
-        if mode == 'listen':
-            confirmation = "Perfect! I'm in listening mode now. I'm here to support you - share whatever's on your mind and I'll be here to listen and offer gentle encouragement."
-        else:
-            confirmation = "Awesome! I'm in talk mode now. I'm excited to chat with you and really engage in conversation. What's on your mind?"
+        confirmation = persona.confirmation
         
         # Add confirmation to conversation history
-        if 'conversation_history' not in session:
-            session['conversation_history'] = []
+        add_messages(conversation, [("ai", confirmation, False)])
         
-        session['conversation_history'].append({
-            "role": "ai",
-            "message": confirmation
-        })
-        
-        print(f"Chat mode set to: {mode}")
-        print(f"Session contents after mode set: {dict(session)}")
+        logger.debug("chat mode set mode=%s conversation_id=%s", mode, conversation.id)
         
         return jsonify({
             "message": "Mode set successfully, please share what's on your mind!",
@@ -336,397 +412,311 @@ def set_chat_mode():
             "confirmation": confirmation
         }), 200
         
-    except Exception as e:
-        print(f"Error setting chat mode: {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        logger.exception("setting chat mode failed")
         return jsonify({"error": "Failed to set chat mode"}), 500
 
-@auth.route('/chat/message', methods=['POST'])
-def chat_message():
-    """Process user message and return AI response based on mode"""
-    data = request.json
-    user_message = data.get('message', '').strip()
-    
-    if not user_message:
-        return jsonify({"error": "Message cannot be empty"}), 400
-    
+def check_chat_access():
+    """Return an error response if the visitor may not chat right now, else None"""
     # Check if user is authenticated first
     if current_user.is_authenticated:
         # User is logged in, proceed with chat
-        pass
+        return None
     elif session.get('guest_mode') == 'guest':
         # Check if guest time has expired
-        guest_elapsed = time.time() - session.get('guest_start_time', 0)
-        if guest_elapsed > 900:  # 15 minutes
-            # Add expiration message to chat history
-            if 'conversation_history' not in session:
-                session['conversation_history'] = []
+        if current_guest().expires_at <= time.time():
+            expiration_message = guest_expiration_message(get_guest_registry().ttl)
             
-            expiration_message = "⏰ Your 15-minute guest session has expired. Please create a free account to continue chatting with Neurochat!"
-            
-            session['conversation_history'].append({
-                "role": "ai",
-                "message": expiration_message
-            })
+            # Add expiration message to chat history
+            add_messages(get_or_start_conversation(), [("ai", expiration_message, False)])
             
             return jsonify({
                 "message": expiration_message,
                 "expired": True,
                 "guest_expired": True
             }), 200
+        return None
     else:
         # Neither authenticated nor guest
         return jsonify({"error": "Please log in or start a guest session"}), 401
+
+def quota_client(conversation):
+    """The (kind, id) a chat turn is charged to"""
+    if current_user.is_authenticated:
+        return 'user', current_user.id
+    return 'guest', session.get('guest_id') or conversation.id
+
+def check_turn_rate(conversation):
+    """Charge a chat turn to the visitor's request quota; raises AdmissionRejected
+    
+    Runs before any context work, so throttled turns cost next to nothing, but
+    after the Idempotency-Key claim, so replays are not charged again.
+    """
+    get_admission().check_request(*quota_client(conversation))
+
+def admit_turn(conversation, mode, context):
+    """Charge a chat turn to the visitor's token quota and take a provider slot
+    
+    Returns a ticket whose release() frees the slot; raises AdmissionRejected.
+    """
+    kind, client_id = quota_client(conversation)
+    persona = get_persona(mode)
+    # The persona prompt and the longest reply count against the quota up front
+    return get_admission().admit(kind, client_id, persona.prompt_tokens + context.tokens + persona.max_tokens)
+
+def admission_rejected(error):
+    """429 response telling the client when to retry"""
+    logger.info("chat turn rejected reason=%s retry_after=%s", error.reason, error.retry_after)
+    message = ("You're sending messages faster than we can answer, please slow down"
+               if error.reason == 'quota' else "Neurochat is very busy right now, please try again shortly")
+    return jsonify({"error": message, "retry_after": error.retry_after}), 429, {'Retry-After': str(error.retry_after)}
+
+def idempotency_claim(conversation, user_message, mode):
+    """Claim the request's Idempotency-Key, if it sent one
+    
+    Returns (key, entry, owner); raises IdempotencyConflict if the key was
+    already used for a different message.
+    """
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if not idempotency_key:
+        return None, None, True
+    
+    # Keys are scoped to the conversation so visitors can't replay each other
+    key = f"{conversation.id}:{idempotency_key}"
+    entry, owner = get_idempotency_store().begin(key, (mode, user_message))
+    return key, entry, owner
+
+@auth.route('/chat/message', methods=['POST'])
+def chat_message():
+    """Process user message and return AI response based on mode"""
+    data = request.json
+    user_message = data.get('message', '').strip()
+    
+    if not user_message:
+        return jsonify({"error": "Message cannot be empty"}), 400
+    
+    access_error = check_chat_access()
+    if access_error:
+        return access_error
     
     mode = session.get('chat_mode')
-    if not mode:
+    if get_persona(mode) is None:
         return jsonify({"error": "Chat mode not set"}), 400
     
-    print(f"Chat message - Current mode: {mode}")
-    print(f"Chat message - Session contents: {dict(session)}")
+    with chat_stage('session_load'):
+        conversation = get_or_start_conversation(mode)
+    
+    try:
+        key, entry, owner = idempotency_claim(conversation, user_message, mode)
+    except IdempotencyConflict:
+        return jsonify({"error": "Idempotency-Key was already used for a different message"}), 422
     
-    # Store conversation history
-    if 'conversation_history' not in session:
-        session['conversation_history'] = []
+    if not owner:
+        # A duplicate submit: reuse the original turn instead of paying for another
+        payload = get_idempotency_store().wait(entry)
+        if payload is None:
+            return jsonify({"error": "The original request for this Idempotency-Key failed"}), 409
+        response = jsonify(payload)
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response, 200
     
-    # Encrypt user message before storing
-    encrypted_user_message = encrypt_message(user_message)
+    try:
+        # Only the turn that runs is charged; replays and key conflicts are free
+        check_turn_rate(conversation)
+        
+        # Only the turns that fit the mode's token budget are decrypted and sent
+        with chat_stage('context_build'):
+            settle(conversation)
+            context = build_context(conversation, mode, user_message)
+        
+        with chat_stage('admission'):
+            ticket = admit_turn(conversation, mode, context)
+        
+        # Generate AI response based on mode
+        try:
+            with chat_stage('provider'):
+                ai_response = generate_response(get_persona(mode), context.user_message, context.history, summary=context.summary)
+        finally:
+            ticket.release()
+        
+        # Encrypt both sides of the turn before storing
+        with chat_stage('encrypt'):
+            encrypted_user_message, encrypted_ai_response = get_cipher().encrypt_many([user_message, ai_response])
+        
+        # Stored by the write-behind queue once the reply is on its way
+        with chat_stage('session_save'):
+            queue_messages(conversation, [
+                ("user", encrypted_user_message, True),
+                ("ai", encrypted_ai_response, True)
+            ], texts=[user_message, ai_response])
+            queue_summary_update(conversation, context, ai_response)
+    except AdmissionRejected as e:
+        if key:
+            get_idempotency_store().fail(key, entry)
+        return admission_rejected(e)
+    except Exception:
+        if key:
+            get_idempotency_store().fail(key, entry)
+        raise
     
-    session['conversation_history'].append({
-        "role": "user",
-        "message": encrypted_user_message,
-        "encrypted": True
-    })
+    payload = {"message": ai_response, "mode": mode}
+    if key:
+        get_idempotency_store().finish(key, entry, payload)
+    return jsonify(payload), 200
+
+def sse_event(payload, event=None):
+    """Format a payload as a single Server-Sent Events frame"""
+    frame = f"event: {event}\n" if event else ""
+    return frame + f"data: {json.dumps(payload)}\n\n"
+
+def sse_response(events, headers=None):
+    """Wrap an iterator of SSE frames in a streaming response"""
+    return current_app.response_class(
+        stream_with_context(events),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no', **(headers or {})}
+    )
+
+@auth.route('/chat/message/stream', methods=['POST'])
+def chat_message_stream():
+    """Process user message and stream the AI response as Server-Sent Events"""
+    data = request.json
+    user_message = data.get('message', '').strip()
     
-    # Generate AI response based on mode
-    if mode == 'listen':
-        print(f"Chat message - Using LISTEN mode")
-        ai_response = generate_listening_response(user_message, session['conversation_history'])
-    else:
-        print(f"Chat message - Using RESPOND mode")
-        ai_response = generate_active_response(user_message, session['conversation_history'])
+    if not user_message:
+        return jsonify({"error": "Message cannot be empty"}), 400
     
-    # Encrypt AI response before storing
-    encrypted_ai_response = encrypt_message(ai_response)
+    access_error = check_chat_access()
+    if access_error:
+        return access_error
     
-    session['conversation_history'].append({
-        "role": "ai",
-        "message": encrypted_ai_response,
-        "encrypted": True
-    })
+    mode = session.get('chat_mode')
+    if get_persona(mode) is None:
+        return jsonify({"error": "Chat mode not set"}), 400
+    
+    with chat_stage('session_load'):
+        conversation = get_or_start_conversation(mode)
     
-    return jsonify({"message": ai_response, "mode": mode}), 200
-
-def generate_listening_response(user_message, history):
-    """Generate empathetic, validating responses for listen mode using OpenAI"""
     try:
-        from openai import OpenAI
-        import os
+        key, entry, owner = idempotency_claim(conversation, user_message, mode)
+    except IdempotencyConflict:
+        return jsonify({"error": "Idempotency-Key was already used for a different message"}), 422
+    
+    if not owner:
+        def replay_stream():
+            # Wait for the original stream and replay its reply in one frame
+            payload = get_idempotency_store().wait(entry)
+            if payload is None:
+                yield sse_event({"error": "The original request for this Idempotency-Key failed"}, event='error')
+                return
+            yield sse_event({"delta": payload["message"]})
+            yield sse_event(payload, event='done')
+        
+        return sse_response(replay_stream(), headers={'Idempotent-Replayed': 'true'})
+    
+    ticket = None
+    try:
+        check_turn_rate(conversation)
         
-        # Try multiple ways to get the API key
-        api_key = None
+        with chat_stage('context_build'):
+            settle(conversation)
+            context = build_context(conversation, mode, user_message)
         
-        # Method 1: Try config function
-        try:
-            api_key = config('OPENAI_API_KEY', default=None)
-            if api_key:
-                # Clean the key - remove any line breaks or extra whitespace
-                api_key = api_key.strip().replace('\n', '').replace('\r', '')
-                print(f"Listen Mode - Method 1 (config): {api_key[:20]}... (length: {len(api_key)})")
-            else:
-                print("Listen Mode - Method 1 (config): No key found")
-        except Exception as e:
-            print(f"Listen Mode - Method 1 failed: {e}")
-        
-        # Method 2: Try direct environment variable
-        if not api_key:
-            api_key = os.environ.get('OPENAI_API_KEY')
-            if api_key:
-                # Clean the key - remove any line breaks or extra whitespace
-                api_key = api_key.strip().replace('\n', '').replace('\r', '')
-                print(f"Listen Mode - Method 2 (os.environ): {api_key[:20]}... (length: {len(api_key)})")
-            else:
-                print("Listen Mode - Method 2 (os.environ): No key found")
-        
-        # Method 3: Try loading from .env file manually
-        if not api_key:
+        with chat_stage('admission'):
+            ticket = admit_turn(conversation, mode, context)
+        
+        # Spool the user message now so it survives even if the stream is cut off
+        with chat_stage('session_save'):
+            queue_messages(conversation, [("user", encrypt_message(user_message), True)], texts=[user_message])
+        persona = get_persona(mode)
+        
+        def event_stream():
             try:
-                # Look for .env file in project root
-                project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
-                env_path = os.path.join(project_root, '.env')
-                print(f"Listen Mode - Looking for .env at: {env_path}")
+                parts = []
+                started = time.perf_counter()
+                try:
+                    reply = generate_response(persona, context.user_message, context.history, stream=True, summary=context.summary)
+                    # Fallback replies come back as a plain string
+                    for delta in ([reply] if isinstance(reply, str) else reply):
+                        if not parts:
+                            CHAT_STAGE_LATENCY.observe(time.perf_counter() - started, stage='provider_first_token')
+                        parts.append(delta)
+                        yield sse_event({"delta": delta})
+                finally:
+                    ticket.release()
+                CHAT_STAGE_LATENCY.observe(time.perf_counter() - started, stage='provider')
                 
-                if os.path.exists(env_path):
-                    print("Listen Mode - .env file found, loading...")
-                    with open(env_path, 'r') as f:
-                        content = f.read()
-                        print(f"Listen Mode - .env file content length: {len(content)}")
-                        print(f"Listen Mode - .env file content preview: {content[:200]}...")
-                        
-                        # Look for OPENAI_API_KEY in the content
-                        if 'OPENAI_API_KEY=' in content:
-                            # Extract the API key, handling potential line breaks
-                            lines = content.split('\n')
-                            for i, line in enumerate(lines):
-                                # Handle BOM character and check for OPENAI_API_KEY
-                                if line.startswith('OPENAI_API_KEY=') or line.startswith('ï»¿OPENAI_API_KEY='):
-                                    # Get the key from this line, removing BOM if present
-                                    full_key = line.replace('ï»¿OPENAI_API_KEY=', '').replace('OPENAI_API_KEY=', '').strip()
-                                    
-                                    # Look for continuation in next lines (up to 5 lines)
-                                    for j in range(i+1, min(i+5, len(lines))):
-                                        next_line = lines[j].strip()
-                                        # If next line doesn't contain '=' and isn't empty, it's likely a continuation
-                                        if next_line and not next_line.startswith('#') and '=' not in next_line:
-                                            full_key += next_line
-                                        else:
-                                            # Stop if we hit another key or empty line
-                                            break
-                                    
-                                    api_key = full_key
-                                    print(f"Listen Mode - Found API key starting with: {api_key[:20]}...")
-                                    break
-                            
-                            if api_key:
-                                os.environ['OPENAI_API_KEY'] = api_key
-                                print(f"Listen Mode - API key loaded from .env: {api_key[:20]}...")
-                                print(f"Listen Mode - API key full length: {len(api_key)}")
-                            else:
-                                print("Listen Mode - Failed to extract API key from .env file")
-                        else:
-                            print("Listen Mode - OPENAI_API_KEY not found in .env file")
-                else:
-                    print(f"Listen Mode - .env file not found at {env_path}")
-            except Exception as e:
-                print(f"Listen Mode - Method 3 failed: {e}")
-                import traceback
-                traceback.print_exc()
-        
-        # Debug: Check final API key status
-        print(f"Listen Mode - Final API Key: {api_key[:20] if api_key else 'None'}...")
-        print(f"Listen Mode - API Key length: {len(api_key) if api_key else 0}")
-        
-        if not api_key:
-            print("Listen Mode - No API key found after all methods, returning fallback")
-            print("Listen Mode - Make sure OPENAI_API_KEY is set in your environment variables")
-            return "I'm here to listen and support you. (Note: OpenAI API key not configured - please add OPENAI_API_KEY to your environment variables)"
-        
-        # Initialize OpenAI client
-        client = OpenAI(api_key=api_key)
-        print("Listen Mode - OpenAI client initialized successfully")
-        
-        # Build conversation context for ChatGPT
-        messages = [
-            {
-                "role": "system", 
-                "content": """You are Neurochat, a warm and empathetic AI companion in 'Listen Mode' where you provide gentle validation and support while mainly listening.
-
-Your personality:
-- Warm, empathetic, and supportive
-- Focus on validating feelings and providing gentle encouragement
-- Keep responses relatively short (1-2 sentences usually)
-- Be present and understanding without trying to solve problems
-- Use a calm, caring tone
-
-Response style:
-- Acknowledge their feelings and experiences
-- Provide gentle validation and support
-- Encourage them to continue sharing
-- Be empathetic but not overly formal
-- Focus on listening rather than giving advice
-
-Remember: You're here to listen with empathy and provide gentle support, not to solve problems or give advice."""
-            }
-        ]
-        
-        # Add recent conversation history (last 4 messages for context)
-        recent_history = history[-4:] if len(history) > 4 else history
-        for msg in recent_history:
-            if msg.get('role') == 'user':
-                messages.append({"role": "user", "content": msg.get('message', '')})
-            elif msg.get('role') == 'ai':
-                messages.append({"role": "assistant", "content": msg.get('message', '')})
-        
-        # Add current user message
-        messages.append({"role": "user", "content": user_message})
-        
-        print(f"Listen Mode - Making OpenAI API call with {len(messages)} messages")
-        
-        # Call OpenAI API
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=messages,
-            max_tokens=100,
-            temperature=0.7,
-            frequency_penalty=0.3,
-            presence_penalty=0.3
-        )
-        
-        ai_response = response.choices[0].message.content.strip()
-        print(f"Listen Mode - OpenAI response received: {ai_response[:50]}...")
-        return ai_response
-        
+                ai_response = ''.join(parts).strip()
+                with chat_stage('session_save'):
+                    queue_messages(conversation, [("ai", encrypt_message(ai_response), True)], texts=[ai_response])
+                    queue_summary_update(conversation, context, ai_response)
+            except BaseException:
+                # Includes the client going away mid-stream
+                if key:
+                    get_idempotency_store().fail(key, entry)
+                raise
+            
+            payload = {"message": ai_response, "mode": mode}
+            if key:
+                get_idempotency_store().finish(key, entry, payload)
+            yield sse_event(payload, event='done')
+        
+        app = current_app._get_current_object()
+        
+        def on_close():
+            # Free the slot and the key even if the client leaves before the stream starts
+            ticket.release()
+            if key and not entry.finished:
+                with app.app_context():
+                    get_idempotency_store().fail(key, entry)
+        
+        response = sse_response(event_stream())
+        response.call_on_close(on_close)
+    except AdmissionRejected as e:
+        if key:
+            get_idempotency_store().fail(key, entry)
+        return admission_rejected(e)
+    except Exception:
+        # Nothing will close the response, so give back the slot and the key here
+        if ticket:
+            ticket.release()
+        if key:
+            get_idempotency_store().fail(key, entry)
+        raise
+    return response
+
+def iter_stream_text(deltas, fallback):
+    """Pass provider text deltas through, falling back if nothing arrives"""
+    streamed = False
+    try:
+        for delta in deltas:
+            streamed = True
+            yield delta
     except Exception as e:
-        print(f"OpenAI API Error in listen mode: {e}")
-        import traceback
-        traceback.print_exc()
-        return "I'm here to listen and support you. Please continue sharing what's on your mind."
+        logger.warning("provider stream failed error=%r", e)
+        if not streamed:
+            yield fallback
 
-def generate_active_response(user_message, history):
-    """Generate responses using OpenAI ChatGPT API"""
-    
+def generate_response(persona, user_message, history, stream=False, summary=None):
+    """Generate a reply in the persona's mode, falling back to a canned reply on failure"""
     try:
-        from openai import OpenAI
-        import os
+        provider = get_provider()
+        if provider is None:
+            logger.warning("no chat provider configured mode=%s", persona.name)
+            return f"{persona.fallback} (Note: OpenAI API key not configured - please add OPENAI_API_KEY to your environment variables)"
         
-        # Try multiple ways to get the API key
-        api_key = None
+        messages = persona.build_messages(user_message, history, summary)
+        logger.debug("provider call mode=%s messages=%d", persona.name, len(messages))
         
-        # Method 1: Try config function
-        try:
-            api_key = config('OPENAI_API_KEY', default=None)
-            if api_key:
-                # Clean the key - remove any line breaks or extra whitespace
-                api_key = api_key.strip().replace('\n', '').replace('\r', '')
-                print(f"Active Mode - Method 1 (config): {api_key[:20]}... (length: {len(api_key)})")
-            else:
-                print("Active Mode - Method 1 (config): No key found")
-        except Exception as e:
-            print(f"Active Mode - Method 1 failed: {e}")
-        
-        # Method 2: Try direct environment variable
-        if not api_key:
-            api_key = os.environ.get('OPENAI_API_KEY')
-            if api_key:
-                # Clean the key - remove any line breaks or extra whitespace
-                api_key = api_key.strip().replace('\n', '').replace('\r', '')
-                print(f"Active Mode - Method 2 (os.environ): {api_key[:20]}... (length: {len(api_key)})")
-            else:
-                print("Active Mode - Method 2 (os.environ): No key found")
-        
-        # Method 3: Try loading from .env file manually
-        if not api_key:
-            try:
-                # Look for .env file in project root
-                project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
-                env_path = os.path.join(project_root, '.env')
-                print(f"Active Mode - Looking for .env at: {env_path}")
-                
-                if os.path.exists(env_path):
-                    print("Active Mode - .env file found, loading...")
-                    with open(env_path, 'r') as f:
-                        content = f.read()
-                        print(f"Active Mode - .env file content length: {len(content)}")
-                        print(f"Active Mode - .env file content preview: {content[:200]}...")
-                        
-                        # Look for OPENAI_API_KEY in the content
-                        if 'OPENAI_API_KEY=' in content:
-                            # Extract the API key, handling potential line breaks
-                            lines = content.split('\n')
-                            for i, line in enumerate(lines):
-                                # Handle BOM character and check for OPENAI_API_KEY
-                                if line.startswith('OPENAI_API_KEY=') or line.startswith('ï»¿OPENAI_API_KEY='):
-                                    # Get the key from this line, removing BOM if present
-                                    full_key = line.replace('ï»¿OPENAI_API_KEY=', '').replace('OPENAI_API_KEY=', '').strip()
-                                    
-                                    # Look for continuation in next lines (up to 5 lines)
-                                    for j in range(i+1, min(i+5, len(lines))):
-                                        next_line = lines[j].strip()
-                                        # If next line doesn't contain '=' and isn't empty, it's likely a continuation
-                                        if next_line and not next_line.startswith('#') and '=' not in next_line:
-                                            full_key += next_line
-                                        else:
-                                            # Stop if we hit another key or empty line
-                                            break
-                                    
-                                    api_key = full_key
-                                    print(f"Active Mode - Found API key starting with: {api_key[:20]}...")
-                                    break
-                            
-                            if api_key:
-                                os.environ['OPENAI_API_KEY'] = api_key
-                                print(f"Active Mode - API key loaded from .env: {api_key[:20]}...")
-                                print(f"Active Mode - API key full length: {len(api_key)}")
-                            else:
-                                print("Active Mode - Failed to extract API key from .env file")
-                        else:
-                            print("Active Mode - OPENAI_API_KEY not found in .env file")
-                else:
-                    print(f"Active Mode - .env file not found at {env_path}")
-            except Exception as e:
-                print(f"Active Mode - Method 3 failed: {e}")
-                import traceback
-                traceback.print_exc()
-        
-        # Debug: Check final API key status
-        print(f"Active Mode - Final API Key: {api_key[:20] if api_key else 'None'}...")
-        print(f"Active Mode - API Key length: {len(api_key) if api_key else 0}")
-        
-        if not api_key:
-            print("Active Mode - No API key found after all methods, returning fallback")
-            print("Active Mode - Make sure OPENAI_API_KEY is set in your environment variables")
-            return "I'm here to chat with you! What's on your mind? (Note: OpenAI API key not configured - please add OPENAI_API_KEY to your environment variables)"
-        
-        # Initialize OpenAI client
-        client = OpenAI(api_key=api_key)
-        print("Active Mode - OpenAI client initialized successfully")
-        
-        # Build conversation context for ChatGPT
-        messages = [
-            {
-                "role": "system", 
-                "content": """You are Neurochat, a warm and empathetic AI companion in 'Response Mode' where you actively engage in conversation. 
-
-Your personality:
-- Casual, friendly, and conversational (like texting a close friend)
-- Use natural language, contractions, and sometimes casual expressions
-- Be genuinely curious and engaged
-- Share relatable thoughts and observations
-- Ask follow-up questions when appropriate, but don't make every response a question
-- Keep responses relatively short (1-3 sentences usually)
-- Be empathetic but not overly formal or therapeutic
-
-Response style:
-- Use lowercase naturally when it fits the casual tone
-- Occasional casual expressions like "oh wow", "that's wild", "honestly", etc.
-- Relate to their experiences with your own observations about life
-- Be authentic and human-like, not robotic or overly positive
-- Sometimes just validate their feelings without trying to "fix" anything
-
-Remember: You're a supportive friend having a natural conversation, not a therapist or formal assistant."""
-            }
-        ]
-        
-        # Add recent conversation history (last 6 messages for context)
-        recent_history = history[-6:] if len(history) > 6 else history
-        for msg in recent_history:
-            if msg.get('role') == 'user':
-                messages.append({"role": "user", "content": msg.get('message', '')})
-            elif msg.get('role') == 'ai':
-                messages.append({"role": "assistant", "content": msg.get('message', '')})
-        
-        # Add current user message
-        messages.append({"role": "user", "content": user_message})
-        
-        print(f"Active Mode - Making OpenAI API call with {len(messages)} messages")
-        
-        # Call OpenAI API
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=messages,
-            max_tokens=150,
-            temperature=0.8,
-            frequency_penalty=0.3,
-            presence_penalty=0.3
-        )
-        
-        ai_response = response.choices[0].message.content.strip()
-        print(f"Active Mode - OpenAI response received: {ai_response[:50]}...")
-        return ai_response
+        if stream:
+            return iter_stream_text(provider.stream(messages, **persona.params()), persona.fallback)
+        return provider.complete(messages, **persona.params())
         
     except Exception as e:
-        print(f"OpenAI API Error in active mode: {e}")
-        import traceback
-        traceback.print_exc()
-        return "I'm having some connection issues right now, but I'm still here with you. What's going on?"
+        if isinstance(e, CircuitOpen):
+            # The provider is known to be down; counted as a short circuit, not an error
+            logger.info("provider skipped, circuit open mode=%s", persona.name)
+        else:
+            logger.exception("provider call failed mode=%s", persona.name)
+            PROVIDER_ERRORS.inc(mode=persona.name)
+        return persona.fallback
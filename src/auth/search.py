@@ -0,0 +1,150 @@
+"""
+Search over a user's encrypted history through a blind index
+
+Message bodies stay encrypted. For every message in an account's
+conversation, each normalised word is stored as a keyed HMAC token in
+MessageToken. A query is tokenised the same way and answered from that
+indexed table; only the matching messages are decrypted. The HMAC key comes
+from SEARCH_INDEX_KEY or, failing that, is derived from ENCRYPTION_KEY.
+After changing either, rebuild the index with `flask reindex-search`.
+Guest conversations are not indexed.
+"""
+import hashlib
+import hmac
+import logging
+import re
+import unicodedata
+import click
+from flask import current_app
+from .models import db, Conversation, Message, MessageToken
+from .cipher import get_cipher
+
+logger = logging.getLogger(__name__)
+
+# Words too common to narrow a search down
+STOPWORDS = frozenset("""
+a an and are as at be but by for from had has have i i'm im is it it's its me my of on or so that the
+this to was we were what when with you your
+""".split())
+WORD_RE = re.compile(r"[^\W_]+(?:'[^\W_]+)?")
+MAX_QUERY_TERMS = 8
+
+
+def normalise_terms(text):
+    """Distinct lowercased, accent-free words worth indexing, in order of appearance"""
+    text = unicodedata.normalize('NFKD', text or '').casefold().replace('’', "'")
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    terms = []
+    for word in WORD_RE.findall(text):
+        if len(word) > 1 and word not in STOPWORDS and word not in terms:
+            terms.append(word)
+    return terms
+
+
+class SearchIndex:
+    """Turns words into blind-index tokens with one process-wide key"""
+
+    def __init__(self, key):
+        self.key = key
+
+    def token(self, term):
+        return hmac.new(self.key, term.encode('utf-8'), hashlib.sha256).hexdigest()[:32]
+
+    def tokens(self, text):
+        return [self.token(term) for term in normalise_terms(text)]
+
+
+def derive_key(app):
+    """SEARCH_INDEX_KEY, or a key derived from ENCRYPTION_KEY for this purpose only"""
+    key = app.config.get('SEARCH_INDEX_KEY')
+    if key:
+        return key.encode()
+    return hmac.new(app.config['ENCRYPTION_KEY'].encode(), b'neurochat blind index', hashlib.sha256).digest()
+
+
+def token_rows(message_id, user_id, tokens):
+    return [MessageToken(message_id=message_id, user_id=user_id, token=token) for token in tokens]
+
+
+def search_messages(user_id, query, limit=20, before=None):
+    """Messages of the user containing every term of the query, newest first
+
+    Returns (entries, has_more); `before` pages back from a message id.
+    """
+    index = get_search_index()
+    tokens = index.tokens(query)[:MAX_QUERY_TERMS]
+    if not tokens:
+        return [], False
+
+    matches = (db.session.query(MessageToken.message_id)
+               .filter(MessageToken.user_id == user_id, MessageToken.token.in_(tokens)))
+    if before is not None:
+        matches = matches.filter(MessageToken.message_id < before)
+    ids = [row.message_id for row in matches
+           .group_by(MessageToken.message_id)
+           .having(db.func.count(db.distinct(MessageToken.token)) == len(tokens))
+           .order_by(MessageToken.message_id.desc())
+           .limit(limit + 1)]
+    has_more = len(ids) > limit
+    ids = ids[:limit]
+    if not ids:
+        return [], False
+
+    messages = Message.query.filter(Message.id.in_(ids)).order_by(Message.id.desc()).all()
+    decrypted = iter(get_cipher().decrypt_many([msg.body for msg in messages if msg.encrypted]))
+    return [{
+        'id': msg.id,
+        'conversation_id': msg.conversation_id,
+        'role': msg.role,
+        'message': next(decrypted) if msg.encrypted else msg.body,
+        'timestamp': msg.created_at.isoformat()
+    } for msg in messages], has_more
+
+
+def reindex(user_id=None, batch_size=500):
+    """Rebuild the tokens of every account message (or one user's), a batch at a time"""
+    index = get_search_index()
+    cipher = get_cipher()
+    deleted = MessageToken.query
+    if user_id is not None:
+        deleted = deleted.filter_by(user_id=user_id)
+    deleted.delete(synchronize_session=False)
+    db.session.commit()
+
+    indexed = 0
+    after = 0
+    while True:
+        query = (db.session.query(Message.id, Message.body, Message.encrypted, Conversation.user_id)
+                 .join(Conversation, Message.conversation_id == Conversation.id)
+                 .filter(Conversation.user_id.isnot(None), Message.id > after))
+        if user_id is not None:
+            query = query.filter(Conversation.user_id == user_id)
+        batch = query.order_by(Message.id).limit(batch_size).all()
+        if not batch:
+            break
+        decrypted = iter(cipher.decrypt_many([row.body for row in batch if row.encrypted]))
+        for row in batch:
+            text = next(decrypted) if row.encrypted else row.body
+            db.session.add_all(token_rows(row.id, row.user_id, index.tokens(text)))
+        db.session.commit()
+        indexed += len(batch)
+        after = batch[-1].id
+    logger.info("search index rebuilt user_id=%s messages=%d", user_id, indexed)
+    return indexed
+
+
+def init_search(app):
+    """Set up the blind-index key and the reindex-search CLI command"""
+    app.extensions['search_index'] = SearchIndex(derive_key(app))
+
+    @app.cli.command('reindex-search')
+    @click.option('--user-id', type=int, default=None, help='Only rebuild this user\'s tokens')
+    @click.option('--batch-size', default=500, type=int, help='Messages decrypted per batch')
+    def reindex_search_command(user_id, batch_size):
+        """Rebuild the blind search index from the stored messages"""
+        click.echo(f"Indexed {reindex(user_id, batch_size)} messages")
+
+
+def get_search_index():
+    """Return the search index of the current app"""
+    return current_app.extensions['search_index']
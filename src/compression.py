@@ -0,0 +1,112 @@
+"""
+Negotiated gzip/brotli compression for dynamic responses
+
+JSON, HTML and text bodies above COMPRESS_MIN_SIZE are compressed with the
+best encoding the client accepts (brotli needs the optional brotli package).
+Streamed responses such as the SSE chat stream are compressed chunk by chunk
+with a flush after each one, so events still arrive as they are produced.
+"""
+import zlib
+from flask import request
+
+COMPRESSIBLE_MIMETYPES = {
+    'application/json', 'text/html', 'text/plain', 'text/css', 'text/javascript',
+    'application/javascript', 'text/event-stream', 'application/x-ndjson',
+}
+
+
+def _brotli():
+    try:
+        import brotli
+        return brotli
+    except ImportError:
+        return None
+
+
+def choose_encoding(accept_encodings, brotli_available):
+    """Pick 'br', 'gzip' or None from the request's Accept-Encoding"""
+    options = [('gzip', accept_encodings['gzip'])]
+    if brotli_available:
+        # Listed first so brotli wins ties
+        options.insert(0, ('br', accept_encodings['br']))
+    encoding, quality = max(options, key=lambda option: option[1])
+    return encoding if quality > 0 else None
+
+
+class Compressor:
+    """Incremental compressor whose flush() emits everything fed so far"""
+
+    def __init__(self, encoding, level, brotli_quality):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._brotli = _brotli().Compressor(quality=brotli_quality)
+        else:
+            # wbits 31 = gzip header and trailer
+            self._zlib = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        if self.encoding == 'br':
+            return self._brotli.process(data) + self._brotli.flush()
+        return self._zlib.compress(data) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == 'br':
+            return self._brotli.finish()
+        return self._zlib.flush(zlib.Z_FINISH)
+
+
+def compress_stream(chunks, compressor):
+    """Compress a response iterable chunk by chunk, closing it when done"""
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            if chunk:
+                yield compressor.compress(chunk)
+        yield compressor.finish()
+    finally:
+        # Pass a client disconnect on to the wrapped generator's cleanup
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+def init_compression(app):
+    """Compress eligible responses according to the request's Accept-Encoding"""
+    brotli_available = _brotli() is not None
+
+    @app.after_request
+    def compress_response(response):
+        if response.mimetype not in COMPRESSIBLE_MIMETYPES or response.direct_passthrough:
+            return response
+        # The body depends on Accept-Encoding whether or not this one is compressed
+        response.vary.add('Accept-Encoding')
+        if 'Content-Encoding' in response.headers or 'no-transform' in response.headers.get('Cache-Control', ''):
+            return response
+        encoding = choose_encoding(request.accept_encodings, brotli_available)
+        if encoding is None:
+            return response
+
+        # Compressed bytes differ from the identity ones, so only a weak
+        # validator holds; routes compare ETags with contains_weak()
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+
+        if response.status_code < 200 or response.status_code in (204, 206, 304) or request.method == 'HEAD':
+            return response
+        streamed = response.is_streamed
+        if streamed and not app.config.get('COMPRESS_STREAMS', True):
+            return response
+        if not streamed and response.calculate_content_length() < app.config.get('COMPRESS_MIN_SIZE', 500):
+            return response
+
+        compressor = Compressor(encoding, app.config.get('COMPRESS_LEVEL', 6),
+                                app.config.get('COMPRESS_BROTLI_QUALITY', 4))
+        if streamed:
+            response.response = compress_stream(response.response, compressor)
+            response.headers.pop('Content-Length', None)
+        else:
+            response.set_data(compressor.compress(response.get_data()) + compressor.finish())
+        response.headers['Content-Encoding'] = encoding
+        return response
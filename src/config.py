@@ -1,3 +1,4 @@
+import multiprocessing
 import os
 from decouple import config
 
@@ -9,20 +10,126 @@ class Config:
     SQLALCHEMY_DATABASE_URI = config('DATABASE_URL', default=f'sqlite:///{os.path.join(INSTANCE_DIR, "users.db")}')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     WTF_CSRF_ENABLED = config('WTF_CSRF_ENABLED', default=True, cast=bool)
+    # Compress JSON/HTML/SSE responses above this many bytes (gzip, or brotli if installed)
+    COMPRESS_MIN_SIZE = config('COMPRESS_MIN_SIZE', default=500, cast=int)
+    COMPRESS_LEVEL = config('COMPRESS_LEVEL', default=6, cast=int)
+    # Brotli quality for dynamic responses (0-11); higher costs far more CPU per request
+    COMPRESS_BROTLI_QUALITY = config('COMPRESS_BROTLI_QUALITY', default=4, cast=int)
+    COMPRESS_STREAMS = config('COMPRESS_STREAMS', default=True, cast=bool)
+    # Same defaults as gunicorn.conf.py, for settings sized per host or per thread
+    WEB_CONCURRENCY = config('WEB_CONCURRENCY', default=min(multiprocessing.cpu_count() * 2 + 1, 8), cast=int)
+    GUNICORN_THREADS = config('GUNICORN_THREADS', default=32, cast=int)
+    # Engine profile: 'auto' picks pooled (Postgres/MySQL), sqlite or sqlite_memory from the URI
+    DB_ENGINE_PROFILE = config('DB_ENGINE_PROFILE', default='auto')
+    # Per worker process; size + overflow covers every gunicorn thread holding a connection
+    DB_POOL_SIZE = config('DB_POOL_SIZE', default=10, cast=int)
+    DB_MAX_OVERFLOW = config('DB_MAX_OVERFLOW', default=max(0, GUNICORN_THREADS - 10), cast=int)
+    DB_POOL_TIMEOUT = config('DB_POOL_TIMEOUT', default=5, cast=int)
+    DB_POOL_RECYCLE = config('DB_POOL_RECYCLE', default=1800, cast=int)
+    SQLITE_BUSY_TIMEOUT_MS = config('SQLITE_BUSY_TIMEOUT_MS', default=5000, cast=int)
+    SQLITE_MMAP_SIZE = config('SQLITE_MMAP_SIZE', default=268435456, cast=int)
+    LOG_LEVEL = config('LOG_LEVEL', default='INFO')
+    # bcrypt cost; stored hashes are upgraded on login when it changes
+    BCRYPT_LOG_ROUNDS = config('BCRYPT_LOG_ROUNDS', default=12, cast=int)
+    # Processes per host doing bcrypt off the request threads, shared out between the workers
+    PASSWORD_WORKERS = config('PASSWORD_WORKERS', default=2, cast=int)
+    PASSWORD_QUEUE_LIMIT = config('PASSWORD_QUEUE_LIMIT', default=32, cast=int)
+    PASSWORD_TIMEOUT = config('PASSWORD_TIMEOUT', default=10.0, cast=float)
+    # Bearer token required to read /metrics; without one it is served only if METRICS_OPEN
+    METRICS_TOKEN = config('METRICS_TOKEN', default=None)
+    METRICS_OPEN = config('METRICS_OPEN', default=True, cast=bool)
+    # Request profiling: a share of requests to sample, and the bearer token for
+    # /admin/profiles, which also enables the signed per-request header
+    PROFILE_SAMPLE_RATE = config('PROFILE_SAMPLE_RATE', default=0.0, cast=float)
+    PROFILE_TOKEN = config('PROFILE_TOKEN', default=None)
+    PROFILE_DIR = config('PROFILE_DIR', default=os.path.join(INSTANCE_DIR, 'profiles'))
+    PROFILE_MAX_FILES = config('PROFILE_MAX_FILES', default=50, cast=int)
+    # Seconds a `flask profile-token` header stays valid
+    PROFILE_HEADER_MAX_AGE = config('PROFILE_HEADER_MAX_AGE', default=3600, cast=int)
+    # Message encryption; old keys (comma separated) stay readable after rotation
+    ENCRYPTION_KEY = config('ENCRYPTION_KEY', default=None)
+    ENCRYPTION_OLD_KEYS = config('ENCRYPTION_OLD_KEYS', default='')
+    # HMAC key for the search index; derived from ENCRYPTION_KEY when unset
+    SEARCH_INDEX_KEY = config('SEARCH_INDEX_KEY', default=None)
+    # Chat completion provider ('openai' or 'fake'), built once per process
+    LLM_PROVIDER = config('LLM_PROVIDER', default='openai')
+    OPENAI_BASE_URL = config('OPENAI_BASE_URL', default=None)
+    OPENAI_TIMEOUT = config('OPENAI_TIMEOUT', default=30.0, cast=float)
+    OPENAI_MAX_RETRIES = config('OPENAI_MAX_RETRIES', default=2, cast=int)
+    # Seconds each kind of provider call may take before it counts as failed
+    LLM_TIMEOUTS = {
+        'listen': config('LLM_TIMEOUT_LISTEN', default=8.0, cast=float),
+        'talk': config('LLM_TIMEOUT_TALK', default=12.0, cast=float),
+        'summary': config('LLM_TIMEOUT_SUMMARY', default=20.0, cast=float),
+    }
+    # Failures in a row that open the provider circuit (0 disables it), and seconds until a probe
+    LLM_BREAKER_FAILURES = config('LLM_BREAKER_FAILURES', default=5, cast=int)
+    LLM_BREAKER_RESET = config('LLM_BREAKER_RESET', default=30.0, cast=float)
+    # Send a second completion when the first runs past this latency percentile
+    LLM_HEDGE = config('LLM_HEDGE', default=False, cast=bool)
+    LLM_HEDGE_PERCENTILE = config('LLM_HEDGE_PERCENTILE', default=95, cast=int)
+    LLM_HEDGE_MODEL = config('LLM_HEDGE_MODEL', default=None)
+    LLM_PREWARM = config('LLM_PREWARM', default=False, cast=bool)
+    FAKE_LLM_LATENCY = config('FAKE_LLM_LATENCY', default=0.0, cast=float)
+    # Prompt tokens per mode for summary + recent turns + the new message
+    CONTEXT_TOKEN_BUDGETS = {
+        'listen': config('CONTEXT_TOKEN_BUDGET_LISTEN', default=600, cast=int),
+        'talk': config('CONTEXT_TOKEN_BUDGET_TALK', default=1200, cast=int),
+    }
+    # Fold turns that fell out of the window into the summary this many at a time
+    CONTEXT_SUMMARY_BATCH = config('CONTEXT_SUMMARY_BATCH', default=6, cast=int)
+    CONTEXT_SUMMARY_MAX_TOKENS = config('CONTEXT_SUMMARY_MAX_TOKENS', default=150, cast=int)
+    CONTEXT_SUMMARY_MODEL = config('CONTEXT_SUMMARY_MODEL', default='gpt-3.5-turbo')
+    # Seconds a finished chat turn can be replayed for a repeated Idempotency-Key
+    IDEMPOTENCY_TTL = config('IDEMPOTENCY_TTL', default=300, cast=int)
+    # Post-response writes (chat history, summaries) go through a local spool
+    WRITE_BEHIND_ENABLED = config('WRITE_BEHIND_ENABLED', default=True, cast=bool)
+    WRITE_BEHIND_SPOOL = config('WRITE_BEHIND_SPOOL', default=os.path.join(INSTANCE_DIR, 'write_behind.db'))
+    WRITE_BEHIND_BATCH_SIZE = config('WRITE_BEHIND_BATCH_SIZE', default=50, cast=int)
+    # Spooled jobs per worker before submits fall back to running inline
+    WRITE_BEHIND_MAX_PENDING = config('WRITE_BEHIND_MAX_PENDING', default=1000, cast=int)
+    # Seconds before jobs claimed by a worker that died are run again
+    WRITE_BEHIND_LEASE = config('WRITE_BEHIND_LEASE', default=60.0, cast=float)
+    # Rows read and decrypted per batch by the conversation export
+    EXPORT_BATCH_SIZE = config('EXPORT_BATCH_SIZE', default=500, cast=int)
+    # Seconds a logged-in user is served from the per-process cache
+    USER_CACHE_TTL = config('USER_CACHE_TTL', default=60, cast=int)
+    USER_CACHE_SIZE = config('USER_CACHE_SIZE', default=10000, cast=int)
+    # Seconds a guest may chat before being asked to sign up
+    GUEST_SESSION_TTL = config('GUEST_SESSION_TTL', default=900, cast=int)
+    # Admission control in front of the provider (limits are per worker process).
+    # In flight plus queued stays below the worker's threads, leaving some for other pages
+    ADMISSION_BACKEND = config('ADMISSION_BACKEND', default='memory')
+    ADMISSION_MAX_IN_FLIGHT = config('ADMISSION_MAX_IN_FLIGHT', default=max(1, GUNICORN_THREADS * 5 // 8), cast=int)
+    ADMISSION_QUEUE_SIZE = config('ADMISSION_QUEUE_SIZE', default=max(1, GUNICORN_THREADS // 8), cast=int)
+    ADMISSION_QUEUE_TIMEOUT = config('ADMISSION_QUEUE_TIMEOUT', default=2.0, cast=float)
+    USER_REQUESTS_PER_MINUTE = config('USER_REQUESTS_PER_MINUTE', default=20, cast=int)
+    USER_REQUEST_BURST = config('USER_REQUEST_BURST', default=5, cast=int)
+    USER_TOKENS_PER_MINUTE = config('USER_TOKENS_PER_MINUTE', default=20000, cast=int)
+    GUEST_REQUESTS_PER_MINUTE = config('GUEST_REQUESTS_PER_MINUTE', default=10, cast=int)
+    GUEST_REQUEST_BURST = config('GUEST_REQUEST_BURST', default=3, cast=int)
+    GUEST_TOKENS_PER_MINUTE = config('GUEST_TOKENS_PER_MINUTE', default=8000, cast=int)
 
 class ProductionConfig(Config):
     DEBUG = False
     TESTING = False
     SECRET_KEY = config('SECRET_KEY')  # Must be set in production
+    METRICS_OPEN = config('METRICS_OPEN', default=False, cast=bool)
     
 class DevelopmentConfig(Config):
     DEBUG = True
     DEVELOPMENT = True
+    LOG_LEVEL = config('LOG_LEVEL', default='DEBUG')
+    BCRYPT_LOG_ROUNDS = config('BCRYPT_LOG_ROUNDS', default=10, cast=int)
     
 class TestingConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
     WTF_CSRF_ENABLED = False
+    LLM_PROVIDER = 'fake'
+    BCRYPT_LOG_ROUNDS = 4
+    PASSWORD_WORKERS = 0
+    WRITE_BEHIND_ENABLED = False
 
 config_dict = {
     'production': ProductionConfig,
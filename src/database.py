@@ -0,0 +1,131 @@
+"""
+Engine profiles for the SQLAlchemy database
+
+Postgres gets a connection pool sized to the worker's thread count, with
+pre-ping and recycling. File-backed SQLite gets WAL and the other pragmas
+that let readers and a writer work at the same time. Pool checkout waits
+and connection counts are exported on /metrics.
+"""
+import time
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+from metrics import gauge, histogram
+
+DB_POOL_CHECKOUT = histogram('neurochat_db_pool_checkout_seconds', 'Time spent waiting for a pooled DB connection',
+                             buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0))
+
+# The most recently initialised engine, read by the gauge below. Its pool is
+# looked up each time because dispose() swaps in a new one after a fork.
+_engine = None
+
+
+def _pool_connections():
+    pool = _engine.pool if _engine is not None else None
+    if not isinstance(pool, QueuePool):
+        return {}
+    return {
+        ('checked_out',): pool.checkedout(),
+        ('idle',): pool.checkedin(),
+        ('overflow',): max(0, pool.overflow()),
+        ('size',): pool.size(),
+    }
+
+
+DB_POOL_CONNECTIONS = gauge('neurochat_db_pool_connections', 'DB pool connections by state', ('state',),
+                            callback=_pool_connections)
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT.observe(time.perf_counter() - start)
+
+
+def backend_name(uri):
+    """'postgresql', 'sqlite', ... from a database URI (driver suffix dropped)"""
+    scheme = uri.split(':', 1)[0].split('+', 1)[0]
+    return 'postgresql' if scheme == 'postgres' else scheme
+
+
+def select_profile(app):
+    profile = app.config.get('DB_ENGINE_PROFILE', 'auto')
+    if profile != 'auto':
+        return profile
+    uri = app.config.get('SQLALCHEMY_DATABASE_URI', '')
+    backend = backend_name(uri)
+    if backend == 'sqlite':
+        # An in-memory database lives in one connection and cannot use WAL
+        return 'sqlite_memory' if ':memory:' in uri or uri.rstrip('/') == 'sqlite:' else 'sqlite'
+    return 'pooled' if backend in ('postgresql', 'mysql') else 'default'
+
+
+def engine_options(app, profile):
+    """SQLALCHEMY_ENGINE_OPTIONS for a profile"""
+    config = app.config
+    if profile == 'pooled':
+        return {
+            'poolclass': TimedQueuePool,
+            'pool_size': config.get('DB_POOL_SIZE', 10),
+            'max_overflow': config.get('DB_MAX_OVERFLOW', 22),
+            'pool_timeout': config.get('DB_POOL_TIMEOUT', 5),
+            'pool_recycle': config.get('DB_POOL_RECYCLE', 1800),
+            'pool_pre_ping': True,
+        }
+    if profile == 'sqlite':
+        # Every thread may hold a connection; SQLite connections are cheap
+        return {
+            'poolclass': TimedQueuePool,
+            'pool_size': config.get('DB_POOL_SIZE', 10),
+            'max_overflow': config.get('DB_MAX_OVERFLOW', 22),
+            'pool_timeout': config.get('DB_POOL_TIMEOUT', 5),
+        }
+    return {}
+
+
+def sqlite_pragmas(app):
+    return (
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('busy_timeout', app.config.get('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+        ('mmap_size', app.config.get('SQLITE_MMAP_SIZE', 268435456)),
+    )
+
+
+def configure_engine_options(app):
+    """Fill in SQLALCHEMY_ENGINE_OPTIONS for the configured backend; call before db.init_app"""
+    uri = app.config.get('SQLALCHEMY_DATABASE_URI', '')
+    if uri.startswith('postgres://'):
+        # Heroku still hands out the old scheme, which SQLAlchemy 1.4+ refuses
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql://' + uri[len('postgres://'):]
+    profile = select_profile(app)
+    app.config['DB_ENGINE_PROFILE_ACTIVE'] = profile
+    options = engine_options(app, profile)
+    # Explicit engine options in the config win over the profile
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+    return profile
+
+
+def init_database(app, db):
+    """Apply per-connection settings and start exporting pool metrics"""
+    global _engine
+    with app.app_context():
+        engine = db.engine
+
+    if app.config.get('DB_ENGINE_PROFILE_ACTIVE') == 'sqlite':
+        pragmas = sqlite_pragmas(app)
+
+        @event.listens_for(engine, 'connect')
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas:
+                cursor.execute(f"PRAGMA {name}={value}")
+            cursor.close()
+
+    _engine = engine
+    return engine
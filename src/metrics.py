@@ -0,0 +1,212 @@
+"""
+Prometheus-format metrics for the chat and auth hot paths
+
+Metrics live in the memory of each worker process, so scrape every worker
+(or sum them in Prometheus) to see the whole box.
+"""
+import hmac
+import threading
+import time
+from contextlib import contextmanager
+from flask import Response, request, current_app, abort
+
+# Latency buckets in seconds, from fast DB reads to slow completions
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values)) + (extra or [])
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Counter:
+    """Monotonic counter with optional labels"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+
+class Gauge(Counter):
+    """Value that can go up and down, or be read from a callback"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.callback is not None:
+            # The callback returns {label tuple: value}
+            for key, value in sorted(self.callback().items()):
+                yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+            return
+        yield from super().samples()
+
+
+class Histogram:
+    """Cumulative histogram of observed values with optional labels"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # One count per bucket plus +Inf, then the sum
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            else:
+                series[len(self.buckets)] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for key, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), values):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', le)])} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {values[-1]}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}"
+
+
+class Registry:
+    """Collection of metrics rendered together on /metrics"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            # Re-registering by name returns the existing metric, so app
+            # factories can run more than once in a process
+            return self._metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=(), callback=None):
+    return REGISTRY.register(Gauge(name, documentation, labelnames, callback))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+HTTP_REQUESTS = counter('neurochat_http_requests_total', 'HTTP requests handled', ('endpoint', 'method', 'status'))
+HTTP_LATENCY = histogram('neurochat_http_request_seconds', 'HTTP request latency', ('endpoint',))
+CHAT_STAGE_LATENCY = histogram('neurochat_chat_stage_seconds', 'Latency of each stage of a chat turn', ('stage',))
+PASSWORD_LATENCY = histogram('neurochat_password_hash_seconds', 'bcrypt hashing and verification time', ('operation',))
+PASSWORD_QUEUE_DEPTH = gauge('neurochat_password_queue_depth', 'Password operations queued or running on the pool')
+ADMISSION_IN_FLIGHT = gauge('neurochat_admission_in_flight', 'Chat turns holding a provider slot')
+ADMISSION_REJECTIONS = counter('neurochat_admission_rejections_total', 'Chat turns answered with 429', ('reason', 'kind'))
+USER_CACHE_LOOKUPS = counter('neurochat_user_cache_lookups_total', 'user_loader lookups by cache result', ('result',))
+WRITE_BEHIND_PENDING = gauge('neurochat_write_behind_pending', 'Jobs this worker has spooled that are not done yet')
+WRITE_BEHIND_JOBS = counter('neurochat_write_behind_jobs_total', 'Write-behind jobs by task and outcome', ('task', 'result'))
+PROVIDER_CIRCUIT_STATE = gauge('neurochat_provider_circuit_state', 'Provider circuit breaker (0 closed, 1 half-open, 2 open)')
+PROVIDER_SHORT_CIRCUITS = counter('neurochat_provider_short_circuits_total', 'Provider calls failed fast by the open circuit', ('mode',))
+PROVIDER_HEDGES = counter('neurochat_provider_hedges_total', 'Hedged completion requests fired and won', ('outcome',))
+PROVIDER_ERRORS = counter('neurochat_provider_errors_total', 'Chat provider calls that failed and fell back', ('mode',))
+
+
+def chat_stage(stage):
+    """Time one stage of a chat turn (session_load, decrypt, summary, context_build, admission, provider, encrypt, session_save)"""
+    return CHAT_STAGE_LATENCY.time(stage=stage)
+
+
+def init_metrics(app):
+    """Record request metrics and serve them on /metrics"""
+
+    @app.before_request
+    def start_request_timer():
+        request.environ['neurochat.start'] = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = request.environ.get('neurochat.start')
+        endpoint = request.endpoint or 'unmatched'
+        if start is not None:
+            HTTP_LATENCY.observe(time.perf_counter() - start, endpoint=endpoint)
+        HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        """Expose metrics in the Prometheus text format"""
+        token = current_app.config.get('METRICS_TOKEN')
+        if token:
+            if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode()):
+                return Response('Unauthorized\n', status=401, mimetype='text/plain')
+        elif not current_app.config.get('METRICS_OPEN'):
+            # No token configured where metrics must not be public (production)
+            abort(404)
+        return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+    return REGISTRY
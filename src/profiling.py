@@ -0,0 +1,239 @@
+"""
+Opt-in request profiling
+
+A WSGI middleware profiles a request with cProfile when it is sampled
+(PROFILE_SAMPLE_RATE) or carries a signed X-Neurochat-Profile header from
+`flask profile-token`. Profiling covers the streamed body too and ends
+when the response is closed. Each profile goes to PROFILE_DIR as a .prof
+file (pstats format, readable by snakeviz and friends) with a .json
+summary next to it. Only the newest PROFILE_MAX_FILES are kept. With
+PROFILE_TOKEN set, /admin/profiles lists them and serves each one as a
+file or as a text report.
+"""
+import cProfile
+import hmac
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import click
+from flask import current_app, request, jsonify, send_file, abort, Response
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'X-Neurochat-Profile'
+PROFILE_NAME_RE = re.compile(r'^[\w.-]+\.prof$')
+SIGNER_SALT = 'neurochat-profile'
+
+
+class ProfileRing:
+    """Directory of the newest `max_files` profiles"""
+
+    def __init__(self, directory, max_files=50):
+        self.directory = directory
+        self.max_files = max_files
+        self._lock = threading.Lock()
+
+    def save(self, profile, meta):
+        """Write a profile and its summary, dropping the oldest beyond the limit"""
+        os.makedirs(self.directory, exist_ok=True)
+        slug = re.sub(r'[^A-Za-z0-9]+', '_', meta['path']).strip('_')[:40] or 'root'
+        # Sortable by time, so the ring and the listing can go by name
+        name = f"{time.strftime('%Y%m%dT%H%M%S')}{int(time.time() * 1000) % 1000:03d}-{os.getpid()}-{slug}.prof"
+        path = os.path.join(self.directory, name)
+        stats = pstats.Stats(profile)
+        meta = dict(meta, name=name, cpu_ms=round(stats.total_tt * 1000, 1))
+        stats.dump_stats(path)
+        with open(path[:-len('.prof')] + '.json', 'w') as f:
+            json.dump(meta, f)
+        with self._lock:
+            for old in self.list()[self.max_files:]:
+                for suffix in ('.prof', '.json'):
+                    try:
+                        os.remove(os.path.join(self.directory, old['name'][:-len('.prof')] + suffix))
+                    except FileNotFoundError:
+                        pass
+        return name
+
+    def list(self):
+        """Summaries of the stored profiles, newest first"""
+        try:
+            names = sorted((name for name in os.listdir(self.directory) if name.endswith('.json')), reverse=True)
+        except FileNotFoundError:
+            return []
+        profiles = []
+        for name in names:
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    profiles.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return profiles
+
+    def path(self, name):
+        """Absolute path of a stored profile, or None"""
+        if not PROFILE_NAME_RE.match(name):
+            return None
+        path = os.path.join(self.directory, name)
+        return path if os.path.isfile(path) else None
+
+
+class ProfilerMiddleware:
+    """Profile sampled or explicitly requested requests, one at a time per process"""
+
+    def __init__(self, wsgi_app, ring, sample_rate=0.0, signer=None, max_age=3600):
+        self.wsgi_app = wsgi_app
+        self.ring = ring
+        self.sample_rate = sample_rate
+        self.signer = signer
+        self.max_age = max_age
+        # cProfile cannot run two profilers at once, so concurrent picks are skipped
+        self._busy = threading.Lock()
+
+    def _requested(self, environ):
+        header = environ.get('HTTP_' + PROFILE_HEADER.upper().replace('-', '_'))
+        if header and self.signer is not None:
+            try:
+                self.signer.unsign(header, max_age=self.max_age)
+                return 'header'
+            except Exception:
+                logger.info("ignoring invalid profile header")
+        if self.sample_rate and random.random() < self.sample_rate:
+            return 'sampled'
+        return None
+
+    def __call__(self, environ, start_response):
+        trigger = self._requested(environ)
+        if trigger is None or not self._busy.acquire(blocking=False):
+            return self.wsgi_app(environ, start_response)
+
+        profile = cProfile.Profile()
+        started = time.perf_counter()
+        status = []
+
+        def record_status(status_line, headers, exc_info=None):
+            status.append(status_line)
+            return start_response(status_line, headers, exc_info)
+
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler (a debugger, or py-spy's sys.monitoring) is active
+            self._busy.release()
+            return self.wsgi_app(environ, start_response)
+        try:
+            body = self.wsgi_app(environ, record_status)
+        except BaseException:
+            profile.disable()
+            self._busy.release()
+            raise
+        return ProfiledBody(self, body, profile, started, {
+            'method': environ.get('REQUEST_METHOD'),
+            'path': environ.get('PATH_INFO', '/'),
+            'trigger': trigger,
+        }, status)
+
+    def finish(self, profile, meta):
+        profile.disable()
+        self._busy.release()
+        try:
+            name = self.ring.save(profile, meta)
+            logger.info("request profiled name=%s path=%s wall_ms=%s", name, meta['path'], meta['wall_ms'])
+        except Exception:
+            logger.exception("saving profile failed path=%s", meta['path'])
+
+
+class ProfiledBody:
+    """Response body that stops the profile when the server closes it"""
+
+    def __init__(self, middleware, body, profile, started, meta, status):
+        self.middleware = middleware
+        self.body = body
+        self.profile = profile
+        self.started = started
+        self.meta = meta
+        self.status = status
+        self.closed = False
+
+    def __iter__(self):
+        yield from self.body
+        # Finish as soon as the body is sent rather than relying on close() alone
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            close = getattr(self.body, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self.middleware.finish(self.profile, dict(
+                self.meta,
+                status=int(self.status[0].split(' ', 1)[0]) if self.status else None,
+                wall_ms=round((time.perf_counter() - self.started) * 1000, 1),
+                pid=os.getpid(),
+                created_at=time.time(),
+            ))
+
+
+def _signer(app):
+    from itsdangerous import TimestampSigner
+    return TimestampSigner(app.config['SECRET_KEY'], salt=SIGNER_SALT)
+
+
+def _authorized():
+    token = current_app.config.get('PROFILE_TOKEN')
+    return bool(token) and hmac.compare_digest(request.headers.get('Authorization', '').encode(),
+                                               f'Bearer {token}'.encode())
+
+
+def init_profiling(app):
+    """Wrap the app in the profiler when sampling or PROFILE_TOKEN is configured"""
+    sample_rate = app.config.get('PROFILE_SAMPLE_RATE', 0.0)
+    token = app.config.get('PROFILE_TOKEN')
+    if not sample_rate and not token:
+        return None
+
+    ring = ProfileRing(app.config['PROFILE_DIR'], app.config.get('PROFILE_MAX_FILES', 50))
+    app.wsgi_app = ProfilerMiddleware(app.wsgi_app, ring, sample_rate=sample_rate,
+                                      signer=_signer(app) if token else None,
+                                      max_age=app.config.get('PROFILE_HEADER_MAX_AGE', 3600))
+    app.extensions['profile_ring'] = ring
+
+    @app.route('/admin/profiles')
+    def list_profiles():
+        """Stored request profiles, newest first"""
+        if not _authorized():
+            abort(404)
+        return jsonify({"profiles": ring.list()})
+
+    @app.route('/admin/profiles/<name>')
+    def get_profile(name):
+        """Download a profile, or `?format=text` for the top functions by cumulative time"""
+        if not _authorized():
+            abort(404)
+        path = ring.path(name)
+        if path is None:
+            abort(404)
+        if request.args.get('format') == 'text':
+            out = io.StringIO()
+            sort = request.args.get('sort', 'cumulative')
+            if sort not in ('cumulative', 'tottime', 'calls'):
+                sort = 'cumulative'
+            pstats.Stats(path, stream=out).sort_stats(sort).print_stats(request.args.get('limit', 40, type=int))
+            return Response(out.getvalue(), mimetype='text/plain')
+        return send_file(path, mimetype='application/octet-stream', as_attachment=True, download_name=name)
+
+    @app.cli.command('profile-token')
+    def profile_token_command():
+        """Print a signed X-Neurochat-Profile header value"""
+        click.echo(f"{PROFILE_HEADER}: {_signer(app).sign(b'profile').decode()}")
+
+    return ring
@@ -0,0 +1,17 @@
+"""
+bcrypt calls run by the password pool processes
+
+Pool processes are spawned and import only this module, so it must not
+import the app or the auth package: each process then stays a bare
+interpreter plus bcrypt instead of a copy of the whole application.
+"""
+
+
+def hash_password(password, rounds):
+    import bcrypt
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds=rounds, prefix=b'2b'))
+
+
+def check_password(pw_hash, password):
+    import bcrypt
+    return bcrypt.checkpw(password, pw_hash)
@@ -138,10 +138,7 @@ async function setMode(mode) {
 
 async function handleChatMessage(message) {
     try {
-        console.log('handleChatMessage called with:', message);
-        
         // Show typing indicator immediately
-        console.log('About to show typing indicator...');
         showTypingIndicator();
         
         const headers = { 'Content-Type': 'application/json' };
@@ -150,25 +147,33 @@ async function handleChatMessage(message) {
             headers['X-CSRFToken'] = csrfToken;
         }
         
-        console.log('Sending message to backend...');
-        const response = await fetch('/auth/chat/message', {
+        // One key per message, reused by every retry, so a resend never costs a second reply
+        headers['Idempotency-Key'] = newIdempotencyKey();
+        
+        const response = await postWithRetry('/auth/chat/message/stream', {
             method: 'POST',
             headers: headers,
             body: JSON.stringify({ message: message })
         });
         
+        const contentType = response.headers.get('Content-Type') || '';
+        if (response.ok && contentType.includes('text/event-stream')) {
+            await renderStreamedReply(response);
+            return;
+        }
+        
         const data = await response.json();
-        console.log('Backend response:', data);
+        
+        if (response.status === 429) {
+            // Rate limited or overloaded: say so instead of a generic apology
+            hideTypingIndicator();
+            addMessage('ai', data.error);
+            return;
+        }
         
         if (response.ok) {
-            // Hide typing indicator first
-            console.log('Hiding typing indicator...');
             hideTypingIndicator();
-            
-            // Add AI response with a small delay for natural feel
-            setTimeout(() => {
-                addMessage('ai', data.message);
-            }, 500); // 0.5 second delay after typing stops
+            addMessage('ai', data.message);
         } else {
             throw new Error(data.error || 'Failed to send message');
         }
@@ -179,6 +184,79 @@ async function handleChatMessage(message) {
     }
 }
 
+function newIdempotencyKey() {
+    if (window.crypto && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    return Date.now().toString(36) + Math.random().toString(36).slice(2);
+}
+
+// Retry a request with the same options after a network error or a transient
+// server error; the Idempotency-Key in the headers makes this safe
+async function postWithRetry(url, options, attempts = 3) {
+    for (let attempt = 1; ; attempt++) {
+        try {
+            const response = await fetch(url, options);
+            if (attempt >= attempts || ![409, 502, 503, 504].includes(response.status)) {
+                return response;
+            }
+        } catch (error) {
+            if (attempt >= attempts) throw error;
+        }
+        await new Promise(resolve => setTimeout(resolve, 500 * 2 ** (attempt - 1)));
+    }
+}
+
+// Render a Server-Sent Events reply as its text deltas arrive
+async function renderStreamedReply(response) {
+    const chatWindow = document.getElementById('chatWindow');
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let chatDiv = null;
+    
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        
+        buffer += decoder.decode(value, { stream: true });
+        const frames = buffer.split('\n\n');
+        buffer = frames.pop();
+        
+        for (const frame of frames) {
+            let eventType = 'message';
+            let payload = '';
+            for (const line of frame.split('\n')) {
+                if (line.startsWith('event: ')) eventType = line.slice(7);
+                else if (line.startsWith('data: ')) payload += line.slice(6);
+            }
+            if (!payload) continue;
+            
+            const data = JSON.parse(payload);
+            if (eventType === 'error') {
+                throw new Error(data.error || 'Failed to send message');
+            }
+            if (!chatDiv) {
+                hideTypingIndicator();
+                chatDiv = addMessage('ai', '');
+            }
+            
+            if (eventType === 'done') {
+                chatDiv.textContent = data.message;
+            } else if (data.delta) {
+                chatDiv.textContent += data.delta;
+            }
+            if (chatWindow) {
+                chatWindow.scrollTop = chatWindow.scrollHeight;
+            }
+        }
+    }
+    
+    if (!chatDiv) {
+        hideTypingIndicator();
+    }
+}
+
 function addMessage(sender, message) {
     const chatWindow = document.getElementById('chatWindow');
     if (!chatWindow) return;
@@ -202,6 +280,8 @@ function addMessage(sender, message) {
     setTimeout(() => {
         messageDiv.classList.remove('message-animated');
     }, 300);
+    
+    return chatDiv;
 }
 
 function showTypingIndicator() {
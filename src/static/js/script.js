@@ -44,7 +44,7 @@ function getCSRFToken() {
 // Check authentication status
 async function checkAuthStatus() {
     try {
-        const response = await fetch('/guest/status');
+        const response = await fetch('/auth/guest/status');
         const data = await response.json();
         
         if (data.authenticated) {
@@ -56,12 +56,80 @@ async function checkAuthStatus() {
         
         // User is not authenticated, continue with guest mode
         isAuthenticated = false;
+        if (data.expires_at) {
+            watchGuestExpiry(data.expires_at - Date.now() / 1000);
+        }
     } catch (error) {
         console.error('Error checking auth status:', error);
         isAuthenticated = false;
     }
 }
 
+// Seconds before the expiry at which we start listening for the server's push
+const GUEST_EXPIRY_LEAD = 30;
+// Delay before reconnecting after a failed push stream, doubling up to the cap
+const GUEST_EVENTS_RETRY_MIN = 1000;
+const GUEST_EVENTS_RETRY_MAX = 60000;
+let guestEventsFailures = 0;
+
+// Wait until the guest session is nearly over, then let the server push the
+// moment it expires instead of polling the status endpoint
+function watchGuestExpiry(secondsLeft) {
+    const delay = Math.max(0, secondsLeft - GUEST_EXPIRY_LEAD) * 1000;
+    setTimeout(() => {
+        const source = new EventSource('/auth/guest/events');
+        source.addEventListener('expired', (event) => {
+            source.close();
+            guestEventsFailures = 0;
+            const data = JSON.parse(event.data);
+            if (typeof showGuestExpired === 'function') {
+                showGuestExpired(data.expiration_message);
+            }
+        });
+        source.addEventListener('pending', (event) => {
+            // Not over yet (or our clock is off): re-arm from the server's count
+            source.close();
+            guestEventsFailures = 0;
+            watchGuestExpiry(JSON.parse(event.data).remaining_time);
+        });
+        source.onerror = () => {
+            // EventSource would reconnect at once, forever; back off instead
+            source.close();
+            retryGuestExpiry();
+        };
+    }, delay);
+}
+
+// After a failed push stream, wait, then check there is still a guest
+// session to watch before connecting again
+async function retryGuestExpiry() {
+    guestEventsFailures += 1;
+    const backoff = Math.min(GUEST_EVENTS_RETRY_MAX, GUEST_EVENTS_RETRY_MIN * 2 ** (guestEventsFailures - 1));
+    await new Promise(resolve => setTimeout(resolve, backoff));
+    
+    let response;
+    try {
+        response = await fetch('/auth/guest/status', { cache: 'no-cache' });
+    } catch (error) {
+        // Offline: keep backing off
+        retryGuestExpiry();
+        return;
+    }
+    if (response.status >= 400 && response.status < 500) {
+        // The guest session is gone (logged in elsewhere, or cleared)
+        return;
+    }
+    if (!response.ok) {
+        retryGuestExpiry();
+        return;
+    }
+    const data = await response.json();
+    if (data.authenticated || !data.expires_at) {
+        return;
+    }
+    watchGuestExpiry(data.expires_at - Date.now() / 1000);
+}
+
 // Initialize chat when page loads (only on index page)
 window.addEventListener('DOMContentLoaded', function() {
     // Check if we're on the index page (has chatWindow element)
@@ -174,17 +242,7 @@ async function setMode(mode) {
 
 async function handleChatMessage(message) {
     try {
-        console.log('handleChatMessage called with:', message);
-        
-        // Check if user is authenticated
-        if (isAuthenticated) {
-            // User is authenticated, proceed with chat
-            await sendAuthenticatedMessage(message);
-            return;
-        }
-        
         // Show typing indicator immediately
-        console.log('About to show typing indicator...');
         showTypingIndicator();
         
         const headers = { 'Content-Type': 'application/json' };
@@ -193,37 +251,40 @@ async function handleChatMessage(message) {
             headers['X-CSRFToken'] = csrfToken;
         }
         
-        console.log('Sending message to backend...');
-        const response = await fetch('/auth/chat/message', {
+        // One key per message, reused by every retry, so a resend never costs a second reply
+        headers['Idempotency-Key'] = newIdempotencyKey();
+        
+        const response = await postWithRetry('/auth/chat/message/stream', {
             method: 'POST',
             headers: headers,
             body: JSON.stringify({ message: message })
         });
         
+        const contentType = response.headers.get('Content-Type') || '';
+        if (response.ok && contentType.includes('text/event-stream')) {
+            await renderStreamedReply(response);
+            return;
+        }
+        
         const data = await response.json();
-        console.log('Backend response:', data);
+        
+        if (response.status === 429) {
+            // Rate limited or overloaded: say so instead of a generic apology
+            hideTypingIndicator();
+            addMessage('ai', data.error);
+            return;
+        }
         
         if (response.ok) {
-            // Hide typing indicator first
-            console.log('Hiding typing indicator...');
             hideTypingIndicator();
-            
-            // Add AI response with a small delay for natural feel
-            setTimeout(() => {
-                addMessage('ai', data.message);
-            }, 500); // 0.5 second delay after typing stops
-        } else {
-            // Check if it's a guest time expiration error
-            if (response.status === 403 && data.expired) {
-                hideTypingIndicator();
-                addMessage('ai', data.message);
-                // Show the expired message overlay
-                if (typeof showGuestExpired === 'function') {
-                    showGuestExpired();
-                }
+            // Guest time ran out before the message was sent
+            if (data.expired && typeof showGuestExpired === 'function') {
+                showGuestExpired(data.message);
             } else {
-                throw new Error(data.error || 'Failed to send message');
+                addMessage('ai', data.message);
             }
+        } else {
+            throw new Error(data.error || 'Failed to send message');
         }
     } catch (error) {
         console.error('Error sending message:', error);
@@ -232,37 +293,76 @@ async function handleChatMessage(message) {
     }
 }
 
-// Function to send messages for authenticated users
-async function sendAuthenticatedMessage(message) {
-    try {
-        showTypingIndicator();
-        
-        const headers = { 'Content-Type': 'application/json' };
-        const csrfToken = getCSRFToken();
-        if (csrfToken) {
-            headers['X-CSRFToken'] = csrfToken;
+function newIdempotencyKey() {
+    if (window.crypto && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    return Date.now().toString(36) + Math.random().toString(36).slice(2);
+}
+
+// Retry a request with the same options after a network error or a transient
+// server error; the Idempotency-Key in the headers makes this safe
+async function postWithRetry(url, options, attempts = 3) {
+    for (let attempt = 1; ; attempt++) {
+        try {
+            const response = await fetch(url, options);
+            if (attempt >= attempts || ![409, 502, 503, 504].includes(response.status)) {
+                return response;
+            }
+        } catch (error) {
+            if (attempt >= attempts) throw error;
         }
+        await new Promise(resolve => setTimeout(resolve, 500 * 2 ** (attempt - 1)));
+    }
+}
+
+// Render a Server-Sent Events reply as its text deltas arrive
+async function renderStreamedReply(response) {
+    const chatWindow = document.getElementById('chatWindow');
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let chatDiv = null;
+    
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
         
-        const response = await fetch('/auth/chat/message', {
-            method: 'POST',
-            headers: headers,
-            body: JSON.stringify({ message: message })
-        });
+        buffer += decoder.decode(value, { stream: true });
+        const frames = buffer.split('\n\n');
+        buffer = frames.pop();
         
-        const data = await response.json();
-        
-        if (response.ok) {
-            hideTypingIndicator();
-            setTimeout(() => {
-                addMessage('ai', data.message);
-            }, 500);
-        } else {
-            throw new Error(data.error || 'Failed to send message');
+        for (const frame of frames) {
+            let eventType = 'message';
+            let payload = '';
+            for (const line of frame.split('\n')) {
+                if (line.startsWith('event: ')) eventType = line.slice(7);
+                else if (line.startsWith('data: ')) payload += line.slice(6);
+            }
+            if (!payload) continue;
+            
+            const data = JSON.parse(payload);
+            if (eventType === 'error') {
+                throw new Error(data.error || 'Failed to send message');
+            }
+            if (!chatDiv) {
+                hideTypingIndicator();
+                chatDiv = addMessage('ai', '');
+            }
+            
+            if (eventType === 'done') {
+                chatDiv.textContent = data.message;
+            } else if (data.delta) {
+                chatDiv.textContent += data.delta;
+            }
+            if (chatWindow) {
+                chatWindow.scrollTop = chatWindow.scrollHeight;
+            }
         }
-    } catch (error) {
-        console.error('Error sending authenticated message:', error);
+    }
+    
+    if (!chatDiv) {
         hideTypingIndicator();
-        addMessage('ai', "I apologize, but I'm having trouble responding right now. Please try again.");
     }
 }
 
@@ -289,6 +389,8 @@ function addMessage(sender, message) {
     setTimeout(() => {
         messageDiv.classList.remove('message-animated');
     }, 300);
+    
+    return chatDiv;
 }
 
 function showTypingIndicator() {
@@ -0,0 +1,306 @@
+"""
+Write-behind queue for work that can happen after the response is sent
+
+Jobs are appended to a SQLite spool before submit() returns, so a crash never
+loses them. A background thread per worker process claims them in batches,
+runs the registered task for each run of same-task jobs inside an app
+context, and deletes them once they succeed. Memory stays bounded because
+the jobs themselves only live in the spool.
+
+Workers on one machine share the spool file. Claims are leases: jobs left
+behind by a process that died are picked up again once the lease runs out.
+Jobs with the same key run in submission order. Delivery is at least once,
+so a crash between a task's commit and the spool delete repeats that batch.
+"""
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from flask import current_app
+from metrics import WRITE_BEHIND_JOBS, WRITE_BEHIND_PENDING
+
+logger = logging.getLogger(__name__)
+
+# Failed jobs are retried with backoff, then kept in the spool marked failed
+MAX_ATTEMPTS = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    task TEXT NOT NULL,
+    key TEXT,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    claimed_by TEXT,
+    claimed_at REAL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_jobs_key ON jobs (key);
+"""
+
+# Oldest first; a keyed job waits while an earlier job with its key is leased elsewhere
+CLAIMABLE = """
+SELECT id, task, key, payload, attempts FROM jobs AS job
+WHERE failed = 0 AND (claimed_at IS NULL OR claimed_at < :stale)
+  AND (key IS NULL OR NOT EXISTS (
+      SELECT 1 FROM jobs AS earlier
+      WHERE earlier.key = job.key AND earlier.id < job.id AND earlier.failed = 0 AND earlier.claimed_at >= :stale))
+ORDER BY id LIMIT :limit
+"""
+
+TASKS = {}
+
+
+def register_task(name):
+    """Decorator registering fn(payloads) as the handler for a job name"""
+    def decorator(fn):
+        TASKS[name] = fn
+        return fn
+    return decorator
+
+
+class WriteBehindQueue:
+    """Durable, batched background queue backed by a SQLite spool
+
+    With enabled=False every job runs inline in submit(), which keeps tests
+    and one-off scripts synchronous.
+    """
+
+    def __init__(self, app, spool_path, enabled=True, batch_size=50, max_pending=1000,
+                 lease=60.0, poll_interval=1.0):
+        self.app = app
+        self.spool_path = spool_path
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.lease = lease
+        self.poll_interval = poll_interval
+        # Ids of jobs this process spooled that have not finished yet
+        self._submitted = set()
+        self._local = threading.local()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._owner = None
+
+    @property
+    def pending(self):
+        """Jobs spooled by this process that are not finished yet"""
+        return len(self._submitted)
+
+    def _connect(self):
+        # One connection per thread; the pid check drops one inherited over a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.spool_path)), exist_ok=True)
+            conn = sqlite3.connect(self.spool_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def submit(self, task, payload, key=None):
+        """Spool a job for the background thread; runs it inline when disabled or backed up"""
+        if task not in TASKS:
+            raise KeyError(f"Unknown write-behind task {task!r}")
+        if not self.enabled or self.pending >= self.max_pending:
+            if self.enabled:
+                logger.warning("write-behind backlog full, running inline task=%s pending=%d", task, self.pending)
+            TASKS[task]([payload])
+            WRITE_BEHIND_JOBS.inc(task=task, result='inline')
+            return
+
+        job_id = self._connect().execute(
+            "INSERT INTO jobs (task, key, payload, created_at) VALUES (?, ?, ?, ?)",
+            (task, key, json.dumps(payload), time.time())).lastrowid
+        with self._cond:
+            self._submitted.add(job_id)
+            WRITE_BEHIND_PENDING.inc()
+            self.ensure_started()
+            self._cond.notify_all()
+
+    def ensure_started(self):
+        """Start the background thread in this process if it is not running"""
+        with self._cond:
+            if not self.enabled or self._stopping or (self._thread is not None and self._thread.is_alive()):
+                return
+            if self._owner != f"{os.getpid()}-{id(self)}":
+                self._owner = f"{os.getpid()}-{id(self)}"
+                atexit.register(self.drain)
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+
+    def _claim(self):
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(CLAIMABLE, {'stale': now - self.lease, 'limit': self.batch_size}).fetchall()
+            conn.executemany("UPDATE jobs SET claimed_by = ?, claimed_at = ? WHERE id = ?",
+                             [(self._owner, now, row[0]) for row in rows])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return rows
+
+    def _run_batch(self, rows):
+        """Run claimed jobs, one handler call per run of the same task
+
+        Returns the ids of the jobs that are finished, done or failed for good.
+        """
+        from auth.models import db
+        conn = self._connect()
+        finished = []
+        groups = []
+        for row in rows:
+            if groups and groups[-1][0] == row[1]:
+                groups[-1][1].append(row)
+            else:
+                groups.append((row[1], [row]))
+
+        with self.app.app_context():
+            for index, (task, group) in enumerate(groups):
+                try:
+                    TASKS[task]([json.loads(row[3]) for row in group])
+                except Exception as e:
+                    db.session.rollback()
+                    if self._retry(conn, task, group, e):
+                        finished.extend(row[0] for row in group)
+                    # Hand the rest back so nothing overtakes the failed jobs
+                    conn.executemany("UPDATE jobs SET claimed_by = NULL, claimed_at = NULL WHERE id = ?",
+                                     [(row[0],) for _, later in groups[index + 1:] for row in later])
+                    break
+                conn.executemany("DELETE FROM jobs WHERE id = ?", [(row[0],) for row in group])
+                WRITE_BEHIND_JOBS.inc(len(group), task=task, result='done')
+                finished.extend(row[0] for row in group)
+            db.session.remove()
+        return finished
+
+    def _retry(self, conn, task, group, error):
+        """Schedule a failed group again after a backoff; returns True once it has failed for good"""
+        attempts = group[0][4] + 1
+        if attempts >= MAX_ATTEMPTS:
+            logger.error("write-behind task failed for good task=%s jobs=%d error=%r", task, len(group), error)
+            conn.executemany("UPDATE jobs SET failed = 1, attempts = ? WHERE id = ?",
+                             [(attempts, row[0]) for row in group])
+            WRITE_BEHIND_JOBS.inc(len(group), task=task, result='failed')
+            return True
+        # Backdating the lease makes the jobs claimable again after the backoff
+        backoff = min(2 ** attempts, 60)
+        logger.warning("write-behind task failed, retrying task=%s jobs=%d in=%ss error=%r",
+                       task, len(group), backoff, error)
+        conn.executemany("UPDATE jobs SET attempts = ?, claimed_by = NULL, claimed_at = ? WHERE id = ?",
+                         [(attempts, time.time() - self.lease + backoff, row[0]) for row in group])
+        WRITE_BEHIND_JOBS.inc(len(group), task=task, result='retry')
+        return False
+
+    def _finished(self, job_ids):
+        """Stop counting jobs of this process that will not run again"""
+        with self._cond:
+            mine = self._submitted.intersection(job_ids)
+            self._submitted.difference_update(mine)
+            WRITE_BEHIND_PENDING.dec(len(mine))
+            self._cond.notify_all()
+
+    def _forget_gone(self):
+        # Jobs of ours another worker ran after our lease lapsed are gone from the spool
+        with self._cond:
+            ids = list(self._submitted)
+        if not ids:
+            return
+        conn = self._connect()
+        present = set()
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            present.update(row[0] for row in conn.execute(
+                f"SELECT id FROM jobs WHERE failed = 0 AND id IN ({','.join('?' * len(chunk))})", chunk))
+        self._finished(set(ids) - present)
+
+    def _run(self):
+        while True:
+            try:
+                rows = self._claim()
+                if rows:
+                    self._finished(self._run_batch(rows))
+                else:
+                    self._forget_gone()
+            except Exception:
+                logger.exception("write-behind batch failed")
+                rows = []
+            with self._cond:
+                if rows:
+                    continue
+                if self._stopping:
+                    return
+                # Submits wake the thread; the timeout also picks up other workers' leftovers
+                self._cond.wait(self.poll_interval)
+
+    def has_pending(self, key):
+        """Whether unfinished jobs with this key are still in the spool"""
+        if not self.enabled:
+            return False
+        row = self._connect().execute("SELECT 1 FROM jobs WHERE key = ? AND failed = 0 LIMIT 1", (key,)).fetchone()
+        return row is not None
+
+    def wait_for(self, key, timeout=2.0):
+        """Block until jobs with this key are done so a read sees their writes
+
+        Returns False if they are still pending after `timeout` seconds.
+        """
+        deadline = time.monotonic() + timeout
+        while self.has_pending(key):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.warning("write-behind jobs still pending key=%s", key)
+                return False
+            self.ensure_started()
+            with self._cond:
+                self._cond.wait(min(remaining, 0.05))
+        return True
+
+    def drain(self, timeout=10.0):
+        """Stop taking new background work and finish what is spooled, up to `timeout`"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+            if thread.is_alive():
+                logger.warning("write-behind drain timed out pending=%d", self.pending)
+                return False
+        # Later submits run inline
+        self.enabled = False
+        return True
+
+
+def init_write_behind(app):
+    """Build the process-wide write-behind queue; its thread starts on first use"""
+    queue = WriteBehindQueue(
+        app,
+        spool_path=app.config['WRITE_BEHIND_SPOOL'],
+        enabled=app.config.get('WRITE_BEHIND_ENABLED', True),
+        batch_size=app.config.get('WRITE_BEHIND_BATCH_SIZE', 50),
+        max_pending=app.config.get('WRITE_BEHIND_MAX_PENDING', 1000),
+        lease=app.config.get('WRITE_BEHIND_LEASE', 60.0),
+    )
+    app.extensions['write_behind'] = queue
+
+    @app.before_request
+    def start_write_behind():
+        # Picks up jobs a crashed or restarted worker left in the spool
+        if queue._thread is None:
+            queue.ensure_started()
+
+    return queue
+
+
+def get_write_behind():
+    """Return the write-behind queue of the current app"""
+    return current_app.extensions['write_behind']
@@ -0,0 +1,42 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+os.environ.setdefault('SECRET_KEY', 'test')
+
+
+@pytest.fixture
+def app():
+    from app import create_app
+    from auth.models import db
+    app = create_app('testing')
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def make_user(app):
+    from auth.models import db, User
+
+    def make_user(email):
+        user = User(first_name=email.split('@')[0], email=email, password_hash='x')
+        db.session.add(user)
+        db.session.commit()
+        return user
+    return make_user
+
+
+def login(client, user):
+    """Log the test client in as a user without going through the password form"""
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
@@ -0,0 +1,80 @@
+import pytest
+from auth.admission import get_admission
+from conftest import login
+
+
+@pytest.fixture
+def chat(client, make_user):
+    login(client, make_user('chat@example.com'))
+    assert client.post('/auth/chat/mode', json={'mode': 'talk'}).status_code == 200
+    # Two requests of burst and a negligible refill rate
+    get_admission().limits['user'] = (0.001, 2, 100000)
+    return client
+
+
+def send(client, message, key=None, path='/auth/chat/message'):
+    return client.post(path, json={'message': message}, headers={'Idempotency-Key': key} if key else {})
+
+
+def test_request_quota_throttles(chat):
+    assert send(chat, 'one').status_code == 200
+    assert send(chat, 'two').status_code == 200
+    response = send(chat, 'three')
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) > 0
+
+
+def test_replay_is_not_charged(chat):
+    first = send(chat, 'hello', key='k1')
+    assert first.status_code == 200
+    for _ in range(3):
+        replay = send(chat, 'hello', key='k1')
+        assert replay.status_code == 200
+        assert replay.headers['Idempotent-Replayed'] == 'true'
+        assert replay.get_json() == first.get_json()
+    # The replays left the second request of the burst untouched
+    assert send(chat, 'another').status_code == 200
+
+
+def test_key_reuse_is_reported_before_the_quota(chat):
+    assert send(chat, 'hello', key='k1').status_code == 200
+    assert send(chat, 'two').status_code == 200
+    assert send(chat, 'something else', key='k1').status_code == 422
+
+
+def test_throttled_turn_releases_its_key(chat):
+    assert send(chat, 'one').status_code == 200
+    assert send(chat, 'two').status_code == 200
+    assert send(chat, 'three', key='k1').status_code == 429
+    # The quota refills
+    get_admission().backend._buckets.clear()
+    response = send(chat, 'three', key='k1')
+    assert response.status_code == 200
+    assert 'Idempotent-Replayed' not in response.headers
+
+
+def test_stream_replay_is_not_charged(chat):
+    first = send(chat, 'hello', key='k1', path='/auth/chat/message/stream')
+    assert first.status_code == 200
+    assert b'event: done' in first.data
+    for _ in range(3):
+        replay = send(chat, 'hello', key='k1', path='/auth/chat/message/stream')
+        assert replay.headers['Idempotent-Replayed'] == 'true'
+        assert b'event: done' in replay.data
+
+
+def test_stream_setup_failure_releases_slot_and_key(chat, monkeypatch):
+    import auth.routes
+    admission = get_admission()
+
+    def broken(*args, **kwargs):
+        raise RuntimeError('spool down')
+    monkeypatch.setattr(auth.routes, 'queue_messages', broken)
+    with pytest.raises(RuntimeError):
+        send(chat, 'hello', key='k1', path='/auth/chat/message/stream')
+    assert admission.backend._slots['provider'] == 0
+
+    monkeypatch.undo()
+    response = send(chat, 'hello', key='k1', path='/auth/chat/message/stream')
+    assert 'Idempotent-Replayed' not in response.headers
+    assert b'event: done' in response.data
@@ -0,0 +1,37 @@
+from auth.cipher import get_cipher, generate_key, parse_key
+
+
+def use_key(app, key):
+    app.config['ENCRYPTION_KEY'] = key
+    app.extensions['cipher'] = None
+
+
+def test_round_trip_with_generated_key(app):
+    use_key(app, generate_key())
+    cipher = get_cipher()
+    encrypted = cipher.encrypt('hello')
+    assert encrypted != 'hello'
+    assert cipher.decrypt(encrypted) == 'hello'
+
+
+def test_invalid_key_falls_back_to_a_working_key(app):
+    use_key(app, 'not-a-fernet-key')
+    cipher = get_cipher()
+    encrypted = cipher.encrypt('hello')
+    assert encrypted != 'hello'
+    assert cipher.decrypt(encrypted) == 'hello'
+
+
+def test_parse_key_restores_padding():
+    key = generate_key()
+    assert not key.endswith('=')
+    assert parse_key(key) == (key + '=').encode()
+
+
+def test_old_keys_still_decrypt(app):
+    old = generate_key()
+    use_key(app, old)
+    encrypted = get_cipher().encrypt('hello')
+    app.config['ENCRYPTION_OLD_KEYS'] = old
+    use_key(app, generate_key())
+    assert get_cipher().decrypt(encrypted) == 'hello'
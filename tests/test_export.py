@@ -0,0 +1,61 @@
+import json
+import pytest
+from auth.models import db, Conversation
+from auth.conversations import add_messages
+from auth.cipher import get_cipher
+from auth.export import iter_export
+from conftest import login
+
+
+@pytest.fixture
+def owner_conversation(make_user):
+    owner = make_user('owner@example.com')
+    conversation = Conversation(user_id=owner.id, mode='talk')
+    db.session.add(conversation)
+    db.session.commit()
+    add_messages(conversation, [('user', get_cipher().encrypt('owner secret'), True),
+                                ('ai', get_cipher().encrypt('a reply'), True)])
+    return owner, conversation
+
+
+def records(chunks):
+    return [json.loads(line) for chunk in chunks for line in chunk.splitlines()]
+
+
+def test_export_resumes_from_own_cursor(owner_conversation):
+    owner, conversation = owner_conversation
+    first = records(iter_export(owner.id))
+    messages = [record for record in first if record['type'] == 'message']
+    assert [record['message'] for record in messages] == ['owner secret', 'a reply']
+
+    resumed = records(iter_export(owner.id, messages[0]['cursor']))
+    assert [record['message'] for record in resumed if record['type'] == 'message'] == ['a reply']
+    assert resumed[-1] == {'type': 'end', 'conversations': 0, 'messages': 1}
+
+
+def test_export_refuses_cursor_of_another_user(owner_conversation, make_user):
+    _, conversation = owner_conversation
+    other = make_user('other@example.com')
+    with pytest.raises(ValueError):
+        iter_export(other.id, f"{conversation.id}:0")
+
+
+def test_export_route_refuses_cursor_of_another_user(owner_conversation, make_user, client):
+    _, conversation = owner_conversation
+    login(client, make_user('other@example.com'))
+
+    response = client.get(f'/auth/export?cursor={conversation.id}:0')
+    assert response.status_code == 400
+    assert 'owner secret' not in response.get_data(as_text=True)
+
+
+def test_export_cli_refuses_cursor_of_another_user(app, owner_conversation, make_user, tmp_path):
+    _, conversation = owner_conversation
+    other = make_user('other@example.com')
+    output = tmp_path / 'export.ndjson'
+
+    result = app.test_cli_runner().invoke(args=['export-conversations', str(other.id), '-o', str(output),
+                                                '--cursor', f"{conversation.id}:0"])
+    assert result.exit_code != 0
+    assert 'does not belong' in result.output
+    assert not output.exists()
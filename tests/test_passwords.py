@@ -0,0 +1,34 @@
+import threading
+import pytest
+from auth.passwords import PasswordHasher, PasswordPoolBusy, init_password_hasher
+
+
+def test_every_server_worker_gets_a_pool_process(app):
+    app.config.update(PASSWORD_WORKERS=2, WEB_CONCURRENCY=5)
+    assert init_password_hasher(app).workers == 1
+    app.config.update(PASSWORD_WORKERS=16, WEB_CONCURRENCY=4)
+    assert init_password_hasher(app).workers == 4
+    app.config.update(PASSWORD_WORKERS=0)
+    assert init_password_hasher(app).workers == 0
+
+
+def test_inline_hashing_is_bounded():
+    hasher = PasswordHasher(rounds=4, workers=0, max_queue=1)
+    started, release = threading.Event(), threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return 'done'
+
+    results = []
+    thread = threading.Thread(target=lambda: results.append(hasher._run(slow)))
+    thread.start()
+    assert started.wait(5)
+    with pytest.raises(PasswordPoolBusy):
+        hasher.generate_password_hash('secret')
+    release.set()
+    thread.join(5)
+    assert results == ['done']
+    assert hasher.pending == 0
+    assert hasher.check_password_hash(hasher.generate_password_hash('secret'), 'secret')
@@ -0,0 +1,66 @@
+import os
+import pytest
+from flask import Flask
+from profiling import init_profiling, _signer, PROFILE_HEADER
+
+TOKEN = 'profile-secret'
+
+
+@pytest.fixture
+def profiled(tmp_path):
+    app = Flask('profiled')
+    app.config.update(SECRET_KEY='test', PROFILE_TOKEN=TOKEN, PROFILE_DIR=str(tmp_path), PROFILE_MAX_FILES=2)
+
+    @app.route('/ping/<int:n>')
+    def ping(n):
+        return 'pong'
+
+    ring = init_profiling(app)
+    return app, app.test_client(), ring
+
+
+def profile_requests(app, client, count):
+    header = _signer(app).sign(b'profile').decode()
+    for n in range(count):
+        assert client.get(f'/ping/{n}', headers={PROFILE_HEADER: header}).data == b'pong'
+
+
+@pytest.mark.parametrize('headers', [{}, {'Authorization': 'Bearer wrong'}, {'Authorization': TOKEN}])
+def test_listing_needs_the_token(profiled, headers):
+    app, client, ring = profiled
+    assert client.get('/admin/profiles', headers=headers).status_code == 404
+
+
+def test_profile_download_needs_the_token(profiled):
+    app, client, ring = profiled
+    profile_requests(app, client, 1)
+    name = ring.list()[0]['name']
+    assert client.get(f'/admin/profiles/{name}', headers={'Authorization': 'Bearer wrong'}).status_code == 404
+    response = client.get(f'/admin/profiles/{name}?format=text', headers={'Authorization': f'Bearer {TOKEN}'})
+    assert response.status_code == 200
+    assert b'function calls' in response.data
+
+
+def test_ring_keeps_the_newest_profiles(profiled, tmp_path):
+    app, client, ring = profiled
+    profile_requests(app, client, 4)
+    response = client.get('/admin/profiles', headers={'Authorization': f'Bearer {TOKEN}'})
+    assert response.status_code == 200
+    profiles = response.get_json()['profiles']
+    assert [profile['path'] for profile in profiles] == ['/ping/3', '/ping/2']
+    assert all(profile['status'] == 200 and profile['trigger'] == 'header' for profile in profiles)
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        profile['name'][:-len('.prof')] + suffix for profile in profiles for suffix in ('.prof', '.json'))
+
+
+def test_unsigned_header_is_not_profiled(profiled):
+    app, client, ring = profiled
+    client.get('/ping/1', headers={PROFILE_HEADER: 'forged'})
+    assert ring.list() == []
+
+
+def test_routes_absent_without_a_token(tmp_path):
+    app = Flask('unprofiled')
+    app.config.update(SECRET_KEY='test', PROFILE_DIR=str(tmp_path))
+    assert init_profiling(app) is None
+    assert app.test_client().get('/admin/profiles', headers={'Authorization': 'Bearer None'}).status_code == 404
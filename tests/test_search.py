@@ -0,0 +1,100 @@
+import json
+import pytest
+from auth.models import db, Conversation, MessageToken
+from auth.conversations import queue_messages, add_messages
+from auth.cipher import get_cipher
+from auth.search import search_messages, get_search_index, reindex, SearchIndex
+from writebehind import get_write_behind
+from conftest import login
+
+SECRET = 'the zebra ate my homework'
+
+
+def store_turn(user, text, reply='tell me more'):
+    conversation = Conversation(user_id=user.id if user else None, mode='talk')
+    db.session.add(conversation)
+    db.session.commit()
+    queue_messages(conversation, [('user', get_cipher().encrypt(text), True), ('ai', get_cipher().encrypt(reply), True)],
+                   texts=[text, reply])
+    return conversation
+
+
+@pytest.fixture
+def alice(make_user):
+    return make_user('alice@example.com')
+
+
+@pytest.fixture
+def bob(make_user):
+    return make_user('bob@example.com')
+
+
+def test_user_finds_own_messages(client, alice):
+    store_turn(alice, SECRET)
+    results, has_more = search_messages(alice.id, 'Zebra homework')
+    assert [result['message'] for result in results] == [SECRET]
+    assert not has_more
+
+    login(client, alice)
+    response = client.get('/auth/chat/search?q=zebra')
+    assert [result['message'] for result in response.get_json()['results']] == [SECRET]
+
+
+def test_user_cannot_match_another_users_messages(client, alice, bob):
+    store_turn(alice, SECRET)
+    assert search_messages(bob.id, 'zebra') == ([], False)
+
+    login(client, bob)
+    response = client.get('/auth/chat/search?q=zebra')
+    assert response.status_code == 200
+    assert response.get_json()['results'] == []
+
+
+def test_same_word_gets_the_same_token_for_every_user(alice, bob):
+    # Scoping comes from the user_id column, so it must hold even when tokens collide
+    store_turn(alice, SECRET)
+    store_turn(bob, 'a zebra of my own')
+    assert [result['message'] for result in search_messages(bob.id, 'zebra')[0]] == ['a zebra of my own']
+    assert [result['message'] for result in search_messages(alice.id, 'zebra')[0]] == [SECRET]
+
+
+def test_tokens_are_not_stored_in_plaintext(alice):
+    store_turn(alice, SECRET)
+    tokens = {row.token for row in MessageToken.query.all()}
+    assert tokens
+    for term in ('zebra', 'ate', 'homework', 'tell', 'more'):
+        assert term not in tokens
+        assert not any(term in token for token in tokens)
+    assert get_search_index().token('zebra') in tokens
+    # Without the key the tokens cannot be recomputed
+    assert SearchIndex(b'another key').token('zebra') not in tokens
+
+
+def test_spooled_job_carries_tokens_not_text(app, alice, monkeypatch):
+    write_behind = get_write_behind()
+    submitted = []
+    original = write_behind.submit
+    monkeypatch.setattr(write_behind, 'submit',
+                        lambda task, payload, key=None: (submitted.append(json.dumps(payload)), original(task, payload, key)))
+    store_turn(alice, SECRET)
+    assert submitted
+    assert 'zebra' not in submitted[0] and 'homework' not in submitted[0]
+
+
+def test_guest_conversations_are_not_indexed(app):
+    store_turn(None, SECRET)
+    assert MessageToken.query.count() == 0
+
+
+def test_reindex_rebuilds_scoped_tokens(alice, bob):
+    store_turn(alice, SECRET)
+    conversation = Conversation(user_id=bob.id, mode='talk')
+    db.session.add(conversation)
+    db.session.commit()
+    add_messages(conversation, [('user', get_cipher().encrypt('zebra crossing'), True)])
+    # Encrypted messages stored without their texts are only found after a rebuild
+    assert search_messages(bob.id, 'zebra') == ([], False)
+
+    assert reindex() == 3
+    assert [result['message'] for result in search_messages(bob.id, 'zebra')[0]] == ['zebra crossing']
+    assert [result['message'] for result in search_messages(alice.id, 'zebra')[0]] == [SECRET]
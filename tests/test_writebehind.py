@@ -0,0 +1,154 @@
+import time
+import pytest
+from writebehind import WriteBehindQueue, register_task, MAX_ATTEMPTS
+
+calls = []
+failures = {}
+
+
+@register_task('test_record')
+def record(payloads):
+    calls.extend(payloads)
+
+
+@register_task('test_flaky')
+def flaky(payloads):
+    for payload in payloads:
+        if failures.get(payload['n'], 0) > 0:
+            failures[payload['n']] -= 1
+            raise RuntimeError('flaky')
+    calls.extend(payloads)
+
+
+@pytest.fixture(autouse=True)
+def reset():
+    calls.clear()
+    failures.clear()
+
+
+@pytest.fixture
+def spool(tmp_path):
+    return str(tmp_path / 'spool.db')
+
+
+@pytest.fixture
+def make_queue(app, spool):
+    queues = []
+
+    def make_queue(**kwargs):
+        queue = WriteBehindQueue(app, spool, **dict({'lease': 60.0, 'poll_interval': 0.02}, **kwargs))
+        queues.append(queue)
+        return queue
+    yield make_queue
+    for queue in queues:
+        queue.drain(timeout=5)
+
+
+def spool_job(queue, task, payload, key=None, claimed_by=None, claimed_at=None):
+    """Put a job in the spool directly, as another (possibly dead) worker would"""
+    import json
+    return queue._connect().execute(
+        "INSERT INTO jobs (task, key, payload, claimed_by, claimed_at, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        (task, key, json.dumps(payload), claimed_by, claimed_at, time.time())).lastrowid
+
+
+def test_claim_skips_leased_jobs_and_recovers_stale_ones(make_queue):
+    first, second = make_queue(), make_queue()
+    ids = [spool_job(first, 'test_record', {'n': n}) for n in range(3)]
+
+    assert [row[0] for row in first._claim()] == ids
+    # Leased by a live worker: nobody else may take them
+    assert second._claim() == []
+
+    # The first worker died; once its lease runs out the jobs are claimable again
+    first._connect().execute("UPDATE jobs SET claimed_at = ?", (time.time() - 61,))
+    assert [row[0] for row in second._claim()] == ids
+
+
+def test_keyed_job_waits_while_an_earlier_one_is_leased(make_queue):
+    queue = make_queue()
+    spool_job(queue, 'test_record', {'n': 1}, key='a', claimed_by='other', claimed_at=time.time())
+    spool_job(queue, 'test_record', {'n': 2}, key='a')
+    unkeyed = spool_job(queue, 'test_record', {'n': 3}, key='b')
+
+    assert [row[0] for row in queue._claim()] == [unkeyed]
+
+
+def test_jobs_with_a_key_run_in_submission_order(make_queue):
+    queue = make_queue()
+    for n in range(40):
+        queue.submit('test_record', {'n': n, 'key': n % 3}, key=f"k{n % 3}")
+    for key in range(3):
+        assert queue.wait_for(f"k{key}", timeout=5)
+
+    for key in range(3):
+        assert [c['n'] for c in calls if c['key'] == key] == list(range(key, 40, 3))
+    assert queue.pending == 0
+
+
+def test_failed_job_is_retried_after_a_backoff(make_queue):
+    queue = make_queue()
+    job = spool_job(queue, 'test_flaky', {'n': 1})
+    failures[1] = 1
+
+    finished = queue._run_batch(queue._claim())
+    assert finished == []
+    attempts, claimed_at = queue._connect().execute(
+        "SELECT attempts, claimed_at FROM jobs WHERE id = ?", (job,)).fetchone()
+    assert attempts == 1
+    # Claimable again two seconds from now, not before
+    assert claimed_at == pytest.approx(time.time() - queue.lease + 2, abs=1)
+    assert queue._claim() == []
+
+    queue._connect().execute("UPDATE jobs SET claimed_at = ?", (time.time() - queue.lease - 1,))
+    assert queue._run_batch(queue._claim()) == [job]
+    assert calls == [{'n': 1}]
+
+
+def test_job_is_marked_failed_after_max_attempts(make_queue):
+    queue = make_queue()
+    job = spool_job(queue, 'test_flaky', {'n': 1})
+    queue._connect().execute("UPDATE jobs SET attempts = ?", (MAX_ATTEMPTS - 1,))
+    failures[1] = 1
+
+    assert queue._run_batch(queue._claim()) == [job]
+    assert queue._connect().execute("SELECT failed FROM jobs WHERE id = ?", (job,)).fetchone() == (1,)
+    assert not queue.has_pending(None)
+
+
+def test_pending_counts_only_this_process_jobs_until_they_finish(make_queue):
+    queue = make_queue()
+    # Leftovers of a worker that died do not reduce our own count
+    for n in range(5):
+        spool_job(queue, 'test_record', {'n': n}, claimed_by='dead', claimed_at=time.time() - 120)
+    failures[99] = 2
+    queue.submit('test_flaky', {'n': 99}, key='flaky')
+    queue.submit('test_record', {'n': 100}, key='ok')
+
+    assert queue.wait_for('ok', timeout=5)
+    # The flaky job is waiting out its backoff, so it still counts
+    assert queue.pending == 1
+    assert queue.has_pending('flaky')
+    assert not queue.wait_for('flaky', timeout=0.2)
+
+    queue._connect().execute("UPDATE jobs SET claimed_at = ?", (time.time() - queue.lease - 1,))
+    assert queue.wait_for('flaky', timeout=5)
+    time.sleep(0.1)
+    assert queue.pending == 0
+    assert sorted(c['n'] for c in calls) == [0, 1, 2, 3, 4, 99, 100]
+
+
+def test_settle_waits_for_queued_messages(app, make_queue):
+    from auth.models import db, Conversation, Message
+    from auth.conversations import queue_messages, settle
+
+    queue = make_queue()
+    app.extensions['write_behind'] = queue
+    conversation = Conversation(mode='talk')
+    db.session.add(conversation)
+    db.session.commit()
+
+    queue_messages(conversation, [('user', 'hello', False), ('ai', 'hi there', False)])
+    settle(conversation)
+    assert [m.body for m in Message.query.filter_by(conversation_id=conversation.id).order_by(Message.id)] == \
+        ['hello', 'hi there']